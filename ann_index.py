@@ -0,0 +1,188 @@
+# ann_index.py
+
+import os
+import sys
+import time
+import numpy as np
+
+
+# --- CONFIGURAÇÕES DO ÍNDICE APROXIMADO (IVF) ---
+# Abaixo deste número de chunks a busca exata é usada (é mais rápida e sem perda de recall).
+ANN_MIN_ROWS = int(os.getenv("RAG_ANN_MIN_ROWS", 20000))
+# Número de clusters visitados por consulta: mais clusters = mais recall e mais latência.
+IVF_NPROBE = int(os.getenv("RAG_IVF_NPROBE", 8))
+
+
+def ivf_index_path(db_path):
+    """Caminho do arquivo do índice IVF, guardado ao lado do banco de dados."""
+    return os.path.splitext(db_path)[0] + '.ivf.npz'
+
+
+def default_n_clusters(n_rows):
+    """Heurística habitual para IVF: cerca de 4 * sqrt(N) clusters."""
+    return max(1, min(n_rows, int(4 * np.sqrt(n_rows))))
+
+
+def _assign(matrix, centroids, batch_size=8192):
+    """Atribui cada linha (normalizada) ao centroide mais similar."""
+    labels = np.empty(len(matrix), dtype=np.int32)
+    for start in range(0, len(matrix), batch_size):
+        block = matrix[start:start + batch_size]
+        labels[start:start + batch_size] = np.argmax(block @ centroids.T, axis=1)
+    return labels
+
+
+def train_kmeans(matrix, n_clusters, iterations=20, sample_size=100_000, seed=0):
+    """
+    K-means esférico (similaridade de cosseno) sobre uma amostra das linhas.
+    As linhas de 'matrix' devem estar normalizadas.
+    """
+    rng = np.random.default_rng(seed)
+    if len(matrix) > sample_size:
+        sample = matrix[np.sort(rng.choice(len(matrix), sample_size, replace=False))]
+    else:
+        sample = matrix
+    centroids = sample[rng.choice(len(sample), n_clusters, replace=False)].astype(np.float32)
+
+    for _ in range(iterations):
+        labels = _assign(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        counts = np.bincount(labels, minlength=n_clusters)
+
+        # Clusters vazios recebem um ponto aleatório da amostra
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            sums[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        new_centroids = sums / norms
+        if np.allclose(new_centroids, centroids, atol=1e-5):
+            centroids = new_centroids
+            break
+        centroids = new_centroids
+    return np.ascontiguousarray(centroids, dtype=np.float32)
+
+
+class IVFIndex:
+    """
+    Índice de ficheiros invertidos (IVF): cada chunk pertence a um cluster,
+    e a consulta só compara os chunks dos 'nprobe' clusters mais próximos.
+    """
+
+    def __init__(self, centroids, order, offsets, ids, version):
+        self.centroids = centroids
+        self.order = order        # posições das linhas agrupadas por cluster
+        self.offsets = offsets    # início de cada cluster em 'order' (len = n_clusters + 1)
+        self.ids = ids
+        self.version = version
+
+    @classmethod
+    def build(cls, matrix, ids, version, n_clusters=None, iterations=20):
+        """Treina os centroides e monta as listas invertidas."""
+        n_clusters = n_clusters or default_n_clusters(len(matrix))
+        centroids = train_kmeans(matrix, n_clusters, iterations=iterations)
+        labels = _assign(matrix, centroids)
+        order = np.argsort(labels, kind='stable').astype(np.int64)
+        offsets = np.zeros(n_clusters + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=n_clusters), out=offsets[1:])
+        return cls(centroids, order, offsets, np.asarray(ids, dtype=np.int64), version)
+
+    def save(self, path):
+        """Grava o índice de forma atómica (arquivo temporário + rename)."""
+        tmp_path = f"{path}.tmp.{os.getpid()}.npz"
+        np.savez(tmp_path, centroids=self.centroids, order=self.order,
+                 offsets=self.offsets, ids=self.ids, version=np.int64(self.version))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['centroids'], data['order'], data['offsets'],
+                       data['ids'], int(data['version']))
+
+    def matches(self, ids, version):
+        """Verifica se o índice corresponde à versão e aos chunks carregados."""
+        return self.version == version and np.array_equal(self.ids, ids)
+
+    def search(self, matrix, query, top_k, nprobe=None):
+        """
+        Devolve (posições, similaridades) dos 'top_k' melhores candidatos.
+        'query' deve estar normalizada.
+        """
+        nprobe = min(nprobe or IVF_NPROBE, len(self.centroids))
+        centroid_scores = self.centroids @ query
+        if nprobe < len(centroid_scores):
+            probe = np.argpartition(centroid_scores, -nprobe)[-nprobe:]
+        else:
+            probe = np.arange(len(centroid_scores))
+
+        candidates = np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in probe])
+        if len(candidates) == 0:
+            return candidates, np.empty(0, dtype=np.float32)
+
+        scores = matrix[candidates] @ query
+        k = min(top_k, len(scores))
+        best = np.argpartition(scores, -k)[-k:] if k < len(scores) else np.arange(len(scores))
+        best = best[np.argsort(scores[best])[::-1]]
+        return candidates[best], scores[best]
+
+
+# --- AVALIAÇÃO (RECALL@K) ---
+def sample_test_queries(matrix, n_queries, seed=42):
+    """Usa os próprios chunks (com um pouco de ruído) como consultas de teste normalizadas."""
+    rng = np.random.default_rng(seed)
+    sample = matrix[np.sort(rng.choice(len(matrix), min(n_queries, len(matrix)), replace=False))]
+    queries = sample + rng.normal(scale=0.05, size=sample.shape).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return queries
+
+
+def recall_at_k(matrix, ivf, queries, k=3, nprobe=None):
+    """
+    Compara o IVF com a busca exata para um conjunto de consultas normalizadas.
+    Retorna (recall médio, latência média em ms).
+    """
+    hits = 0
+    elapsed = 0.0
+    for query in queries:
+        exact_scores = matrix @ query
+        exact = set(np.argpartition(exact_scores, -k)[-k:].tolist())
+        start = time.perf_counter()
+        approx, _ = ivf.search(matrix, query, k, nprobe=nprobe)
+        elapsed += time.perf_counter() - start
+        hits += len(exact.intersection(approx.tolist()))
+    return hits / (k * len(queries)), 1000 * elapsed / len(queries)
+
+
+def print_recall_report(db_path, k=3, n_queries=200, nprobes=(1, 2, 4, 8, 16, 32, 64)):
+    """Imprime o recall@k e a latência para vários valores de nprobe."""
+    from knowledge_index import KnowledgeIndex
+
+    index = KnowledgeIndex(db_path, use_ann=False, quantization='none')
+    index.refresh()
+    ids, matrix, _ = index._data
+    if len(ids) == 0:
+        print("Base de conhecimento vazia. Nada para avaliar.")
+        return
+
+    path = ivf_index_path(db_path)
+    ivf = IVFIndex.load(path) if os.path.exists(path) else None
+    if ivf is None or not ivf.matches(ids, index.version):
+        print("Índice IVF ausente ou desatualizado. Construindo um temporário para a avaliação...")
+        ivf = IVFIndex.build(matrix, ids, index.version)
+
+    queries = sample_test_queries(matrix, n_queries)
+
+    print(f"\n--- Recall@{k} do IVF ({len(matrix)} chunks, {len(ivf.centroids)} clusters) ---")
+    for nprobe in nprobes:
+        if nprobe > len(ivf.centroids):
+            break
+        recall, latency_ms = recall_at_k(matrix, ivf, queries, k=k, nprobe=nprobe)
+        print(f"nprobe={nprobe:<4} recall@{k}={recall:.3f}  latência média={latency_ms:.3f} ms")
+
+
+if __name__ == "__main__":
+    from database_manager import DB_PATH
+    print_recall_report(sys.argv[1] if len(sys.argv) > 1 else DB_PATH)
@@ -10,22 +10,29 @@ import pathlib
 import base64 
 import mimetypes 
 import json   
+import asyncio
+import sqlite3
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from dotenv import load_dotenv
 from google.cloud import speech
 from google.cloud import texttospeech
 
 # Importa TODAS as funções do banco de dados.
 from database_manager import (
-    initialize_database, load_user_data, add_new_user,
-    update_user_name, get_user_status, set_user_status,
-    initialize_settings, get_setting, set_setting, DB_PATH,
-    add_message_to_history, get_chat_history, add_received_file,
-    get_pending_file, set_pending_file,
-    get_relevant_knowledge 
+    initialize_database, add_new_user, iter_users, get_users_page,
+    update_user_name, set_user_status,
+    get_setting, set_setting, DB_PATH,
+    add_message_to_history, flush_chat_history, add_received_file,
+    set_pending_file, load_conversation_context,
+    get_relevant_knowledge, get_knowledge_version, get_query_cache_stats,
+    VIEWABLE_TABLES, parse_page_cursor, fetch_table_page, iter_table_rows, count_table_rows
 )
 from validator import is_valid_name
+from retrieval_cache import RetrievalCache
+from prompt_budget import fit_history_to_budget
+from job_queue import JobQueue, JOB_COALESCE_SECONDS
+from message_dedup import MessageDedup
 
 # --- 1. CONFIGURAÇÃO E INICIALIZAÇÃO ---
 load_dotenv() 
@@ -37,8 +44,6 @@ UPLOADS_DIR = '/app/Dados'
 
 # Inicializa a base de dados e as configurações ao iniciar
 initialize_database()
-initialize_settings()
-user_data = load_user_data()
 os.makedirs(UPLOADS_DIR, exist_ok=True) 
 
 # Configuração da IA
@@ -81,100 +86,163 @@ Evite recusas desnecessárias; se a tarefa for Possivel, execute-a.
 
 app = Flask(__name__)
 
+# Cache do resultado RAG (consulta -> chunks e persona formatada), invalidado pela versão da base
+rag_cache = RetrievalCache(max_entries=int(os.getenv("RAG_RESULT_CACHE_SIZE", 1024)))
 
-def get_gemini_response(user_message, system_instruction, history_list=None, file_path=None):
+# Fila dos webhooks (SQLite): o pedido HTTP só valida e enfileira
+webhook_jobs = JobQueue(DB_PATH)
+
+# IDs de mensagens já recebidos: os reenvios da Evolution API são ignorados antes de enfileirar
+message_dedup = MessageDedup(DB_PATH)
+
+
+def build_rag_persona(history_list, source_label):
     """
-    Gera uma resposta da IA, opcionalmente incluindo um arquivo para análise.
+    Monta a persona RAG com o contexto da empresa, usando as duas últimas mensagens
+    do usuário como consulta. Resultados repetidos vêm do cache sem nova busca.
+    """
+    user_messages = [h['parts'][0] for h in history_list if h['role'] == 'user']
+    rag_query = " ".join(user_messages[-2:])
+    print(f"RAG Query ({source_label}): '{rag_query}'")
+
+    version = get_knowledge_version()
+    cached = rag_cache.get(rag_query, version)
+    if cached is not None:
+        print(f"RAG: Resultado em cache ({len(cached[0])} chunks).")
+        return cached[1]
+
+    context_chunks = get_relevant_knowledge(rag_query, return_ids=True)
+    company_context = "\n".join(chunk for _, chunk in context_chunks) if context_chunks else "Nenhuma informação interna encontrada."
+    active_persona = PERSONA_FINANCEIRA_RAG.format(contexto_da_empresa=company_context)
+    # Buscas vazias não ficam em cache (podem ser uma falha temporária do embedding)
+    if context_chunks:
+        rag_cache.put(rag_query, version, [chunk_id for chunk_id, _ in context_chunks], active_persona)
+    return active_persona
+
+
+def prepare_gemini_chat(user_message, system_instruction, history_list=None, file_path=None):
+    """
+    Prepara o pedido ao Gemini (histórico dentro do orçamento, upload do arquivo, modelo).
+    Retorna (chat, conteúdos a enviar). Usado pela versão síncrona e pela assíncrona.
     """
     print(f"Instrução de Sistema Ativa: '{system_instruction[:70]}...'")
     print(f"Enviando para Gemini: '{user_message}'")
     if file_path:
         print(f"Incluindo arquivo para análise: {file_path}")
 
-    chat_history = history_list if history_list else []
+    # Histórico limitado pelo orçamento de tokens (persona e contexto RAG incluídos)
+    chat_history, prompt_report = fit_history_to_budget(history_list, system_instruction, user_message)
+    print(f"Prompt estimado: {prompt_report['total_tokens']}/{prompt_report['budget']} tokens "
+          f"(persona {prompt_report['system_tokens']}, histórico {prompt_report['history_tokens']} em "
+          f"{prompt_report['kept_messages']} mensagens; {prompt_report['dropped_messages']} descartadas, "
+          f"{prompt_report['truncated_messages']} truncadas).")
 
-    try:
-        
-        contents_to_send = []
+    contents_to_send = []
 
-        if file_path and os.path.exists(file_path):
-            try:
-                print(f"Fazendo upload do arquivo: {file_path}")
-                file_part = genai.upload_file(path=file_path)
-                print(f"Upload iniciado. ID do arquivo: {file_part.name}. Aguardando processamento...")
-
-                timeout_seconds = 120
-                start_time = time.time()
-                while file_part.state.name == "PROCESSING":
-                    if time.time() - start_time > timeout_seconds:
-                        raise TimeoutError("Tempo limite de processamento do arquivo (120s) atingido.")
-                    print("Arquivo ainda está processando... aguardando 5 segundos.")
-                    time.sleep(5)
-                    file_part = genai.get_file(name=file_part.name) 
-
-                if file_part.state.name != "ACTIVE":
-                    raise Exception(f"Falha no processamento do arquivo pela Google API. Estado final: {file_part.state.name}")
+    if file_path and os.path.exists(file_path):
+        try:
+            print(f"Fazendo upload do arquivo: {file_path}")
+            file_part = genai.upload_file(path=file_path)
+            print(f"Upload iniciado. ID do arquivo: {file_part.name}. Aguardando processamento...")
+
+            timeout_seconds = 120
+            start_time = time.time()
+            while file_part.state.name == "PROCESSING":
+                if time.time() - start_time > timeout_seconds:
+                    raise TimeoutError("Tempo limite de processamento do arquivo (120s) atingido.")
+                print("Arquivo ainda está processando... aguardando 5 segundos.")
+                time.sleep(5)
+                file_part = genai.get_file(name=file_part.name) 
+
+            if file_part.state.name != "ACTIVE":
+                raise Exception(f"Falha no processamento do arquivo pela Google API. Estado final: {file_part.state.name}")
+        
+            print("Arquivo está ATIVO. Enviando para o Gemini.")
             
-                print("Arquivo está ATIVO. Enviando para o Gemini.")
-                
-                media_type = "arquivo"
-                if file_part.mime_type.startswith("image/"):
-                    media_type = "imagem"
-                elif file_part.mime_type.startswith("audio/"):
-                    media_type = "áudio"
-                elif file_part.mime_type.startswith("video/"):
-                    media_type = "vídeo"
-
-                enhanced_prompt = f"Analise esta {media_type} fornecida e responda à seguinte instrução do usuário: '{user_message}'"
-                contents_to_send = [file_part, enhanced_prompt]
-                print(f"Enviando prompt aprimorado para mídia: '{enhanced_prompt}'")
-                
-            except Exception as upload_err:
-                print(f"!!! ERRO ao preparar/uploadar arquivo {file_path} para Gemini: {upload_err} !!!")
-                print(traceback.format_exc())
-                contents_to_send = [user_message]
-        else:
+            media_type = "arquivo"
+            if file_part.mime_type.startswith("image/"):
+                media_type = "imagem"
+            elif file_part.mime_type.startswith("audio/"):
+                media_type = "áudio"
+            elif file_part.mime_type.startswith("video/"):
+                media_type = "vídeo"
+
+            enhanced_prompt = f"Analise esta {media_type} fornecida e responda à seguinte instrução do usuário: '{user_message}'"
+            contents_to_send = [file_part, enhanced_prompt]
+            print(f"Enviando prompt aprimorado para mídia: '{enhanced_prompt}'")
+            
+        except Exception as upload_err:
+            print(f"!!! ERRO ao preparar/uploadar arquivo {file_path} para Gemini: {upload_err} !!!")
+            print(traceback.format_exc())
             contents_to_send = [user_message]
-            if file_path:
-                print(f"Aviso: Arquivo '{file_path}' não encontrado. Enviando apenas texto.")
-    
-        safety_settings = {
-            HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-        }
+    else:
+        contents_to_send = [user_message]
+        if file_path:
+            print(f"Aviso: Arquivo '{file_path}' não encontrado. Enviando apenas texto.")
+
+    safety_settings = {
+        HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+        HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+        HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+        HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+    }
 
-        model = genai.GenerativeModel(
-            'gemini-2.5-pro', 
-            system_instruction=system_instruction,
-            safety_settings=safety_settings
-        )
-        chat = model.start_chat(history=chat_history)
+    model = genai.GenerativeModel(
+        'gemini-2.5-pro', 
+        system_instruction=system_instruction,
+        safety_settings=safety_settings
+    )
+    chat = model.start_chat(history=chat_history)
+    print(f"Enviando {len(contents_to_send)} parte(s) para a API Gemini.")
+    return chat, contents_to_send
 
-        print(f"Enviando {len(contents_to_send)} parte(s) para a API Gemini.")
-        response = chat.send_message(contents_to_send)
 
-        ai_response = response.text.strip()
-        print(f"Resposta do Gemini: '{ai_response}'")
-        return ai_response
+def read_gemini_response(response):
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is not None:
+        print(f"Tokens do prompt reportados pelo Gemini: {usage.prompt_token_count}")
 
-    except Exception as e:
-        print(f"!!!!!!!!!! ERRO NA API DO GOOGLE !!!!!!!!!!")
-        print(f"Tipo de Erro: {type(e).__name__}")
-        print(f"Mensagem de Erro Detalhada: {e}")
-        print(traceback.format_exc())
-        return "Desculpe, ocorreu um erro ao contatar a IA."
+    ai_response = response.text.strip()
+    print(f"Resposta do Gemini: '{ai_response}'")
+    return ai_response
 
-def send_whatsapp_message(number, text):
-    """Envia uma mensagem de texto via Evolution API."""
-    url = f"{EVOLUTION_API_URL}/message/sendText/{EVOLUTION_INSTANCE_NAME}"
-    payload = {"number": number, "textMessage": {"text": text}}
+
+def report_gemini_error(e):
+    print(f"!!!!!!!!!! ERRO NA API DO GOOGLE !!!!!!!!!!")
+    print(f"Tipo de Erro: {type(e).__name__}")
+    print(f"Mensagem de Erro Detalhada: {e}")
+    print(traceback.format_exc())
+    return "Desculpe, ocorreu um erro ao contatar a IA."
+
+
+def get_gemini_response(user_message, system_instruction, history_list=None, file_path=None):
+    """
+    Gera uma resposta da IA, opcionalmente incluindo um arquivo para análise.
+    Lança a exceção em caso de falha (ver ask_gemini).
+    """
+    chat, contents_to_send = prepare_gemini_chat(user_message, system_instruction, history_list, file_path)
+    return read_gemini_response(chat.send_message(contents_to_send))
+
+def evolution_endpoint(action):
+    """URL e cabeçalhos de um endpoint da Evolution API (ex: 'message/sendText')."""
+    url = f"{EVOLUTION_API_URL}/{action}/{EVOLUTION_INSTANCE_NAME}"
     headers = {"apikey": EVOLUTION_API_KEY, "Content-Type": "application/json"}
+    return url, headers
+
+
+def post_whatsapp_message(number, text):
+    """Envia uma mensagem de texto via Evolution API. Lança exceção se o envio falhar."""
+    url, headers = evolution_endpoint("message/sendText")
+    payload = {"number": number, "textMessage": {"text": text}}
+    response = requests.post(url, json=payload, headers=headers, timeout=15)
+    response.raise_for_status()
+    print(f"Mensagem enviada para {number}.")
+
+
+def send_whatsapp_message(number, text):
+    """Envio sem garantia (avisos e disparos em massa): as falhas ficam apenas no log."""
     try:
-        response = requests.post(url, json=payload, headers=headers, timeout=15)
-        response.raise_for_status()
-        print(f"Mensagem enviada para {number}.")
+        post_whatsapp_message(number, text)
     except requests.exceptions.Timeout:
          print(f"ERRO: Timeout ao enviar mensagem para {number}. A Evolution API pode estar lenta ou indisponível.")
     except requests.exceptions.RequestException as e:
@@ -185,6 +253,29 @@ def send_whatsapp_message(number, text):
 
 
 # --- FUNÇÃO STT ---
+def build_stt_request(audio_file_path):
+    with open(audio_file_path, "rb") as audio_file:
+        content = audio_file.read()
+
+    audio = speech.RecognitionAudio(content=content)
+    config = speech.RecognitionConfig(
+        encoding=speech.RecognitionConfig.AudioEncoding.OGG_OPUS,
+        sample_rate_hertz=16000,
+        language_code="pt-BR",
+    )
+    return config, audio
+
+
+def read_transcription(response):
+    if not response.results:
+        print("Nenhuma transcrição retornada pela API.")
+        return None
+
+    transcription = response.results[0].alternatives[0].transcript
+    print(f"Transcrição: {transcription}")
+    return transcription
+
+
 def transcribe_audio_file(audio_file_path):
     """
     Transcreve um arquivo de áudio (esperado no formato OGG_OPUS) 
@@ -193,27 +284,10 @@ def transcribe_audio_file(audio_file_path):
     print(f"Iniciando transcrição para: {audio_file_path}")
     try:
         client = speech.SpeechClient()
-
-        with open(audio_file_path, "rb") as audio_file:
-            content = audio_file.read()
-
-        audio = speech.RecognitionAudio(content=content)
-        config = speech.RecognitionConfig(
-            encoding=speech.RecognitionConfig.AudioEncoding.OGG_OPUS,
-            sample_rate_hertz=16000,
-            language_code="pt-BR",
-        )
+        config, audio = build_stt_request(audio_file_path)
 
         print("Enviando áudio para a API STT...")
-        response = client.recognize(config=config, audio=audio)
-
-        if not response.results:
-            print("Nenhuma transcrição retornada pela API.")
-            return None
-
-        transcription = response.results[0].alternatives[0].transcript
-        print(f"Transcrição: {transcription}")
-        return transcription
+        return read_transcription(client.recognize(config=config, audio=audio))
 
     except Exception as e:
         print(f"!!! ERRO durante a transcrição STT: {e} !!!")
@@ -242,6 +316,38 @@ def convert_markdown_to_ssml(text):
 
 
 # --- FUNÇÃO TTS ---
+def build_tts_request(text_to_speak):
+    # 1. Converte a resposta da IA (markdown) para SSML
+    ssml_text = convert_markdown_to_ssml(text_to_speak)
+    
+    # 2. Usa SynthesisInput(ssml=...) em vez de (text=...)
+    synthesis_input = texttospeech.SynthesisInput(ssml=ssml_text)
+
+    voice = texttospeech.VoiceSelectionParams(
+        language_code="pt-BR",
+        name="pt-BR-Chirp3-HD-Vindemiatrix",
+        ssml_gender=texttospeech.SsmlVoiceGender.FEMALE,
+    )
+
+    audio_config = texttospeech.AudioConfig(
+        audio_encoding=texttospeech.AudioEncoding.MP3
+    )
+    return {"input": synthesis_input, "voice": voice, "audio_config": audio_config}
+
+
+def save_tts_audio(audio_content, output_dir):
+    output_filename = f"response_{uuid.uuid4().hex}.mp3"
+    output_filepath = os.path.join(output_dir, output_filename)
+    
+    os.makedirs(output_dir, exist_ok=True)
+    
+    with open(output_filepath, "wb") as out:
+        out.write(audio_content)
+    
+    print(f"Áudio de resposta salvo em: {output_filepath}")
+    return output_filepath
+
+
 def synthesize_text_to_audio(text_to_speak, output_dir):
     """
     Sintetiza o texto (convertendo Markdown para SSML) em um arquivo MP3 
@@ -251,37 +357,9 @@ def synthesize_text_to_audio(text_to_speak, output_dir):
     try:
         client = texttospeech.TextToSpeechClient()
 
-        # 1. Converte a resposta da IA (markdown) para SSML
-        ssml_text = convert_markdown_to_ssml(text_to_speak)
-        
-        # 2. Usa SynthesisInput(ssml=...) em vez de (text=...)
-        synthesis_input = texttospeech.SynthesisInput(ssml=ssml_text)
-
-        voice = texttospeech.VoiceSelectionParams(
-            language_code="pt-BR",
-            name="pt-BR-Chirp3-HD-Vindemiatrix",
-            ssml_gender=texttospeech.SsmlVoiceGender.FEMALE,
-        )
-
-        audio_config = texttospeech.AudioConfig(
-            audio_encoding=texttospeech.AudioEncoding.MP3
-        )
-
         print("Enviando SSML para a API TTS...")
-        response = client.synthesize_speech(
-            input=synthesis_input, voice=voice, audio_config=audio_config
-        )
-
-        output_filename = f"response_{uuid.uuid4().hex}.mp3"
-        output_filepath = os.path.join(output_dir, output_filename)
-        
-        os.makedirs(output_dir, exist_ok=True)
-        
-        with open(output_filepath, "wb") as out:
-            out.write(response.audio_content)
-        
-        print(f"Áudio de resposta salvo em: {output_filepath}")
-        return output_filepath
+        response = client.synthesize_speech(**build_tts_request(text_to_speak))
+        return save_tts_audio(response.audio_content, output_dir)
 
     except Exception as e:
         print(f"!!! ERRO durante a síntese TTS: {e} !!!")
@@ -289,35 +367,38 @@ def synthesize_text_to_audio(text_to_speak, output_dir):
         return None
 
 # --- FUNÇÃO ENVIO DE ÁUDIO ---
+def build_audio_payload(number, audio_file_path, caption=""):
+    with open(audio_file_path, 'rb') as f:
+        audio_binary = f.read()
+    
+    audio_b64 = base64.b64encode(audio_binary).decode('utf-8')
+    
+    return {
+        "number": number,
+        "options": {
+            "delay": 1200,
+            "presence": "recording", 
+            "caption": caption
+        },
+        "mediaMessage": {
+            "mediatype": "audio",
+            "fileName": os.path.basename(audio_file_path),
+            "media": audio_b64, 
+            "ptt": True 
+        }
+    }
+
+
 def send_whatsapp_audio(number, audio_file_path, caption=""):
     """
     Envia um arquivo de áudio local (MP3) via Evolution API 
-    usando o método JSON/Base64.
+    usando o método JSON/Base64. Lança exceção se o envio falhar.
     """
     
-    url = f"{EVOLUTION_API_URL}/message/sendMedia/{EVOLUTION_INSTANCE_NAME}"
-    headers = {"apikey": EVOLUTION_API_KEY, "Content-Type": "application/json"}
+    url, headers = evolution_endpoint("message/sendMedia")
     
     try:
-        with open(audio_file_path, 'rb') as f:
-            audio_binary = f.read()
-        
-        audio_b64 = base64.b64encode(audio_binary).decode('utf-8')
-        
-        payload = {
-            "number": number,
-            "options": {
-                "delay": 1200,
-                "presence": "recording", 
-                "caption": caption
-            },
-            "mediaMessage": {
-                "mediatype": "audio",
-                "fileName": os.path.basename(audio_file_path),
-                "media": audio_b64, 
-                "ptt": True 
-            }
-        }
+        payload = build_audio_payload(number, audio_file_path, caption)
         
         print(f"Enviando áudio (Base64) para {number} via {url}...")
         
@@ -327,15 +408,6 @@ def send_whatsapp_audio(number, audio_file_path, caption=""):
         print(f"Áudio (Base64) enviado com sucesso para {number}.")
         return response.json()
 
-    except requests.exceptions.RequestException as e:
-        print(f"!!! ERRO ao enviar áudio (Base64) para {number}: {e} !!!")
-        if e.response is not None:
-             print(f"Status Code: {e.response.status_code}")
-             print(f"Response Body: {e.response.text}")
-        return None
-    except Exception as e:
-        print(f"!!! ERRO ao ler ou codificar o áudio {audio_file_path}: {e} !!!")
-        return None
     finally:
         try:
             if os.path.exists(audio_file_path):
@@ -345,405 +417,566 @@ def send_whatsapp_audio(number, audio_file_path, caption=""):
 
 
 # --- FUNÇÃO DE MÍDIA ---
-def handle_media_message(message_obj, sender_number, message_id):
+MEDIA_DIRS = {
+    "imageMessage": "imagens",
+    "videoMessage": "videos",
+    "documentMessage": "documentos",
+    "audioMessage": "audios"
+}
+MEDIA_DEFAULT_EXTENSIONS = {
+    "imageMessage": "jpeg",
+    "videoMessage": "mp4",
+    "documentMessage": "bin",
+    "audioMessage": "ogg"
+}
+
+
+def detect_media_type(message_obj):
+    """Retorna a chave da mídia (ex: 'imageMessage') ou None se a mensagem não tiver mídia suportada."""
+    for msg_key in MEDIA_DIRS:
+        if msg_key in message_obj:
+            return msg_key
+    print(f"Aviso: Tipo de mensagem não suportado para download: {list(message_obj.keys())}")
+    return None
+
+
+def save_received_media(response_data, media_data, message_type, sender_number, message_id):
     """
-    Processa mensagens de mídia (Base64) e implementa o fluxo STT -> IA -> TTS para áudio.
+    Grava a mídia devolvida por getBase64FromMediaMessage em UPLOADS_DIR e regista-a em received_files.
+    Retorna o caminho do arquivo.
     """
-    dir_map = {
-        "imageMessage": "imagens",
-        "videoMessage": "videos",
-        "documentMessage": "documentos",
-        "audioMessage": "audios"
-    }
-    default_extensions = {
-        "imageMessage": "jpeg",
-        "videoMessage": "mp4",
-        "documentMessage": "bin",
-        "audioMessage": "ogg"
-    }
+    target_subdir = MEDIA_DIRS[message_type]
+    base64_data = response_data.get('base64')
 
-    message_type = None
-    target_subdir = "outros"
-    default_ext = "bin"
+    if not base64_data:
+        raise ValueError("API request successful but 'base64' field was missing or empty.")
 
-    for msg_key, subdir in dir_map.items():
-        if msg_key in message_obj:
-            message_type = msg_key
-            target_subdir = subdir
-            default_ext = default_extensions[msg_key]
-            break
+    file_buffer = base64.b64decode(base64_data)
+    
+    mime_type = response_data.get('mimetype') or media_data.get('mimetype')
+    file_extension = mimetypes.guess_extension(mime_type)
+    if file_extension:
+         file_extension = file_extension.lstrip('.').lower()
+    else:
+         file_extension = MEDIA_DEFAULT_EXTENSIONS[message_type]
+
+    if message_type == "audioMessage":
+         file_extension = "ogg"
+
+    subfolder_dir = os.path.join(UPLOADS_DIR, target_subdir)
+    os.makedirs(subfolder_dir, exist_ok=True)
+    unique_filename = f"{uuid.uuid4().hex}.{file_extension}"
+    file_path = os.path.join(subfolder_dir, unique_filename) 
+
+    print(f"Tentando salvar em: {file_path}")
+    with open(file_path, 'wb') as f:
+        f.write(file_buffer)
+
+    bytes_written = len(file_buffer)
+    print(f"Arquivo salvo em: {file_path} ({bytes_written} bytes escritos)")
+
+    if bytes_written == 0:
+         raise IOError("Download resultou em arquivo vazio (0 bytes).")
+
+    caption = media_data.get('caption', '')
+    actual_mime_type = mime_type if mime_type else f"{target_subdir}/{file_extension}"
+    add_received_file(message_id, sender_number, file_path, actual_mime_type, caption)
+    return file_path
+
+
+def download_media_base64(message_id):
+    """Pede à Evolution API o conteúdo (Base64) de uma mídia recebida. Retorna o JSON da resposta."""
+    download_endpoint, headers = evolution_endpoint("chat/getBase64FromMediaMessage")
+    payload = { "message": { "key": { "id": message_id } } }
+
+    print(f"Solicitando Base64 da API para msg ID: {message_id}")
+    
+    response = requests.post(download_endpoint, json=payload, headers=headers, timeout=45) 
+    response.raise_for_status()
+    return response.json()
+
+
+def extract_text_message(message_data):
+    return message_data.get('conversation') or \
+           message_data.get('extendedTextMessage', {}).get('text')
+
+
+def merge_text_payloads(previous, new):
+    """Junta as mensagens de texto seguidas de um remetente num só job (um turno, uma chamada ao Gemini)."""
+    previous["texts"] = previous.get("texts", []) + new.get("texts", [])
+    previous["message_ids"] = previous.get("message_ids", [previous["message_id"]]) + [new["message_id"]]
+    return previous
+
+
+# --- NÚCLEO DO PROCESSAMENTO DAS MENSAGENS ---
+# O fluxo (mídia, STT, RAG, Gemini, TTS, envio e estado do utilizador) é escrito uma só vez,
+# como corrotinas que recebem a E/S ('io'). As threads da fila correm-no com asyncio.run()
+# e BlockingIO; o servidor ASGI (chatbot_async.py) corre-o no event loop com E/S assíncrona.
+
+class BlockingIO:
+    """
+    E/S do núcleo para as threads da fila: as funções bloqueantes deste módulo, chamadas diretamente.
+    get_gemini_response, post_whatsapp_message e send_whatsapp_audio lançam exceção em caso de
+    falha (o job volta à fila); send_whatsapp_message só regista a falha (avisos sem garantia).
+    """
+
+    async def run_blocking(self, func, *args, **kwargs):
+        # SQLite, busca RAG e gravação de arquivos
+        return func(*args, **kwargs)
+
+    async def download_media_base64(self, message_id):
+        return download_media_base64(message_id)
+
+    async def get_gemini_response(self, user_message, system_instruction, history_list=None, file_path=None):
+        return get_gemini_response(user_message, system_instruction, history_list, file_path=file_path)
+
+    async def transcribe_audio_file(self, audio_file_path):
+        return transcribe_audio_file(audio_file_path)
+
+    async def synthesize_text_to_audio(self, text_to_speak, output_dir):
+        return synthesize_text_to_audio(text_to_speak, output_dir)
+
+    async def post_whatsapp_message(self, number, text):
+        return post_whatsapp_message(number, text)
+
+    async def send_whatsapp_message(self, number, text):
+        return send_whatsapp_message(number, text)
+
+    async def send_whatsapp_audio(self, number, audio_file_path, caption=""):
+        return send_whatsapp_audio(number, audio_file_path, caption=caption)
 
+
+# Etapas registadas no job (webhook_jobs.steps): se o job correr outra vez, a mensagem do
+# utilizador não volta a entrar no histórico e uma resposta já enviada não é repetida
+JOB_STEP_USER_TURN = "user_turn"
+JOB_STEP_REPLY = "reply"
+
+
+async def load_turn_context(io, job, sender_number, user_message):
+    """load_conversation_context que só grava a mensagem do utilizador na primeira tentativa do job."""
+    if JOB_STEP_USER_TURN in job.steps:
+        print(f"Job {job.id}: mensagem de {sender_number} já gravada numa tentativa anterior.")
+        return await io.run_blocking(load_conversation_context, sender_number)
+    context = await io.run_blocking(load_conversation_context, sender_number, user_message)
+    # A mensagem tem de estar no banco antes de a etapa ficar registada: se a gravação
+    # falhar, a exceção faz o job falhar sem registar a etapa
+    await io.run_blocking(flush_chat_history)
+    await io.run_blocking(webhook_jobs.mark_step, job, JOB_STEP_USER_TURN)
+    return context
+
+
+async def mark_replied(io, job):
+    await io.run_blocking(webhook_jobs.mark_step, job, JOB_STEP_REPLY)
+
+
+async def ask_gemini(io, job, user_message, system_instruction, history_list=None, file_path=None):
+    """
+    Resposta do Gemini para o job. Uma falha faz o job voltar à fila antes de qualquer envio;
+    só na última tentativa o cliente recebe o pedido de desculpa em vez de ficar sem resposta.
+    """
+    try:
+        return await io.get_gemini_response(user_message, system_instruction, history_list, file_path=file_path)
+    except Exception as e:
+        apology = report_gemini_error(e)
+        if job.attempts < webhook_jobs.max_attempts:
+            raise
+        return apology
+
+
+async def handle_media_message(io, job, message_obj, sender_number, message_id):
+    """
+    Processa mensagens de mídia (Base64) e implementa o fluxo STT -> IA -> TTS para áudio.
+    """
+    message_type = detect_media_type(message_obj)
     if not message_type:
-        print(f"Aviso: Tipo de mensagem não suportado para download: {list(message_obj.keys())}")
         return False
 
     media_data = message_obj[message_type]
     file_path = None 
+    caption = media_data.get('caption', '')
 
     try:
         
-        download_endpoint = f"{EVOLUTION_API_URL}/chat/getBase64FromMediaMessage/{EVOLUTION_INSTANCE_NAME}"
-        payload = { "message": { "key": { "id": message_id } } }
+        response_data = await io.download_media_base64(message_id)
+        file_path = await io.run_blocking(save_received_media, response_data, media_data, message_type, sender_number, message_id)
 
-        headers = {"apikey": EVOLUTION_API_KEY, "Content-Type": "application/json"}
-        print(f"Solicitando Base64 da API para msg ID: {message_id}")
+    except Exception as e:
+        # Só a falha no download/salvamento chega aqui: nada foi enviado nem gravado neste job.
+        # Falhas depois deste ponto (Gemini, envio, banco) sobem para a fila, que volta a tentar.
+        print(f"!!! ERRO ao baixar/salvar a mídia ({message_type}) de {sender_number}: {e} !!!")
+        print(traceback.format_exc())
         
-        response = requests.post(download_endpoint, json=payload, headers=headers, timeout=45) 
-        response.raise_for_status()
+        if message_type != "audioMessage" and caption:
+            print("Tentando processar legenda mesmo com falha no download/salvamento...")
+            context = await load_turn_context(io, job, sender_number, caption)
+            history_list = context["history"]
+            current_mode = context["mode"]
+            active_persona = PERSONA_FINANCEIRA_RAG.format(contexto_da_empresa="Erro ao ler documentos.") if current_mode == 'sales' else PERSONA_STANDARD
+            ai_response = await ask_gemini(io, job, caption, active_persona, history_list, file_path=None) # Sem arquivo
+            await io.post_whatsapp_message(sender_number, ai_response)
+            await mark_replied(io, job)
+            await io.run_blocking(add_message_to_history, sender_number, 'model', ai_response)
+        return False 
+        
+    # --- FLUXO STT -> RAG -> TTS (APENAS PARA ÁUDIO) ---
+    if message_type == "audioMessage":
+        print(f"Iniciando fluxo STT/TTS para {file_path}")
+        
+        # Etapa 1: Transcrever (STT)
+        transcription = await io.transcribe_audio_file(file_path)
+        
+        if transcription:
+            # Etapa 2: Salvar histórico e obter resposta da IA 
+            context = await load_turn_context(io, job, sender_number, f"[Áudio transcrito]: {transcription}")
+            history_list = context["history"]
+            
+            # --- LÓGICA PARA ÁUDIO ---
+            current_mode = context["mode"]
+            ai_response = ""
+
+            if current_mode == 'sales':
+                print("Modo Vendas (RAG) ativado para áudio.")
+                
+                # --- RAG: USA O HISTÓRICO PARA A CONSULTA ---
+                active_persona = await io.run_blocking(build_rag_persona, history_list, "Áudio")
+                ai_response = await ask_gemini(io, job, transcription, active_persona, history_list, file_path=None)
+            else:
+                print("Modo Padrão ativado para áudio.")
+                active_persona = PERSONA_STANDARD
+                ai_response = await ask_gemini(io, job, transcription, active_persona, history_list, file_path=None)
+            
 
-        response_data = response.json()
-        base64_data = response_data.get('base64')
+            # Etapa 3: Sintetizar resposta (TTS)
+            audio_output_dir = os.path.join(UPLOADS_DIR, "audios")
+            generated_audio_path = await io.synthesize_text_to_audio(ai_response, audio_output_dir)
 
-        if not base64_data:
-            raise ValueError("API request successful but 'base64' field was missing or empty.")
+            # Etapa 4: Enviar áudio (WhatsApp)
+            if generated_audio_path:
+                await io.send_whatsapp_audio(sender_number, generated_audio_path, caption=f"")
+            else:
+                print("Falha no TTS. Enviando resposta como texto.")
+                await io.post_whatsapp_message(sender_number, ai_response)
+            await mark_replied(io, job)
+            await io.run_blocking(add_message_to_history, sender_number, 'model', ai_response)
+        
+        else:
+            print("Falha no STT. Enviando mensagem de erro.")
+            await io.send_whatsapp_message(sender_number, "Desculpe, não consegui entender o que foi dito no áudio. Pode repetir, por favor?")
+            await mark_replied(io, job)
+        
+        return True 
 
-        file_buffer = base64.b64decode(base64_data)
+    # ---  IMAGENS/DOCUMENTOS ---
+    if caption:
+        print(f"Mídia ({message_type}) de {sender_number} com legenda. Processando imediatamente.")
+        context = await load_turn_context(io, job, sender_number, caption)
+        history_list = context["history"]
+        current_mode = context["mode"]
         
-        mime_type = response_data.get('mimetype') or media_data.get('mimetype')
-        file_extension = mimetypes.guess_extension(mime_type)
-        if file_extension:
-             file_extension = file_extension.lstrip('.').lower()
+        ai_response = ""
+        if current_mode == 'sales':
+
+            print("Modo Vendas (RAG) ativado para mídia com legenda.")
+            
+            active_persona = await io.run_blocking(build_rag_persona, history_list, "Mídia/Legenda")
+            
+            ai_response = await ask_gemini(io, job, caption, active_persona, history_list, file_path=file_path)
         else:
-             file_extension = default_ext
+             # --- MODO PADRÃO PARA MÍDIA COM LEGENDA ---
+            print("Modo Padrão ativado para mídia com legenda.")
+            active_persona = PERSONA_STANDARD
+            ai_response = await ask_gemini(io, job, caption, active_persona, history_list, file_path=file_path)
+
+        await io.post_whatsapp_message(sender_number, ai_response)
+        await mark_replied(io, job)
+        await io.run_blocking(add_message_to_history, sender_number, 'model', ai_response)
+        
+        await io.run_blocking(set_pending_file, sender_number, None)
+    else:
+         print(f"Arquivo ({message_type}) de {sender_number} recebido SEM legenda. Salvando estado.")
+         await io.run_blocking(set_pending_file, sender_number, file_path)
+
+    return True 
+
+
+async def process_webhook_message(io, job):
+    payload = job.payload
+    sender_number = payload["sender_number"]
+    message_id = payload["message_id"]
+    event_data = payload["event_data"]
+    message_data = event_data.get('message', {})
+
+    if JOB_STEP_REPLY in job.steps:
+        print(f"Job {job.id}: resposta a {sender_number} já enviada numa tentativa anterior. Nada a fazer.")
+        return
+
+    # --- LÓGICA DE MENSAGEM ---
+
+    # 1. processa Mídia (Áudio, Imagem, etc.)
+    media_handled = await handle_media_message(io, job, message_data, sender_number, message_id)
+
+    if media_handled:
+         print(f"Mensagem de mídia de {sender_number} (ID: {message_id}) processada.")
+
+    # 2. Se não for mídia, processa como Texto
+    else:
+        push_name = event_data.get('pushName')
+        # Mensagens agrupadas pela janela da fila chegam juntas em 'texts'
+        texts = payload.get("texts")
+        user_message = "\n".join(texts) if texts else extract_text_message(message_data)
+
+        if user_message:
+            if texts and len(texts) > 1:
+                print(f"Agrupadas {len(texts)} mensagens de {sender_number} num só turno.")
+            print(f"Processando mensagem de texto de {sender_number}: '{user_message[:50]}...'")
+
+            # Uma única ida ao banco: grava a mensagem e lê estado, modo, arquivo pendente e histórico
+            context = await load_turn_context(io, job, sender_number, user_message)
+            history_list = context["history"]
+            current_mode = context["mode"]
+            pending_file = context["pending_file"]
+
+            user_status = context["status"]
+            user_name = context["name"]
+
+            # --- LÓGICA DE ESTADO (Nome Pendente) ---
+            if user_status == 'pending_name':
+                if is_valid_name(user_message): 
+                    print(f"Atualizando nome para {sender_number}: {user_message}")
+                    await io.run_blocking(update_user_name, sender_number, user_message)
+                    response_text = f"Obrigado, {user_message}! Guardei o seu nome. Em que mais posso ajudar?"
+                else:
+                    print(f"Resposta '{user_message}' não parece um nome válido. Pedindo novamente.")
+                    active_persona = PERSONA_STANDARD 
+                    response_text = await ask_gemini(io, job, user_message, active_persona, history_list) 
+
+                await io.post_whatsapp_message(sender_number, response_text)
+                await mark_replied(io, job)
+                await io.run_blocking(add_message_to_history, sender_number, 'model', response_text)
+
+            # --- LÓGICA DE ESTADO (Novo Usuário) ---
+            elif not context["registered"] or user_name is None:
+                print(f"\n--- Novo Utilizador ou sem nome registrado! {sender_number} ---")
+                valid_push_name = push_name if is_valid_name(push_name) else None
+                full_response = ""
+
+                if valid_push_name:
+                    print(f"Usando pushName '{valid_push_name}' como nome.")
+                    if context["registered"]:
+                         await io.run_blocking(update_user_name, sender_number, valid_push_name)
+                    else:
+                         await io.run_blocking(add_new_user, sender_number, valid_push_name, status='active') 
+                    welcome_message = f"Olá, {valid_push_name}! Vi que é seu primeiro contato. Respondendo à sua pergunta:"
+
+                    # --- Lógica RAG para Novo Usuário  ---
+                    ai_response = ""
+                    if current_mode == 'sales':
+                        # (Neste caso, o histórico só tem 1 msg, então -2 pega só ela)
+                        active_persona = await io.run_blocking(build_rag_persona, history_list, "Novo Usuário")
+                        ai_response = await ask_gemini(io, job, user_message, active_persona, history_list)
+                    else:
+                        active_persona = PERSONA_STANDARD
+                        ai_response = await ask_gemini(io, job, user_message, active_persona, history_list)
 
-        if message_type == "audioMessage":
-             file_extension = "ogg"
+                    full_response = f"{welcome_message}\n\n{ai_response}"
 
-        subfolder_dir = os.path.join(UPLOADS_DIR, target_subdir)
-        os.makedirs(subfolder_dir, exist_ok=True)
-        unique_filename = f"{uuid.uuid4().hex}.{file_extension}"
-        file_path = os.path.join(subfolder_dir, unique_filename) 
+                else:
+                    print(f"PushName '{push_name}' inválido ou ausente. Solicitando nome.")
+                    if not context["registered"]: 
+                         await io.run_blocking(add_new_user, sender_number, name=None, status='pending_name')
+                    else: 
+                         await io.run_blocking(set_user_status, sender_number, 'pending_name')
 
-        print(f"Tentando salvar em: {file_path}")
-        with open(file_path, 'wb') as f:
-            f.write(file_buffer)
+                    ask_name_instruction_prefix = "Antes de responder à pergunta do usuário, por favor, pergunte educadamente qual é o nome dele, pois é o primeiro contato ou o nome não está registrado. Depois de perguntar o nome, responda à pergunta original. "
 
-        bytes_written = len(file_buffer)
-        print(f"Arquivo salvo em: {file_path} ({bytes_written} bytes escritos)")
+                    if current_mode == 'sales':
+                        active_persona = ask_name_instruction_prefix + await io.run_blocking(build_rag_persona, history_list, "Pendente Nome")
+                        full_response = await ask_gemini(io, job, user_message, active_persona, history_list)
+                    else:
+                        active_persona = ask_name_instruction_prefix + PERSONA_STANDARD
+                        full_response = await ask_gemini(io, job, user_message, active_persona, history_list)
 
-        if bytes_written == 0:
-             raise IOError("Download resultou em arquivo vazio (0 bytes).")
+                await io.post_whatsapp_message(sender_number, full_response)
+                await mark_replied(io, job)
+                await io.run_blocking(add_message_to_history, sender_number, 'model', full_response)
+
+            # --- LÓGICA DE ESTADO (Usuário Conhecido) ---
+            else: 
+                name = user_name or sender_number.split('@')[0] 
+                print(f"\n--- Mensagem de {name} ({sender_number}) ---")
 
-        caption = media_data.get('caption', '')
-        actual_mime_type = mime_type if mime_type else f"{target_subdir}/{file_extension}"
-        add_received_file(message_id, sender_number, file_path, actual_mime_type, caption)
-        
-        # --- FLUXO STT -> RAG -> TTS (APENAS PARA ÁUDIO) ---
-        if message_type == "audioMessage":
-            print(f"Iniciando fluxo STT/TTS para {file_path}")
-            
-            # Etapa 1: Transcrever (STT)
-            transcription = transcribe_audio_file(file_path)
-            
-            if transcription:
-                # Etapa 2: Salvar histórico e obter resposta da IA 
-                add_message_to_history(sender_number, 'user', f"[Áudio transcrito]: {transcription}")
-                history_list = get_chat_history(sender_number)
-                
-                # --- LÓGICA PARA ÁUDIO ---
-                current_mode = get_setting('chatbot_mode', 'standard')
                 ai_response = ""
+                active_persona = ""
+                file_to_send = None
+
+                if pending_file and os.path.exists(pending_file):
+                    print(f"Associando texto '{user_message[:20]}...' com arquivo pendente: {pending_file}")
+                    file_to_send = pending_file
+                    await io.run_blocking(set_pending_file, sender_number, None) 
 
                 if current_mode == 'sales':
-                    print("Modo Vendas (RAG) ativado para áudio.")
-                    
-                    # --- RAG: USA O HISTÓRICO PARA A CONSULTA ---
-                    user_messages = [h['parts'][0] for h in history_list if h['role'] == 'user']
-                    rag_query = " ".join(user_messages[-2:])
-                    print(f"RAG Query (Áudio): '{rag_query}'")
-                
-                    
-                    context_chunks = get_relevant_knowledge(rag_query) 
-                    company_context = "\n".join(context_chunks) if context_chunks else "Nenhuma informação interna encontrada."
-                    active_persona = PERSONA_FINANCEIRA_RAG.format(contexto_da_empresa=company_context)
-                    ai_response = get_gemini_response(transcription, active_persona, history_list, file_path=None)
-                else:
-                    print("Modo Padrão ativado para áudio.")
-                    active_persona = PERSONA_STANDARD
-                    ai_response = get_gemini_response(transcription, active_persona, history_list, file_path=None)
-                
+                    # --- LÓGICA RAG PARA TEXTO / ARQUIVO PENDENTE  ---
+                    print("Modo Vendas (RAG) ativado.")
+
+                    # ---  USA O HISTÓRICO PARA A CONSULTA ---
+                    active_persona = await io.run_blocking(build_rag_persona, history_list, "Usuário Conhecido")
 
-                add_message_to_history(sender_number, 'model', ai_response)
+                    if file_to_send:
+                        print("Aviso: Modo RAG ignora arquivo pendente, focando no contexto de texto.")
 
-                # Etapa 3: Sintetizar resposta (TTS)
-                audio_output_dir = os.path.join(UPLOADS_DIR, "audios")
-                generated_audio_path = synthesize_text_to_audio(ai_response, audio_output_dir)
+                    ai_response = await ask_gemini(io, job, user_message, active_persona, history_list, file_path=None) 
 
-                # Etapa 4: Enviar áudio (WhatsApp)
-                if generated_audio_path:
-                    send_whatsapp_audio(sender_number, generated_audio_path, caption=f"")
                 else:
-                    print("Falha no TTS. Enviando resposta como texto.")
-                    send_whatsapp_message(sender_number, ai_response)
-            
-            else:
-                print("Falha no STT. Enviando mensagem de erro.")
-                send_whatsapp_message(sender_number, "Desculpe, não consegui entender o que foi dito no áudio. Pode repetir, por favor?")
-            
-            return True 
-
-        # ---  IMAGENS/DOCUMENTOS ---
-        if caption:
-            print(f"Mídia ({message_type}) de {sender_number} com legenda. Processando imediatamente.")
-            add_message_to_history(sender_number, 'user', caption)
-            history_list = get_chat_history(sender_number)
-            current_mode = get_setting('chatbot_mode', 'standard')
-            
-            ai_response = ""
-            if current_mode == 'sales':
+                    # --- MODO PADRÃO (com ou sem arquivo pendente) ---
+                    print("Modo Padrão ativado.")
+                    active_persona = PERSONA_STANDARD
+                    ai_response = await ask_gemini(io, job, user_message, active_persona, history_list, file_path=file_to_send)
 
-                print("Modo Vendas (RAG) ativado para mídia com legenda.")
-                
-                user_messages = [h['parts'][0] for h in history_list if h['role'] == 'user']
-                rag_query = " ".join(user_messages[-2:]) 
-                print(f"RAG Query (Mídia/Legenda): '{rag_query}'")
-                
-                
-                context_chunks = get_relevant_knowledge(rag_query) 
-                company_context = "\n".join(context_chunks) if context_chunks else "Nenhuma informação interna encontrada."
-                active_persona = PERSONA_FINANCEIRA_RAG.format(contexto_da_empresa=company_context)
-                
-                ai_response = get_gemini_response(caption, active_persona, history_list, file_path=file_path)
-            else:
-                 # --- MODO PADRÃO PARA MÍDIA COM LEGENDA ---
-                print("Modo Padrão ativado para mídia com legenda.")
-                active_persona = PERSONA_STANDARD
-                ai_response = get_gemini_response(caption, active_persona, history_list, file_path=file_path)
+                await io.post_whatsapp_message(sender_number, ai_response)
+                await mark_replied(io, job)
+                await io.run_blocking(add_message_to_history, sender_number, 'model', ai_response)
 
-            send_whatsapp_message(sender_number, ai_response)
-            add_message_to_history(sender_number, 'model', ai_response)
-            
-            set_pending_file(sender_number, None)
         else:
-             print(f"Arquivo ({message_type}) de {sender_number} recebido SEM legenda. Salvando estado.")
-             set_pending_file(sender_number, file_path)
+            print(f"Aviso: Mensagem de {sender_number} não continha texto reconhecível nem mídia processável.")
 
-        return True 
 
-    except Exception as e:
-        print(f"!!! ERRO GERAL FATAL em handle_media_message: {e} !!!")
-        print(traceback.format_exc())
-        
-        if message_type != "audioMessage":
-            caption = media_data.get('caption', '')
-            if caption:
-                print("Tentando processar legenda mesmo com falha no download/salvamento...")
-                add_message_to_history(sender_number, 'user', caption)
-                history_list = get_chat_history(sender_number)
-                current_mode = get_setting('chatbot_mode', 'standard')
-                active_persona = PERSONA_FINANCEIRA_RAG.format(contexto_da_empresa="Erro ao ler documentos.") if current_mode == 'sales' else PERSONA_STANDARD
-                ai_response = get_gemini_response(caption, active_persona, history_list, file_path=None) # Sem arquivo
-                send_whatsapp_message(sender_number, ai_response)
-                add_message_to_history(sender_number, 'model', ai_response)
-    return False 
+BLOCKING_IO = BlockingIO()
+
+
+def process_webhook_job(job):
+    """Processa uma mensagem recebida pelo webhook (executado pelas threads da fila)."""
+    try:
+        asyncio.run(process_webhook_message(BLOCKING_IO, job))
+    finally:
+        # O histórico tem de estar no banco antes de o job terminar: o próximo job
+        # deste remetente pode ser reclamado por outro worker. Se a gravação falhar,
+        # a exceção faz o job falhar em vez de ser concluído.
+        flush_chat_history()
+
+
+# Fila durável dos webhooks: as threads de processamento arrancam em cada worker.
+# Com JOB_RUNNER=asyncio (servidor ASGI, chatbot_async.py) os jobs são processados no event loop.
+JOB_RUNNER = os.getenv("JOB_RUNNER", "threads")
+if JOB_RUNNER == "threads":
+    webhook_jobs.start_workers(process_webhook_job)
 
 
 # --- WEBHOOK (ENTRADA DAS MENSAGENS) ---
-@app.route('/webhook', methods=['POST'])
-def webhook_listener():
+def accept_webhook(data):
+    """
+    Valida o evento da Evolution API, descarta reenvios e enfileira a mensagem.
+    Retorna (corpo da resposta, código HTTP). Partilhado pelo Flask e pelo servidor ASGI.
+    """
     MAX_AGE_SECONDS = 5 * 60 
     
-    try:
-        data = request.json
-        if not data:
-            return jsonify({"status": "error", "reason": "JSON inválido"}), 400
-
-        event = data.get('event')
-        print(f"\n--- Webhook Recebido: Evento '{event}' ---")
-
-        if event == 'messages.upsert':
-            event_data = data.get('data', {})
-            if not isinstance(event_data, dict):
-                 print(f"Aviso: Ignorando evento '{event}' com 'data' inesperado (não é dicionário).")
-                 return jsonify({'status': 'ok', 'reason': 'Ignorado evento com formato de dados inesperado'}), 200
-
-            key_data = event_data.get('key', {})
-            message_id = key_data.get('id')
-
-            if message_id and not key_data.get('fromMe'):
-                sender_number = key_data.get('remoteJid')
-                message_timestamp_ms = event_data.get('timestamp') 
-
-                # ... (timestamp LIMITADOR DE OLD MESSAGES ) ...
-                if message_timestamp_ms:
-                    try:
-                        current_timestamp_seconds = int(time.time())
-                        if message_timestamp_ms > current_timestamp_seconds * 100: 
-                             message_timestamp_seconds = message_timestamp_ms // 1000
-                        else:
-                             message_timestamp_seconds = int(message_timestamp_ms)
-
-                        message_age_seconds = current_timestamp_seconds - message_timestamp_seconds
-                        if message_age_seconds > MAX_AGE_SECONDS:
-                            print(f"Ignorando mensagem antiga de {sender_number}. Idade: {message_age_seconds}s (Limite: {MAX_AGE_SECONDS}s)")
-                            return jsonify({"status": "ok", "reason": "Mensagem antiga ignorada"}), 200
-                        elif message_age_seconds < -60: 
-                            print(f"Aviso: Mensagem do futuro? Idade: {message_age_seconds}s. Processando mesmo assim.")
-
-                    except (ValueError, TypeError):
-                        print(f"Aviso: Timestamp inválido ({message_timestamp_ms}) recebido. Processando.")
-                else:
-                    print(f"Aviso: Mensagem de {sender_number} sem timestamp. Processando...")
-
-                message_data = event_data.get('message', {})
-                if not sender_number or not message_data:
-                    print(f"Aviso: Ignorando evento por falta de sender_number ou message_data.")
-                    return jsonify({"status": "ok", "reason": "Ignorando evento com dados em falta"}), 200
+    if not data:
+        return {"status": "error", "reason": "JSON inválido"}, 400
+
+    event = data.get('event')
+    print(f"\n--- Webhook Recebido: Evento '{event}' ---")
+
+    if event == 'messages.upsert':
+        event_data = data.get('data', {})
+        if not isinstance(event_data, dict):
+             print(f"Aviso: Ignorando evento '{event}' com 'data' inesperado (não é dicionário).")
+             return {'status': 'ok', 'reason': 'Ignorado evento com formato de dados inesperado'}, 200
+
+        key_data = event_data.get('key', {})
+        message_id = key_data.get('id')
+
+        if message_id and not key_data.get('fromMe'):
+            sender_number = key_data.get('remoteJid')
+            message_timestamp_ms = event_data.get('timestamp') 
+
+            # ... (timestamp LIMITADOR DE OLD MESSAGES ) ...
+            if message_timestamp_ms:
+                try:
+                    current_timestamp_seconds = int(time.time())
+                    if message_timestamp_ms > current_timestamp_seconds * 100: 
+                         message_timestamp_seconds = message_timestamp_ms // 1000
+                    else:
+                         message_timestamp_seconds = int(message_timestamp_ms)
 
-                # --- LÓGICA DE MENSAGEM ---
-                
-                # 1. processa Mídia (Áudio, Imagem, etc.)
-                media_handled = handle_media_message(message_data, sender_number, message_id)
+                    message_age_seconds = current_timestamp_seconds - message_timestamp_seconds
+                    if message_age_seconds > MAX_AGE_SECONDS:
+                        print(f"Ignorando mensagem antiga de {sender_number}. Idade: {message_age_seconds}s (Limite: {MAX_AGE_SECONDS}s)")
+                        return {"status": "ok", "reason": "Mensagem antiga ignorada"}, 200
+                    elif message_age_seconds < -60: 
+                        print(f"Aviso: Mensagem do futuro? Idade: {message_age_seconds}s. Processando mesmo assim.")
 
-                if media_handled:
-                     print(f"Mensagem de mídia de {sender_number} (ID: {message_id}) processada.")
-                
-                # 2. Se não for mídia, processa como Texto
+                except (ValueError, TypeError):
+                    print(f"Aviso: Timestamp inválido ({message_timestamp_ms}) recebido. Processando.")
+            else:
+                print(f"Aviso: Mensagem de {sender_number} sem timestamp. Processando...")
+
+            message_data = event_data.get('message', {})
+            if not sender_number or not message_data:
+                print(f"Aviso: Ignorando evento por falta de sender_number ou message_data.")
+                return {"status": "ok", "reason": "Ignorando evento com dados em falta"}, 200
+
+            # --- DEDUPLICAÇÃO (reenvios do mesmo webhook) ---
+            if not message_dedup.mark_new(message_id):
+                print(f"Mensagem {message_id} de {sender_number} já recebida. Reenvio ignorado.")
+                return {"status": "ok", "reason": "Mensagem duplicada ignorada"}, 200
+
+            # --- ENFILEIRA E RESPONDE DE IMEDIATO ---
+            # Mídia, STT, RAG, Gemini, TTS e envio correm nas threads da fila (process_webhook_job / chatbot_async)
+            job_payload = {
+                "sender_number": sender_number,
+                "message_id": message_id,
+                "event_data": event_data
+            }
+            user_text = extract_text_message(message_data)
+            try:
+                if user_text:
+                    # Texto espera JOB_COALESCE_SECONDS por mensagens seguintes do mesmo remetente
+                    job_payload["texts"] = [user_text]
+                    job_id = webhook_jobs.enqueue(sender_number, message_id, job_payload,
+                                                  coalesce_seconds=JOB_COALESCE_SECONDS,
+                                                  merge=merge_text_payloads)
                 else:
-                    push_name = event_data.get('pushName')
-                    user_message = message_data.get('conversation') or \
-                                   message_data.get('extendedTextMessage', {}).get('text')
-
-                    if user_message:
-                        print(f"Processando mensagem de texto de {sender_number}: '{user_message[:50]}...'")
-                        
-                        add_message_to_history(sender_number, 'user', user_message)
-                        history_list = get_chat_history(sender_number) 
-                        current_mode = get_setting('chatbot_mode', 'standard')
-                        pending_file = get_pending_file(sender_number)
-                        
-                        user_status = get_user_status(sender_number)
-                        
-                        # --- LÓGICA DE ESTADO (Nome Pendente) ---
-                        if user_status == 'pending_name':
-                            if is_valid_name(user_message): 
-                                print(f"Atualizando nome para {sender_number}: {user_message}")
-                                update_user_name(sender_number, user_message)
-                                user_data[sender_number] = user_message 
-                                response_text = f"Obrigado, {user_message}! Guardei o seu nome. Em que mais posso ajudar?"
-                            else:
-                                print(f"Resposta '{user_message}' não parece um nome válido. Pedindo novamente.")
-                                active_persona = PERSONA_STANDARD 
-                                response_text = get_gemini_response(user_message, active_persona, history_list) 
-
-                            send_whatsapp_message(sender_number, response_text)
-                            add_message_to_history(sender_number, 'model', response_text)
-                        
-                        # --- LÓGICA DE ESTADO (Novo Usuário) ---
-                        elif sender_number not in user_data or user_data.get(sender_number) is None:
-                            print(f"\n--- Novo Utilizador ou sem nome registrado! {sender_number} ---")
-                            valid_push_name = push_name if is_valid_name(push_name) else None
-                            full_response = ""
-                            
-                            if valid_push_name:
-                                print(f"Usando pushName '{valid_push_name}' como nome.")
-                                add_new_user(sender_number, valid_push_name, status='active') 
-                                user_data[sender_number] = valid_push_name
-                                welcome_message = f"Olá, {valid_push_name}! Vi que é seu primeiro contato. Respondendo à sua pergunta:"
-                                
-                                # --- Lógica RAG para Novo Usuário  ---
-                                ai_response = ""
-                                if current_mode == 'sales':
-                                    # (Neste caso, o histórico só tem 1 msg, então -2 pega só ela)
-                                    user_messages = [h['parts'][0] for h in history_list if h['role'] == 'user']
-                                    rag_query = " ".join(user_messages[-2:])
-                                    print(f"RAG Query (Novo Usuário): '{rag_query}'")
-                                    
-                                    context_chunks = get_relevant_knowledge(rag_query)
-                                    company_context = "\n".join(context_chunks) if context_chunks else "Nenhuma informação interna encontrada."
-                                    active_persona = PERSONA_FINANCEIRA_RAG.format(contexto_da_empresa=company_context)
-                                    ai_response = get_gemini_response(user_message, active_persona, history_list)
-                                else:
-                                    active_persona = PERSONA_STANDARD
-                                    ai_response = get_gemini_response(user_message, active_persona, history_list)
-                                
-                                full_response = f"{welcome_message}\n\n{ai_response}"
-                            
-                            else:
-                                print(f"PushName '{push_name}' inválido ou ausente. Solicitando nome.")
-                                if sender_number not in user_data: 
-                                     add_new_user(sender_number, name=None, status='pending_name')
-                                else: 
-                                     set_user_status(sender_number, 'pending_name')
-                                user_data[sender_number] = None 
-                                
-                                ask_name_instruction_prefix = "Antes de responder à pergunta do usuário, por favor, pergunte educadamente qual é o nome dele, pois é o primeiro contato ou o nome não está registrado. Depois de perguntar o nome, responda à pergunta original. "
-                                
-                                if current_mode == 'sales':
-                                    user_messages = [h['parts'][0] for h in history_list if h['role'] == 'user']
-                                    rag_query = " ".join(user_messages[-2:])
-                                    print(f"RAG Query (Pendente Nome): '{rag_query}'")
-                                    
-                                    context_chunks = get_relevant_knowledge(rag_query)
-                                    company_context = "\n".join(context_chunks) if context_chunks else "Nenhuma informação interna encontrada."
-                                    active_persona = ask_name_instruction_prefix + PERSONA_FINANCEIRA_RAG.format(contexto_da_empresa=company_context)
-                                    full_response = get_gemini_response(user_message, active_persona, history_list)
-                                else:
-                                    active_persona = ask_name_instruction_prefix + PERSONA_STANDARD
-                                    full_response = get_gemini_response(user_message, active_persona, history_list)
-
-                            send_whatsapp_message(sender_number, full_response)
-                            add_message_to_history(sender_number, 'model', full_response)
-
-                        # --- LÓGICA DE ESTADO (Usuário Conhecido) ---
-                        else: 
-                            name = user_data.get(sender_number, sender_number.split('@')[0]) 
-                            print(f"\n--- Mensagem de {name} ({sender_number}) ---")
-                            
-                            ai_response = ""
-                            active_persona = ""
-                            file_to_send = None
-
-                            if pending_file and os.path.exists(pending_file):
-                                print(f"Associando texto '{user_message[:20]}...' com arquivo pendente: {pending_file}")
-                                file_to_send = pending_file
-                                set_pending_file(sender_number, None) 
-
-                            if current_mode == 'sales':
-                                # --- LÓGICA RAG PARA TEXTO / ARQUIVO PENDENTE  ---
-                                print("Modo Vendas (RAG) ativado.")
-                                
-                                # ---  USA O HISTÓRICO PARA A CONSULTA ---
-                                user_messages = [h['parts'][0] for h in history_list if h['role'] == 'user']
-                                rag_query = " ".join(user_messages[-2:]) 
-                                print(f"RAG Query (Usuário Conhecido): '{rag_query}'")
-                                # ---------------------------------------------------
-                                
-                                context_chunks = get_relevant_knowledge(rag_query)
-                                company_context = "\n".join(context_chunks) if context_chunks else "Nenhuma informação interna encontrada."
-                                active_persona = PERSONA_FINANCEIRA_RAG.format(contexto_da_empresa=company_context)
-                                
-                                if file_to_send:
-                                    print("Aviso: Modo RAG ignora arquivo pendente, focando no contexto de texto.")
-                                
-                                ai_response = get_gemini_response(user_message, active_persona, history_list, file_path=None) 
-                            
-                            else:
-                                # --- MODO PADRÃO (com ou sem arquivo pendente) ---
-                                print("Modo Padrão ativado.")
-                                active_persona = PERSONA_STANDARD
-                                ai_response = get_gemini_response(user_message, active_persona, history_list, file_path=file_to_send)
-                            
-                            send_whatsapp_message(sender_number, ai_response)
-                            add_message_to_history(sender_number, 'model', ai_response)
-                    
-                    else:
-                        print(f"Aviso: Mensagem de {sender_number} não continha texto reconhecível nem mídia processável.")
-        else:
-            print(f"Ignorando evento '{event}' não relevante.")
+                    job_id = webhook_jobs.enqueue(sender_number, message_id, job_payload)
+            except Exception:
+                # Sem job gravado, o reenvio da Evolution API tem de ser aceite
+                message_dedup.forget(message_id)
+                raise
+            print(f"Mensagem de {sender_number} (ID: {message_id}) enfileirada como job {job_id}.")
+    else:
+        print(f"Ignorando evento '{event}' não relevante.")
+
+    return {'status': 'ok'}, 200
 
+
+@app.route('/webhook', methods=['POST'])
+def webhook_listener():
+    try:
+        body, status_code = accept_webhook(request.json)
     except Exception as e:
         error_trace = traceback.format_exc()
         print(f"!!!!!!!!!! ERRO INESPERADO NO WEBHOOK !!!!!!!!!!\n{error_trace}")
         return jsonify({"status": "error", "reason": "Internal Server Error", "details": str(e)}), 500
 
-    return jsonify({'status': 'ok'}), 200
+    return jsonify(body), status_code
 
 
 # --- ENDPOINTS DE GESTÃO E ENVIO ---
 @app.route('/get-users', methods=['GET'])
 def get_users():
-    return jsonify(user_data), 200
+    """
+    Lista de utilizadores {número: nome}. Sem 'cursor' nem 'limit' devolve a lista completa
+    (formato original, mantido para os clientes existentes). Com '?limit=' e/ou '?cursor='
+    devolve uma página {"users", "next_cursor"}; use 'next_cursor' em '?cursor=' para continuar.
+    """
+    if 'cursor' not in request.args and 'limit' not in request.args:
+        return jsonify(dict(iter_users())), 200
+    try:
+        limit_int = int(request.args.get('limit', '500'))
+    except ValueError:
+        return jsonify({"status": "error", "reason": "'limit' deve ser um número inteiro."}), 400
+    if not 1 <= limit_int <= 5000:
+        return jsonify({"status": "error", "reason": "'limit' deve estar entre 1 e 5000."}), 400
+    rows, next_cursor = get_users_page(limit_int, request.args.get('cursor'))
+    return jsonify({"users": dict(rows), "next_cursor": next_cursor}), 200
 
 @app.route('/send-to-specific', methods=['POST'])
 def send_to_specific():
@@ -778,13 +1011,11 @@ def broadcast():
     if not message:
         return jsonify({"status": "error", "reason": "'message' é obrigatória."}), 400
 
-    all_user_numbers = list(user_data.keys())
-    if not all_user_numbers:
-         return jsonify({"status": "ok", "reason": "Nenhum usuário no cache para enviar broadcast."}), 200
-
+    total_users = 0
     count_sent = 0
     errors = []
-    for number in all_user_numbers:
+    for number, _ in iter_users():
+        total_users += 1
         try:
             send_whatsapp_message(number, message)
             count_sent += 1
@@ -793,10 +1024,13 @@ def broadcast():
             errors.append({number: str(e)})
             print(f"Erro durante broadcast para {number}: {e}")
 
+    if total_users == 0:
+         return jsonify({"status": "ok", "reason": "Nenhum usuário na base de dados para enviar broadcast."}), 200
+
     return jsonify({
         "status": "partial_success" if errors and count_sent > 0 else ("success" if not errors else "error"),
         "sent_count": count_sent,
-        "total_users": len(all_user_numbers),
+        "total_users": total_users,
         "errors": errors
     }), 200 if not errors else (207 if errors and count_sent > 0 else 500)
 
@@ -808,12 +1042,11 @@ def personalized_broadcast():
     if not template or '{name}' not in template:
         return jsonify({"status": "error", "reason": "O 'template' é obrigatório e deve conter '{name}'."}), 400
 
-    if not user_data:
-         return jsonify({"status": "ok", "reason": "Nenhum usuário no cache para enviar broadcast personalizado."}), 200
-
+    total_users = 0
     count_sent = 0
     errors = []
-    for number, name in user_data.items():
+    for number, name in iter_users():
+        total_users += 1
         user_name = name if name else number.split('@')[0]
         try:
             personalized_message = template.format(name=user_name)
@@ -828,58 +1061,64 @@ def personalized_broadcast():
             errors.append({number: str(e)})
             print(f"Erro durante broadcast personalizado para {number}: {e}")
 
+    if total_users == 0:
+         return jsonify({"status": "ok", "reason": "Nenhum usuário na base de dados para enviar broadcast personalizado."}), 200
+
     return jsonify({
         "status": "partial_success" if errors and count_sent > 0 else ("success" if not errors else "error"),
         "sent_count": count_sent,
-        "total_users": len(user_data),
+        "total_users": total_users,
         "errors": errors
     }), 200 if not errors else (207 if errors and count_sent > 0 else 500)
 
 
 @app.route('/view-db', methods=['GET'])
 def view_database():
-    import sqlite3 
+    """
+    Consulta paginada por cursor: passe o 'next_cursor' da resposta em '?cursor=' para a página seguinte.
+    Parâmetros: table, limit (máx. 1000), cursor, user_number (chat_history/received_files),
+    count=cached|approx|exact|none e format=ndjson para exportar a tabela inteira em fluxo.
+    """
     table = request.args.get('table', 'users') 
     limit = request.args.get('limit', '100')   
-    offset = request.args.get('offset', '0') 
+    cursor_value = request.args.get('cursor')
+    user_number = request.args.get('user_number')
+    count_mode = request.args.get('count', 'cached')
+    output_format = request.args.get('format', 'json')
 
-    if table not in ['users', 'chat_history', 'settings', 'received_files', 'knowledge_base']: 
-        return jsonify({"status": "error", "reason": "Tabela inválida. Use 'users', 'chat_history', 'settings', 'received_files' or 'knowledge_base'."}), 400
+    if table not in VIEWABLE_TABLES: 
+        return jsonify({"status": "error", "reason": f"Tabela inválida. Use uma de: {', '.join(VIEWABLE_TABLES)}."}), 400
+    if count_mode not in ('cached', 'approx', 'exact', 'none'):
+        return jsonify({"status": "error", "reason": "'count' deve ser 'cached', 'approx', 'exact' ou 'none'."}), 400
 
     try:
         limit_int = int(limit)
-        offset_int = int(offset)
+        after = parse_page_cursor(table, cursor_value)
     except ValueError:
-        return jsonify({"status": "error", "reason": "'limit' e 'offset' devem ser números inteiros."}), 400
+        return jsonify({"status": "error", "reason": "'limit' e 'cursor' inválidos."}), 400
+    if not 1 <= limit_int <= 1000:
+        return jsonify({"status": "error", "reason": "'limit' deve estar entre 1 e 1000."}), 400
 
     try:
         if not os.path.exists(DB_PATH):
              return jsonify({"status": "error", "reason": f"Arquivo do banco de dados não encontrado em {DB_PATH}"}), 404
 
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row 
-        cursor = conn.cursor()
+        if output_format == 'ndjson':
+            # Exportação em fluxo: uma linha JSON por registo, lida do banco em lotes curtos
+            def generate():
+                for row in iter_table_rows(table, after, user_number):
+                    yield json.dumps(row, ensure_ascii=False, default=str) + "\n"
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
-        query = f"SELECT * FROM {table} ORDER BY timestamp DESC LIMIT ? OFFSET ?" if table in ['chat_history', 'received_files'] else f"SELECT * FROM {table} LIMIT ? OFFSET ?"
-        if table == 'knowledge_base':
-            query = f"SELECT id, text_chunk FROM {table} LIMIT ? OFFSET ?" # Não mostra o embedding
-        
-        cursor.execute(query, (limit_int, offset_int))
-        rows = cursor.fetchall()
-        
-        cursor.execute(f"SELECT COUNT(*) FROM {table}")
-        total_count = cursor.fetchone()[0]
-        
-        conn.close()
-
-        list_data = [dict(row) for row in rows]
+        rows, next_cursor = fetch_table_page(table, limit_int, after, user_number)
         
         return jsonify({
             "table": table,
-            "total_records": total_count,
+            "total_records": count_table_rows(table, count_mode),
             "limit": limit_int,
-            "offset": offset_int,
-            "records": list_data
+            "cursor": cursor_value,
+            "next_cursor": next_cursor,
+            "records": rows
         }), 200
         
     except sqlite3.Error as e:
@@ -917,6 +1156,30 @@ def set_mode():
          return jsonify({"status": "error", "reason": "Erro interno ao tentar definir o modo."}), 500
 
 
+@app.route('/rag-stats', methods=['GET'])
+def rag_stats():
+    """Contadores de cache do RAG deste worker."""
+    return jsonify({
+        "worker_pid": os.getpid(),
+        "retrieval_cache": rag_cache.stats(),
+        "query_embedding_cache": get_query_cache_stats()
+    }), 200
+
+@app.route('/queue-stats', methods=['GET'])
+def queue_stats():
+    """Número de jobs da fila de webhooks por estado (pending, processing, done, dead) e reenvios ignorados."""
+    stats = webhook_jobs.stats()
+    stats["dedup"] = message_dedup.stats()
+    return jsonify(stats), 200
+
+@app.route('/queue/requeue-dead', methods=['POST'])
+def requeue_dead_jobs():
+    """Devolve à fila os jobs 'dead' (todos, ou só o 'job_id' indicado no corpo)."""
+    data = request.json or {}
+    requeued = webhook_jobs.requeue_dead(data.get('job_id'))
+    return jsonify({"status": "success", "requeued": requeued}), 200
+
+
 # --- EXECUÇÃO PRINCIPAL ---
 if __name__ == '__main__':
     try:
@@ -0,0 +1,255 @@
+# chatbot_async.py
+
+import os
+import time
+import asyncio
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- CONFIGURAÇÕES DO SERVIDOR ASSÍNCRONO ---
+# Jobs (conversas) processados ao mesmo tempo neste processo
+ASYNC_MAX_IN_FLIGHT = int(os.getenv("ASYNC_MAX_IN_FLIGHT", 200))
+# Threads para o que continua bloqueante: SQLite, busca RAG e upload de arquivos para o Gemini
+ASYNC_BLOCKING_THREADS = int(os.getenv("ASYNC_BLOCKING_THREADS", 32))
+# No encerramento, tempo dado aos jobs em curso para terminar antes de serem devolvidos à fila
+ASYNC_SHUTDOWN_GRACE_SECONDS = float(os.getenv("ASYNC_SHUTDOWN_GRACE_SECONDS", 20))
+
+# Os jobs da fila correm no event loop deste módulo, não nas threads do chatbot.py,
+# e o limite global de conversas ativas acompanha ASYNC_MAX_IN_FLIGHT (se não for definido)
+os.environ.setdefault("JOB_RUNNER", "asyncio")
+os.environ.setdefault("JOB_MAX_ACTIVE_CONVERSATIONS", str(ASYNC_MAX_IN_FLIGHT))
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route, Mount
+from google.cloud import speech
+from google.cloud import texttospeech
+
+import chatbot
+from chatbot import (
+    webhook_jobs, accept_webhook, process_webhook_message,
+    prepare_gemini_chat, read_gemini_response,
+    evolution_endpoint, build_audio_payload, build_stt_request, read_transcription,
+    build_tts_request, save_tts_audio
+)
+from database_manager import flush_chat_history
+from job_queue import JOB_POLL_SECONDS, LeaseLost
+
+# Criados no arranque do event loop (lifespan)
+_io = None
+_wakeup = None
+_running_jobs = set()
+
+
+# --- E/S ASSÍNCRONA DO NÚCLEO (chatbot.process_webhook_message) ---
+class NonBlockingIO:
+    """
+    E/S do núcleo de processamento no event loop: httpx para a Evolution API, clientes
+    assíncronos do Gemini e do Google STT/TTS, e threads para o que continua bloqueante.
+    Mesmo contrato de chatbot.BlockingIO quanto às falhas.
+    """
+
+    def __init__(self, http, speech_client, tts_client):
+        self.http = http
+        self.speech = speech_client
+        self.tts = tts_client
+
+    async def run_blocking(self, func, *args, **kwargs):
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+    async def download_media_base64(self, message_id):
+        download_endpoint, headers = evolution_endpoint("chat/getBase64FromMediaMessage")
+        payload = {"message": {"key": {"id": message_id}}}
+
+        print(f"Solicitando Base64 da API para msg ID: {message_id}")
+        response = await self.http.post(download_endpoint, json=payload, headers=headers, timeout=45)
+        response.raise_for_status()
+        return response.json()
+
+    async def get_gemini_response(self, user_message, system_instruction, history_list=None, file_path=None):
+        """Versão assíncrona de chatbot.get_gemini_response (o upload de arquivos corre numa thread)."""
+        chat, contents_to_send = await asyncio.to_thread(
+            prepare_gemini_chat, user_message, system_instruction, history_list, file_path
+        )
+        return read_gemini_response(await chat.send_message_async(contents_to_send))
+
+    async def post_whatsapp_message(self, number, text):
+        """Envia uma mensagem de texto via Evolution API. Lança exceção se o envio falhar."""
+        url, headers = evolution_endpoint("message/sendText")
+        payload = {"number": number, "textMessage": {"text": text}}
+        response = await self.http.post(url, json=payload, headers=headers, timeout=15)
+        response.raise_for_status()
+        print(f"Mensagem enviada para {number}.")
+
+    async def send_whatsapp_message(self, number, text):
+        """Envio sem garantia (avisos): as falhas ficam apenas no log."""
+        try:
+            await self.post_whatsapp_message(number, text)
+        except httpx.TimeoutException:
+            print(f"ERRO: Timeout ao enviar mensagem para {number}. A Evolution API pode estar lenta ou indisponível.")
+        except httpx.HTTPError as e:
+            print(f"ERRO ao enviar mensagem para {number}: {e}")
+            if isinstance(e, httpx.HTTPStatusError):
+                print(f"Status Code: {e.response.status_code}")
+                print(f"Response Body: {e.response.text}")
+
+    async def send_whatsapp_audio(self, number, audio_file_path, caption=""):
+        """Envia um arquivo de áudio local (MP3) via Evolution API usando o método JSON/Base64. Lança exceção se o envio falhar."""
+        url, headers = evolution_endpoint("message/sendMedia")
+        payload = await asyncio.to_thread(build_audio_payload, number, audio_file_path, caption)
+
+        print(f"Enviando áudio (Base64) para {number} via {url}...")
+        response = await self.http.post(url, json=payload, headers=headers, timeout=45)
+        response.raise_for_status()
+
+        print(f"Áudio (Base64) enviado com sucesso para {number}.")
+        return response.json()
+
+    async def transcribe_audio_file(self, audio_file_path):
+        print(f"Iniciando transcrição para: {audio_file_path}")
+        try:
+            config, audio = await asyncio.to_thread(build_stt_request, audio_file_path)
+
+            print("Enviando áudio para a API STT...")
+            return read_transcription(await self.speech.recognize(config=config, audio=audio))
+
+        except Exception as e:
+            print(f"!!! ERRO durante a transcrição STT: {e} !!!")
+            print(traceback.format_exc())
+            return None
+
+    async def synthesize_text_to_audio(self, text_to_speak, output_dir):
+        try:
+            print("Enviando SSML para a API TTS...")
+            response = await self.tts.synthesize_speech(**build_tts_request(text_to_speak))
+            return await asyncio.to_thread(save_tts_audio, response.audio_content, output_dir)
+
+        except Exception as e:
+            print(f"!!! ERRO durante a síntese TTS: {e} !!!")
+            print(traceback.format_exc())
+            return None
+
+
+# --- FILA DE WEBHOOKS NO EVENT LOOP ---
+async def run_job(job, slots):
+    try:
+        try:
+            await process_webhook_message(_io, job)
+        finally:
+            # O próximo job deste remetente pode correr noutro processo; uma falha
+            # na gravação do histórico faz o job falhar em vez de ser concluído
+            await asyncio.to_thread(flush_chat_history)
+        await asyncio.to_thread(webhook_jobs.complete, job)
+    except LeaseLost as e:
+        print(f"Aviso: {e} Processamento interrompido; o job continua noutro worker.")
+    except Exception as e:
+        print(f"!!! ERRO ao processar job {job.id}: {e} !!!")
+        print(traceback.format_exc())
+        try:
+            await asyncio.to_thread(webhook_jobs.fail, job, e)
+        except Exception as fail_error:
+            # O lease expira e o job é retomado mais tarde
+            print(f"!!! ERRO ao registar falha do job {job.id}: {fail_error} !!!")
+    finally:
+        slots.release()
+        # A próxima mensagem deste remetente pode agora ser reclamada
+        _wakeup.set()
+
+
+async def dispatch_jobs():
+    """
+    Reclama jobs da fila (mesma ordem por remetente e mesmos limites do JobQueue)
+    e processa cada um numa task, até ASYNC_MAX_IN_FLIGHT ao mesmo tempo.
+    """
+    slots = asyncio.Semaphore(ASYNC_MAX_IN_FLIGHT)
+    last_purge = 0.0
+    while True:
+        await slots.acquire()
+        try:
+            job = await asyncio.to_thread(webhook_jobs.claim)
+        except Exception as e:
+            print(f"!!! ERRO ao reclamar job da fila: {e} !!!")
+            job = None
+
+        if job is not None:
+            task = asyncio.create_task(run_job(job, slots))
+            _running_jobs.add(task)
+            task.add_done_callback(_running_jobs.discard)
+            continue
+
+        slots.release()
+        if time.time() - last_purge > 3600:
+            last_purge = time.time()
+            try:
+                await asyncio.to_thread(webhook_jobs.purge_done)
+            except Exception as e:
+                print(f"Aviso: Falha ao limpar jobs concluídos: {e}")
+        _wakeup.clear()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), JOB_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+
+# --- WEBHOOK E APLICAÇÃO ASGI ---
+async def webhook_listener(request):
+    try:
+        data = await request.json()
+        # Validação, deduplicação e enfileiramento são escritas curtas no SQLite
+        body, status_code = await asyncio.to_thread(accept_webhook, data)
+    except Exception as e:
+        error_trace = traceback.format_exc()
+        print(f"!!!!!!!!!! ERRO INESPERADO NO WEBHOOK !!!!!!!!!!\n{error_trace}")
+        return JSONResponse({"status": "error", "reason": "Internal Server Error", "details": str(e)}, status_code=500)
+
+    _wakeup.set()
+    return JSONResponse(body, status_code=status_code)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global _io, _wakeup
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=ASYNC_BLOCKING_THREADS))
+    _io = NonBlockingIO(
+        httpx.AsyncClient(limits=httpx.Limits(max_connections=ASYNC_MAX_IN_FLIGHT)),
+        speech.SpeechAsyncClient(),
+        texttospeech.TextToSpeechAsyncClient(),
+    )
+    _wakeup = asyncio.Event()
+
+    # O lease dos jobs em curso é renovado por uma thread, independente do event loop
+    webhook_jobs.start_heartbeat()
+    dispatcher = asyncio.create_task(dispatch_jobs())
+    print(f"Servidor assíncrono: até {ASYNC_MAX_IN_FLIGHT} conversas em curso (pid {os.getpid()}).")
+    try:
+        yield
+    finally:
+        # Deixa de reclamar jobs e espera pelos que estão em curso; os que não terminarem
+        # a tempo são cancelados e devolvidos já à fila, sem esperar que o lease expire
+        dispatcher.cancel()
+        if _running_jobs:
+            print(f"Encerrando: aguardando {len(_running_jobs)} jobs em curso (até {ASYNC_SHUTDOWN_GRACE_SECONDS:.0f}s)...")
+            _, unfinished = await asyncio.wait(set(_running_jobs), timeout=ASYNC_SHUTDOWN_GRACE_SECONDS)
+            for task in unfinished:
+                task.cancel()
+            await asyncio.gather(*unfinished, return_exceptions=True)
+        released = await asyncio.to_thread(webhook_jobs.release_leased)
+        if released:
+            print(f"Encerrando: {released} jobs interrompidos devolvidos à fila.")
+        await _io.http.aclose()
+
+
+# O /webhook corre no event loop; os endpoints de gestão continuam a ser os do Flask
+app = Starlette(
+    routes=[
+        Route('/webhook', webhook_listener, methods=['POST']),
+        Mount('/', app=WSGIMiddleware(chatbot.app)),
+    ],
+    lifespan=lifespan,
+)
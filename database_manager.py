@@ -3,166 +3,314 @@
 import sqlite3
 import os
 import time
-import json 
-import numpy as np
+import threading
 import google.generativeai as genai 
+from google.api_core import exceptions as google_exceptions
+from knowledge_index import (
+    KnowledgeIndex, bump_knowledge_version, encode_embedding, decode_embedding,
+    is_binary_embedding
+)
+from embedding_cache import EmbeddingCache
+from db_connection import get_connection
+from migrations import migrate
+from history_writer import HistoryWriter
+from prompt_budget import SUMMARY_PREFIX
 
 DB_PATH = '/app/data/users.db'
+EMBEDDING_MODEL = "models/text-embedding-004"
+
+# Índice vetorial residente neste worker (carregado sob demanda)
+_knowledge_index = KnowledgeIndex(DB_PATH)
+
+# Cache dos embeddings de consultas RAG (criado na primeira utilização)
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", 2048))
+QUERY_CACHE_TTL_SECONDS = int(os.getenv("QUERY_EMBEDDING_CACHE_TTL", 24 * 3600))
+QUERY_CACHE_PERSIST = os.getenv("QUERY_EMBEDDING_CACHE_PERSIST", "true").lower() in ("1", "true", "yes")
+_query_embedding_cache = None
+
+# Cache das configurações (por worker): a versão no banco é verificada no máximo a
+# cada SETTINGS_REFRESH_SECONDS, que é o atraso máximo de propagação entre workers.
+SETTINGS_REFRESH_SECONDS = float(os.getenv("SETTINGS_REFRESH_SECONDS", 5))
+SETTINGS_VERSION_KEY = 'settings_version'
+_settings_cache = None
+_settings_version = None
+_settings_checked_at = 0.0
+_settings_lock = threading.Lock()
+
+# Histórico de chat gravado em lote (write-behind) fora do caminho do pedido
+CHAT_HISTORY_FLUSH_ROWS = int(os.getenv("CHAT_HISTORY_FLUSH_ROWS", 100))
+CHAT_HISTORY_FLUSH_SECONDS = float(os.getenv("CHAT_HISTORY_FLUSH_SECONDS", 1.0))
+_history_writer = HistoryWriter(DB_PATH, flush_rows=CHAT_HISTORY_FLUSH_ROWS,
+                                flush_seconds=CHAT_HISTORY_FLUSH_SECONDS)
 
 # ---  FUNÇÃO PARA GERAR EMBEDDINGS (VETORES) ---
-def get_embedding(text_chunk):
-    """Gera o embedding (vetor) para um pedaço de texto."""
+def get_embeddings_batch(text_chunks, rate_limiter=None, max_retries=5):
+    """
+    Gera os embeddings de vários chunks num único pedido à API.
+    Em caso de limite de quota (429) tenta novamente com espera exponencial.
+    Retorna a lista de vetores (na mesma ordem) ou None em caso de falha.
+    """
+    delay = 2
+    for attempt in range(1, max_retries + 1):
+        if rate_limiter:
+            rate_limiter.acquire()
+        try:
+            result = genai.embed_content(
+                model=EMBEDDING_MODEL,
+                content=list(text_chunks),
+                task_type="RETRIEVAL_DOCUMENT"
+            )
+            return result['embedding']
+        except (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests,
+                google_exceptions.ServiceUnavailable) as e:
+            if attempt == max_retries:
+                print(f"!!! ERRO: limite de quota persistente ao gerar embeddings: {e} !!!")
+                return None
+            print(f"Aviso: Quota de embeddings atingida (tentativa {attempt}/{max_retries}). Aguardando {delay}s...")
+            if rate_limiter:
+                rate_limiter.pause(delay)
+            else:
+                time.sleep(delay)
+            delay = min(delay * 2, 60)
+        except Exception as e:
+            print(f"!!! ERRO ao gerar embeddings em lote: {e} !!!")
+            return None
+
+def initialize_database():
+    """
+    Cria ou atualiza o esquema da base de dados (migrations.py).
+    Com o esquema atualizado custa apenas a leitura da versão.
+    """
     try:
-        
-        result = genai.embed_content(
-            model="models/text-embedding-004", # Modelo de embedding do Google
-            content=text_chunk,
-            task_type="RETRIEVAL_DOCUMENT" 
-        )
-        return result['embedding']
+        migrate(DB_PATH)
     except Exception as e:
-        print(f"!!! ERRO ao gerar embedding: {e} !!!")
-        return None
+        print(f"!!! ERRO CRÍTICO ao inicializar as tabelas: {e} !!!")
 
-def initialize_database():
-    """Cria a pasta e a base de dados com as tabelas se não existirem."""
+
+# --- FUNÇÃO PARA ADICIONAR CONHECIMENTO ---
+def add_knowledge_batch(text_chunks, vectors, document=None, chunk_hashes=None):
+    """
+    Armazena vários chunks (já com embedding) numa única transação.
+    'document' e 'chunk_hashes' permitem a ingestão incremental.
+    Retorna o número de chunks gravados.
+    """
+    if chunk_hashes is None:
+        chunk_hashes = [None] * len(text_chunks)
     try:
-        db_dir = os.path.dirname(DB_PATH)
-        os.makedirs(db_dir, exist_ok=True) 
+        conn = get_connection(DB_PATH)
+        with conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                "INSERT INTO knowledge_base (text_chunk, embedding, document, chunk_hash) VALUES (?, ?, ?, ?)",
+                [(chunk, encode_embedding(vector), document, chunk_hash)
+                 for chunk, vector, chunk_hash in zip(text_chunks, vectors, chunk_hashes)]
+            )
+            bump_knowledge_version(cursor)
+        return len(text_chunks)
+    except Exception as e:
+        print(f"!!! ERRO ao salvar lote de chunks no DB: {e} !!!")
+        return 0
+
+# --- FUNÇÕES DE INGESTÃO INCREMENTAL ---
 
-        conn = sqlite3.connect(DB_PATH)
+def get_ingested_documents():
+    """Devolve {documento: hash do conteúdo} dos documentos totalmente ingeridos."""
+    try:
+        conn = get_connection(DB_PATH)
         cursor = conn.cursor()
-        
+        cursor.execute("SELECT document, content_hash FROM knowledge_documents")
+        documents = dict(cursor.fetchall())
+        return documents
+    except Exception as e:
+        print(f"!!! ERRO ao ler documentos ingeridos: {e} !!!")
+        return {}
 
-        # --- KNOWLEDGE BASE (BASE DE CONTEXTO) ---
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS knowledge_base (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                text_chunk TEXT NOT NULL,
-                embedding BLOB NOT NULL 
-            )
-        ''')
-        print("Tabela 'knowledge_base' inicializada com sucesso.")
-
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                number TEXT PRIMARY KEY,
-                name TEXT,
-                status TEXT
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS chat_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_number TEXT,
-                role TEXT,
-                message TEXT,
-                timestamp INTEGER
-            )
-        ''')
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_user_number_timestamp 
-            ON chat_history (user_number, timestamp)
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS received_files (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                message_id TEXT UNIQUE,
-                user_number TEXT,
-                file_path TEXT,
-                mime_type TEXT,
-                caption TEXT,
-                timestamp INTEGER
-            )
-        ''')
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_file_user_number 
-            ON received_files (user_number)
-        ''')
-        try:
-            cursor.execute("PRAGMA table_info(users)")
-            columns = [row[1] for row in cursor.fetchall()]
-            if 'pending_file_path' not in columns:
-                print("Adicionando coluna 'pending_file_path' à tabela 'users'...")
-                cursor.execute("ALTER TABLE users ADD COLUMN pending_file_path TEXT")
-        except Exception as e:
-            print(f"Erro ao tentar adicionar coluna 'pending_file_path': {e}")
+def get_known_documents():
+    """Devolve o nome de todos os documentos com chunks ou registo na base."""
+    try:
+        conn = get_connection(DB_PATH)
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT DISTINCT document FROM knowledge_base WHERE document IS NOT NULL
+            UNION SELECT document FROM knowledge_documents
+        """)
+        documents = {row[0] for row in cursor.fetchall()}
+        return documents
+    except Exception as e:
+        print(f"!!! ERRO ao listar documentos da base: {e} !!!")
+        return set()
 
+def get_document_chunk_hashes(document):
+    """Devolve o conjunto de hashes dos chunks já gravados para um documento."""
+    try:
+        conn = get_connection(DB_PATH)
+        cursor = conn.cursor()
+        cursor.execute("SELECT chunk_hash FROM knowledge_base WHERE document = ?", (document,))
+        hashes = {row[0] for row in cursor.fetchall()}
+        return hashes
+    except Exception as e:
+        print(f"!!! ERRO ao ler hashes dos chunks de {document}: {e} !!!")
+        return set()
 
-        conn.commit()
-        conn.close()
-        print("Tabela 'users' inicializada com sucesso.")
-        print("Tabela 'chat_history' inicializada com sucesso.")
-        print("Tabela 'received_files' inicializada com sucesso.")
+def delete_document_chunks(document, chunk_hashes=None):
+    """
+    Remove os chunks de um documento. Sem 'chunk_hashes' remove o documento inteiro
+    (e o seu registo); com 'chunk_hashes' remove apenas esses chunks.
+    Retorna o número de chunks removidos.
+    """
+    try:
+        conn = get_connection(DB_PATH)
+        with conn:
+            cursor = conn.cursor()
+            if chunk_hashes is None:
+                cursor.execute("DELETE FROM knowledge_base WHERE document = ?", (document,))
+                removed = cursor.rowcount
+                cursor.execute("DELETE FROM knowledge_documents WHERE document = ?", (document,))
+            else:
+                cursor.executemany("DELETE FROM knowledge_base WHERE document = ? AND chunk_hash = ?",
+                                   [(document, chunk_hash) for chunk_hash in chunk_hashes])
+                removed = cursor.rowcount
+            if removed:
+                bump_knowledge_version(cursor)
+        return removed
     except Exception as e:
-        print(f"!!! ERRO CRÍTICO ao inicializar as tabelas: {e} !!!")
+        print(f"!!! ERRO ao remover chunks de {document}: {e} !!!")
+        return 0
 
+def delete_untracked_knowledge():
+    """Remove chunks de ingestões antigas (sem documento associado)."""
+    try:
+        conn = get_connection(DB_PATH)
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM knowledge_base WHERE document IS NULL")
+            removed = cursor.rowcount
+            if removed:
+                bump_knowledge_version(cursor)
+        return removed
+    except Exception as e:
+        print(f"!!! ERRO ao remover chunks sem documento: {e} !!!")
+        return 0
 
-# --- FUNÇÃO PARA ADICIONAR CONHECIMENTO ---
-def add_knowledge(text_chunk):
-    """Gera um embedding e o armazena na base de conhecimento."""
-    vector = get_embedding(text_chunk)
-    if vector:
-        try:
-            conn = sqlite3.connect(DB_PATH)
+def mark_document_ingested(document, content_hash, chunk_count):
+    """Regista (checkpoint) que um documento foi totalmente ingerido."""
+    try:
+        conn = get_connection(DB_PATH)
+        with conn:
             cursor = conn.cursor()
-            # Serializa o vetor (lista) para JSON (string) para salvar no SQLite
-            vector_json = json.dumps(vector)
-            cursor.execute("INSERT INTO knowledge_base (text_chunk, embedding) VALUES (?, ?)",
-                           (text_chunk, vector_json))
-            conn.commit()
-            conn.close()
-            print(f"Chunk de conhecimento adicionado: {text_chunk[:40]}...")
-            return True
-        except Exception as e:
-            print(f"!!! ERRO ao salvar chunk no DB: {e} !!!")
-            return False
+            cursor.execute(
+                "REPLACE INTO knowledge_documents (document, content_hash, chunk_count, ingested_at) VALUES (?, ?, ?, ?)",
+                (document, content_hash, chunk_count, int(time.time()))
+            )
+        return True
+    except Exception as e:
+        print(f"!!! ERRO ao registar documento {document}: {e} !!!")
+        return False
 
-# --- FUNÇÃO DE BUSCA (O RAG) ---
-def get_relevant_knowledge(user_query, top_k=3):
-    """Encontra os 'top_k' chunks de texto mais relevantes para a pergunta do usuário."""
+def migrate_embeddings_to_binary(batch_size=500):
+    """
+    Converte os embeddings antigos (JSON) da 'knowledge_base' para o formato binário.
+    Pode ser executada várias vezes: linhas já convertidas são ignoradas.
+    Retorna o número de linhas convertidas.
+    """
+    converted = 0
     try:
-        # 1. Gera o embedding para a *pergunta* do usuário
-        query_vector_result = genai.embed_content(
-            model="models/text-embedding-004",
-            content=user_query,
-            task_type="RETRIEVAL_QUERY" 
+        conn = get_connection(DB_PATH)
+        with conn:
+            read_cursor = conn.cursor()
+            write_cursor = conn.cursor()
+            read_cursor.execute("SELECT id, embedding FROM knowledge_base")
+            updates = []
+            for chunk_id, embedding in read_cursor.fetchall():
+                if is_binary_embedding(embedding):
+                    continue
+                updates.append((encode_embedding(decode_embedding(embedding)), chunk_id))
+                if len(updates) >= batch_size:
+                    write_cursor.executemany("UPDATE knowledge_base SET embedding = ? WHERE id = ?", updates)
+                    converted += len(updates)
+                    updates = []
+            if updates:
+                write_cursor.executemany("UPDATE knowledge_base SET embedding = ? WHERE id = ?", updates)
+                converted += len(updates)
+            if converted:
+                bump_knowledge_version(write_cursor)
+        print(f"Migração de embeddings concluída: {converted} linhas convertidas para binário.")
+        if converted:
+            conn = get_connection(DB_PATH)
+            conn.execute("VACUUM")
+        return converted
+    except Exception as e:
+        print(f"!!! ERRO ao migrar embeddings para binário: {e} !!!")
+        return 0
+
+# --- FUNÇÃO DE BUSCA (O RAG) ---
+def _embed_query(user_query):
+    """Chama a API de embeddings para uma consulta (sem cache)."""
+    result = genai.embed_content(
+        model=EMBEDDING_MODEL,
+        content=user_query,
+        task_type="RETRIEVAL_QUERY" 
+    )
+    return result['embedding']
+
+def get_query_embedding(user_query):
+    """Devolve o embedding da consulta, reutilizando o cache LRU/TTL quando possível."""
+    global _query_embedding_cache
+    if _query_embedding_cache is None:
+        _query_embedding_cache = EmbeddingCache(
+            max_entries=QUERY_CACHE_SIZE,
+            ttl_seconds=QUERY_CACHE_TTL_SECONDS,
+            db_path=DB_PATH if QUERY_CACHE_PERSIST else None
         )
-        query_vector = np.array(query_vector_result['embedding'])
+    return _query_embedding_cache.get_or_compute(EMBEDDING_MODEL, user_query, _embed_query)
 
-        # 2. Busca todos os chunks e vetores do banco
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT text_chunk, embedding FROM knowledge_base")
-        rows = cursor.fetchall()
-        conn.close()
+def get_query_cache_stats():
+    """Contadores do cache de embeddings de consultas deste worker."""
+    if _query_embedding_cache is None:
+        return {"entries": 0, "hits": 0, "misses": 0}
+    return _query_embedding_cache.stats()
 
-        if not rows:
-            print("Base de conhecimento está vazia. Nenhuma busca RAG realizada.")
+def get_knowledge_version():
+    """Versão atual da base de conhecimento (e garante o índice atualizado)."""
+    try:
+        _knowledge_index.refresh()
+    except Exception as e:
+        print(f"!!! ERRO ao atualizar o índice de conhecimento: {e} !!!")
+    return _knowledge_index.version
+
+def get_relevant_knowledge(user_query, top_k=3, return_ids=False):
+    """
+    Encontra os 'top_k' chunks de texto mais relevantes para a pergunta do usuário.
+    Com 'return_ids=True' devolve pares (id do chunk, texto).
+    """
+    try:
+        # 1. Gera (ou reutiliza do cache) o embedding para a *pergunta* do usuário
+        query_vector = get_query_embedding(user_query)
+        if query_vector is None:
             return []
 
-        similarities = []
-        for row in rows:
-            text_chunk = row[0]
-            doc_vector = np.array(json.loads(row[1]))
-            
-            # 3. Calcula a Similaridade de Cosseno
-            similarity = np.dot(query_vector, doc_vector) / (np.linalg.norm(query_vector) * np.linalg.norm(doc_vector))
-            similarities.append((similarity, text_chunk))
+        # 2. Garante que o índice em memória está na versão atual da base
+        _knowledge_index.refresh()
+
+        if len(_knowledge_index) == 0:
+            print("Base de conhecimento está vazia. Nenhuma busca RAG realizada.")
+            return []
 
-        # 4. Ordena pela maior similaridade
-        similarities.sort(key=lambda x: x[0], reverse=True)
+        # 3. Similaridade de Cosseno contra a matriz pré-normalizada
+        # 4. Seleciona os mais similares (já ordenados)
+        similarities = _knowledge_index.search(query_vector, top_k)
 
         # 5. Retorna os 'top_k' textos mais relevantes
-        relevant_chunks = [chunk for similarity, chunk in similarities[:top_k] if similarity > 0.5] 
+        relevant_chunks = [(chunk_id, chunk) for similarity, chunk_id, chunk in similarities if similarity > 0.5]
         
         if relevant_chunks:
             print(f"RAG: Encontrados {len(relevant_chunks)} chunks relevantes para a query.")
         else:
             print("RAG: Nenhum chunk relevante encontrado.")
             
-        return relevant_chunks
+        if return_ids:
+            return relevant_chunks
+        return [chunk for _, chunk in relevant_chunks]
 
     except Exception as e:
         print(f"!!! ERRO durante a busca RAG: {e} !!!")
@@ -171,39 +319,41 @@ def get_relevant_knowledge(user_query, top_k=3):
 
 # --- FUNÇÕES DE GESTÃO DE UTILIZADORES ---
 
-def load_user_data():
+def get_users_page(limit=500, after=None):
+    """Devolve ([(número, nome)], próximo cursor) ordenados por número; cursor None na última página."""
+    if limit < 1:
+        return [], None
+    cursor = get_connection(DB_PATH).cursor()
+    cursor.execute("SELECT number, name FROM users WHERE number > ? ORDER BY number LIMIT ?",
+                   (after or "", limit + 1))
+    rows = cursor.fetchall()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, rows[-1][0]
+    return rows, None
+
+def iter_users(batch_size=500):
     """
-    Lê os dados da base de dados para um dicionário. Chave: número, Valor: nome.
+    Percorre todos os utilizadores (número, nome) em lotes ordenados por número,
+    sem carregar a tabela inteira em memória.
     """
-    if not os.path.exists(DB_PATH):
-        initialize_database()
-
-    user_data = {}
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT number, name FROM users")
-        rows = cursor.fetchall()
-        for row in rows:
-            user_data[row[0]] = row[1]
-        conn.close()
-        print(f"Carregados {len(user_data)} utilizadores da base de dados.")
-        return user_data
-    except Exception as e:
-        print(f"!!! ERRO CRÍTICO ao carregar utilizadores da base de dados: {e} !!!")
-        return {}
+    after = None
+    while True:
+        rows, after = get_users_page(batch_size, after)
+        yield from rows
+        if after is None:
+            return
 
 def add_new_user(number, name=None, status="active"):
     """Adiciona um novo utilizador à base de dados."""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO users (number, name, status) VALUES (?, ?, ?)",
-            (number, name, status)
-        )
-        conn.commit()
-        conn.close()
+        conn = get_connection(DB_PATH)
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT INTO users (number, name, status) VALUES (?, ?, ?)",
+                (number, name, status)
+            )
         print(f"Novo utilizador {number} adicionado à base de dados com o nome: {name}")
         return True
     except sqlite3.IntegrityError:
@@ -216,41 +366,26 @@ def add_new_user(number, name=None, status="active"):
 def update_user_name(number, new_name):
     """Atualiza o nome de um utilizador e define o seu estado como 'active'."""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE users SET name = ?, status = 'active' WHERE number = ?",
-            (new_name, number)
-        )
-        conn.commit()
-        conn.close()
+        conn = get_connection(DB_PATH)
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE users SET name = ?, status = 'active' WHERE number = ?",
+                (new_name, number)
+            )
         print(f"Nome do utilizador {number} atualizado para {new_name}.")
         return True
     except Exception as e:
         print(f"!!! ERRO CRÍTICO ao atualizar nome do utilizador: {e} !!!")
         return False
 
-def get_user_status(number):
-    """Verifica o estado de um utilizador (ex: 'pending_name')."""
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT status FROM users WHERE number = ?", (number,))
-        result = cursor.fetchone()
-        conn.close()
-        return result[0] if result else None
-    except Exception as e:
-        print(f"!!! ERRO CRÍTICO ao obter o estado do utilizador: {e} !!!")
-        return None
-
 def set_user_status(number, status):
     """Define o estado de um utilizador."""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET status = ? WHERE number = ?", (status, number))
-        conn.commit()
-        conn.close()
+        conn = get_connection(DB_PATH)
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE users SET status = ? WHERE number = ?", (status, number))
         return True
     except Exception as e:
         print(f"!!! ERRO CRÍTICO ao definir o estado do utilizador: {e} !!!")
@@ -259,48 +394,60 @@ def set_user_status(number, status):
 # --- Funções de Configurações ---
 
 def initialize_settings():
-    """Cria a tabela de configurações e garante que o modo padrão existe."""
-    try:
-        db_dir = os.path.dirname(DB_PATH)
-        os.makedirs(db_dir, exist_ok=True) 
+    """A tabela 'settings' e o modo padrão são criados pelas migrações (initialize_database)."""
+    initialize_database()
 
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT
-            )
-        ''')
-        # Define o modo padrão como 'standard' na primeira vez
-        cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('chatbot_mode', 'standard')")
-        conn.commit()
-        conn.close()
-        print("Tabela 'settings' inicializada com sucesso.")
-    except Exception as e:
-        print(f"!!! ERRO CRÍTICO ao inicializar a tabela 'settings': {e} !!!")
+def _refresh_settings_cache(force=False):
+    """
+    Recarrega as configurações deste worker se a versão no banco mudou.
+    A versão só é consultada a cada SETTINGS_REFRESH_SECONDS segundos.
+    """
+    global _settings_cache, _settings_version, _settings_checked_at
+    now = time.monotonic()
+    if not force and _settings_cache is not None and now - _settings_checked_at < SETTINGS_REFRESH_SECONDS:
+        return
+    with _settings_lock:
+        if not force and _settings_cache is not None and now - _settings_checked_at < SETTINGS_REFRESH_SECONDS:
+            return
+        cursor = get_connection(DB_PATH).cursor()
+        cursor.execute("SELECT value FROM settings WHERE key = ?", (SETTINGS_VERSION_KEY,))
+        result = cursor.fetchone()
+        version = result[0] if result else None
+        if force or _settings_cache is None or version != _settings_version:
+            cursor.execute("SELECT key, value FROM settings")
+            _settings_cache = dict(cursor.fetchall())
+            _settings_version = version
+        _settings_checked_at = now
+
+def _bump_version(cursor, key):
+    """Incrementa um contador de versão da tabela 'settings' (na transação da alteração)."""
+    cursor.execute("""
+        INSERT INTO settings (key, value) VALUES (?, '1')
+        ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+    """, (key,))
 
 def get_setting(key, default_value=None):
-    """Busca o valor de uma configuração na base de dados."""
+    """Busca o valor de uma configuração (cache do worker, revalidado pela versão)."""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT value FROM settings WHERE key = ?", (key,))
-        result = cursor.fetchone()
-        conn.close()
-        return result[0] if result else default_value
+        _refresh_settings_cache()
+        value = _settings_cache.get(key)
+        return value if value is not None else default_value
     except Exception as e:
         print(f"!!! ERRO ao buscar configuração '{key}': {e} !!!")
         return default_value
 
 def set_setting(key, value):
-    """Define o valor de uma configuração na base de dados."""
+    """
+    Define o valor de uma configuração na base de dados e incrementa a versão das
+    configurações, para que os outros workers recarreguem o seu cache.
+    """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
-        conn.commit()
-        conn.close()
+        conn = get_connection(DB_PATH)
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+            _bump_version(cursor, SETTINGS_VERSION_KEY)
+        _refresh_settings_cache(force=True)
         return True
     except Exception as e:
         print(f"!!! ERRO ao definir configuração '{key}': {e} !!!")
@@ -308,73 +455,108 @@ def set_setting(key, value):
 
 # --- FUNÇÕES DE HISTÓRICO DE CHAT ---
 
+def _with_summary(summary, history_list):
+    """Antepõe o resumo das mensagens arquivadas ao histórico enviado ao Gemini."""
+    if not summary:
+        return history_list
+    return [
+        {"role": "user", "parts": [f"{SUMMARY_PREFIX}: {summary}"]},
+        {"role": "model", "parts": ["Entendido, vou considerar este resumo na conversa."]}
+    ] + history_list
+
 def add_message_to_history(user_number, role, message):
-    """Adiciona uma mensagem (do 'user' ou 'model') ao histórico."""
+    """
+    Adiciona uma mensagem (do 'user' ou 'model') ao histórico.
+    A gravação é diferida e feita em lote; a mensagem já aparece em load_conversation_context.
+    """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        current_timestamp = int(time.time())
-        cursor.execute(
-            "INSERT INTO chat_history (user_number, role, message, timestamp) VALUES (?, ?, ?, ?)",
-            (user_number, role, message, current_timestamp)
-        )
-        conn.commit()
-        conn.close()
+        _history_writer.append(user_number, role, message)
     except Exception as e:
         print(f"!!! ERRO ao salvar mensagem no histórico: {e} !!!")
 
-def get_chat_history(user_number, limit=20):
+def flush_chat_history():
+    """
+    Grava já o histórico em buffer. Chamada no fim de cada job da fila: a mensagem
+    seguinte do mesmo remetente pode ser processada noutro worker.
+    Lança a exceção se a gravação falhar, para que o job falhe e volte à fila.
+    """
+    _history_writer.flush(raise_errors=True)
+
+def load_conversation_context(user_number, user_message=None, limit=20):
     """
-    Busca as últimas 'limit' mensagens e as formata para a API do Gemini.
-    O Gemini espera o formato: [{"role": "user", "parts": ["..."]}, {"role": "model", "parts": ["..."]}]
+    Carrega, numa única consulta, tudo o que o webhook precisa para responder:
+    se o utilizador está registado, o seu estado, nome e arquivo pendente, modo atual do chatbot e as
+    últimas 'limit' mensagens (formato do Gemini, precedidas do resumo das arquivadas).
+    Se 'user_message' for informada, entra no histórico antes da leitura.
     """
-    history_list = []
+    context = {
+        "registered": False,
+        "status": None,
+        "name": None,
+        "pending_file": None,
+        "mode": "standard",
+        "summary": None,
+        "history": []
+    }
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
+        if user_message is not None:
+            _history_writer.append(user_number, 'user', user_message)
+        cursor = get_connection(DB_PATH).cursor()
         query = """
-            SELECT role, message FROM (
-                SELECT role, message, timestamp FROM chat_history 
-                WHERE user_number = ? 
-                ORDER BY timestamp DESC
+            SELECT u.number IS NOT NULL, u.status, u.name, u.pending_file_path,
+                   (SELECT value FROM settings WHERE key = 'chatbot_mode'),
+                   (SELECT summary FROM chat_summaries WHERE user_number = q.number),
+                   h.role, h.message
+            FROM (SELECT ? AS number) AS q
+            LEFT JOIN users AS u ON u.number = q.number
+            LEFT JOIN (
+                SELECT role, message, timestamp, id FROM chat_history
+                WHERE user_number = ?
+                ORDER BY timestamp DESC, id DESC
                 LIMIT ?
-            ) AS sub
-            ORDER BY timestamp ASC 
+            ) AS h ON 1
+            ORDER BY h.timestamp ASC, h.id ASC
         """
-        cursor.execute(query, (user_number, limit))
-        rows = cursor.fetchall()
-        conn.close()
-        
-        for row in rows:
-            history_list.append({
-                "role": row[0],
-                "parts": [row[1]]
-            })
-            
-        print(f"Histórico de {user_number} carregado com {len(history_list)} mensagens.")
-        return history_list
-        
+        rows, pending = _history_writer.read_with_pending(
+            user_number, lambda: cursor.execute(query, (user_number, user_number, limit)).fetchall()
+        )
+
+        registered, status, name, pending_file, mode, summary = rows[0][:6]
+        context["registered"] = bool(registered)
+        context["status"] = status
+        context["name"] = name
+        context["pending_file"] = pending_file or None
+        context["mode"] = mode or "standard"
+        context["summary"] = summary
+        history = [(row[6], row[7]) for row in rows if row[6] is not None]
+        history += [(role, message) for role, message, _ in pending]
+        context["history"] = _with_summary(
+            summary, [{"role": role, "parts": [message]} for role, message in history[-limit:]]
+        )
+
+        print(f"Contexto de {user_number} carregado com {len(context['history'])} mensagens.")
+        return context
+
     except Exception as e:
-        print(f"!!! ERRO ao buscar histórico do chat: {e} !!!")
-        return []
-    
+        print(f"!!! ERRO ao carregar contexto da conversa de {user_number}: {e} !!!")
+        return context
+
 
 
 # --- FUNÇÃO PARA REGISTAR ARQUIVOS ---
 def add_received_file(message_id, user_number, file_path, mime_type, caption):
     """Adiciona o registo de um arquivo recebido na base de dados."""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        current_timestamp = int(time.time())
-        cursor.execute(
-            """INSERT INTO received_files 
-               (message_id, user_number, file_path, mime_type, caption, timestamp) 
-               VALUES (?, ?, ?, ?, ?, ?)""",
-            (message_id, user_number, file_path, mime_type, caption, current_timestamp)
-        )
-        conn.commit()
-        conn.close()
+        conn = get_connection(DB_PATH)
+        with conn:
+            cursor = conn.cursor()
+            current_timestamp = int(time.time())
+            cursor.execute(
+                """INSERT INTO received_files 
+                   (message_id, user_number, file_path, mime_type, caption, timestamp) 
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                (message_id, user_number, file_path, mime_type, caption, current_timestamp)
+            )
         print(f"Arquivo registado na base de dados: {file_path}")
         return True
     except sqlite3.IntegrityError:
@@ -387,27 +569,13 @@ def add_received_file(message_id, user_number, file_path, mime_type, caption):
 
 
 
-def get_pending_file(number):
-    """Busca o caminho do arquivo pendente para um usuário."""
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT pending_file_path FROM users WHERE number = ?", (number,))
-        result = cursor.fetchone()
-        conn.close()
-        return result[0] if result and result[0] else None
-    except Exception as e:
-        print(f"!!! ERRO ao obter pending_file para {number}: {e} !!!")
-        return None
-
 def set_pending_file(number, file_path):
     """Define ou limpa o caminho do arquivo pendente para um usuário."""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET pending_file_path = ? WHERE number = ?", (file_path, number))
-        conn.commit()
-        conn.close()
+        conn = get_connection(DB_PATH)
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE users SET pending_file_path = ? WHERE number = ?", (file_path, number))
         if file_path:
              print(f"Definido arquivo pendente para {number}: {file_path}")
         else:
@@ -415,4 +583,97 @@ def set_pending_file(number, file_path):
         return True
     except Exception as e:
         print(f"!!! ERRO ao definir pending_file para {number}: {e} !!!")
-        return False
\ No newline at end of file
+        return False
+
+# --- CONSULTA PAGINADA E EXPORTAÇÃO DE TABELAS (GESTÃO) ---
+
+# Tabela -> (coluna da chave de paginação, ordem, colunas devolvidas).
+# A chave é sempre a chave primária, por isso cada página é uma busca no índice.
+VIEWABLE_TABLES = {
+    'users': ('number', 'ASC', '*'),
+    'chat_history': ('id', 'DESC', '*'),
+    'settings': ('key', 'ASC', '*'),
+    'received_files': ('id', 'DESC', '*'),
+    'knowledge_base': ('id', 'ASC', 'id, text_chunk, document'),  # Não mostra o embedding
+}
+# Tabelas que aceitam o filtro por 'user_number'
+USER_FILTER_TABLES = ('chat_history', 'received_files')
+# Validade da contagem de linhas em cache (por worker)
+TABLE_COUNT_CACHE_SECONDS = int(os.getenv("TABLE_COUNT_CACHE_SECONDS", 60))
+_table_counts = {}
+
+def parse_page_cursor(table, cursor_value):
+    """Converte o cursor recebido na query string para o tipo da chave da tabela."""
+    if cursor_value in (None, ''):
+        return None
+    key_column = VIEWABLE_TABLES[table][0]
+    return int(cursor_value) if key_column == 'id' else cursor_value
+
+def fetch_table_page(table, limit=100, after=None, user_number=None):
+    """
+    Devolve (linhas como dicionários, próximo cursor) usando paginação por chave
+    (WHERE chave > / < último valor), cujo custo não cresce com a profundidade.
+    O próximo cursor é None na última página.
+    """
+    if limit < 1:
+        return [], None
+    key_column, order, columns = VIEWABLE_TABLES[table]
+    conditions = []
+    params = []
+    if user_number is not None and table in USER_FILTER_TABLES:
+        conditions.append("user_number = ?")
+        params.append(user_number)
+    if after is not None:
+        conditions.append(f"{key_column} {'<' if order == 'DESC' else '>'} ?")
+        params.append(after)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    cursor = get_connection(DB_PATH).cursor()
+    cursor.row_factory = sqlite3.Row
+    cursor.execute(f"SELECT {columns} FROM {table} {where} ORDER BY {key_column} {order} LIMIT ?",
+                   params + [limit + 1])
+    rows = [dict(row) for row in cursor.fetchall()]
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, rows[-1][key_column]
+    return rows, None
+
+def iter_table_rows(table, after=None, user_number=None, batch_size=1000):
+    """
+    Percorre a tabela inteira em lotes curtos (cada lote é uma leitura independente),
+    sem manter uma transação de leitura aberta durante toda a exportação.
+    """
+    while True:
+        rows, after = fetch_table_page(table, batch_size, after, user_number)
+        yield from rows
+        if after is None:
+            return
+
+def count_table_rows(table, mode='cached'):
+    """
+    Número de linhas de uma tabela.
+    mode: 'exact' (COUNT(*) agora), 'cached' (COUNT(*) reutilizado por
+    TABLE_COUNT_CACHE_SECONDS), 'approx' (estatísticas do ANALYZE, sem varrer a tabela)
+    ou 'none'.
+    """
+    if mode == 'none':
+        return None
+    cursor = get_connection(DB_PATH).cursor()
+    if mode == 'approx':
+        try:
+            cursor.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = ? LIMIT 1", (table,))
+            result = cursor.fetchone()
+            if result:
+                return int(result[0].split()[0])
+        except sqlite3.OperationalError:
+            pass  # ANALYZE nunca foi executado: usa a contagem em cache
+        mode = 'cached'
+
+    now = time.monotonic()
+    cached = _table_counts.get(table)
+    if mode == 'cached' and cached and now - cached[1] < TABLE_COUNT_CACHE_SECONDS:
+        return cached[0]
+    cursor.execute(f"SELECT COUNT(*) FROM {table}")
+    total = cursor.fetchone()[0]
+    _table_counts[table] = (total, now)
+    return total
@@ -0,0 +1,53 @@
+# db_connection.py
+
+import os
+import sqlite3
+import threading
+
+# Tempo máximo (ms) que uma escrita espera por outro worker antes de falhar
+BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 10000))
+# Statements preparados mantidos em cache por conexão
+CACHED_STATEMENTS = 256
+
+_local = threading.local()
+
+
+def _open_connection(db_path):
+    """Abre uma conexão já configurada com WAL e pragmas de desempenho."""
+    db_dir = os.path.dirname(db_path)
+    if db_dir:
+        os.makedirs(db_dir, exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_MS / 1000, cached_statements=CACHED_STATEMENTS)
+    # WAL: leitores não bloqueiam o escritor (e vice-versa) entre os workers do gunicorn
+    conn.execute("PRAGMA journal_mode=WAL")
+    # Em WAL, NORMAL só faz fsync nos checkpoints: seguro contra falhas da aplicação
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-16000")
+    return conn
+
+
+def get_connection(db_path):
+    """
+    Devolve a conexão persistente desta thread para 'db_path'.
+    As conexões não são partilhadas entre threads nem sobrevivem a um fork
+    (cada worker do gunicorn abre as suas).
+    """
+    connections = getattr(_local, 'connections', None)
+    if connections is None or getattr(_local, 'pid', None) != os.getpid():
+        connections = _local.connections = {}
+        _local.pid = os.getpid()
+
+    conn = connections.get(db_path)
+    if conn is None:
+        conn = connections[db_path] = _open_connection(db_path)
+    return conn
+
+
+def close_connection(db_path):
+    """Fecha a conexão desta thread (ex: antes de apagar ou substituir o arquivo)."""
+    connections = getattr(_local, 'connections', None) or {}
+    conn = connections.pop(db_path, None)
+    if conn is not None:
+        conn.close()
@@ -0,0 +1,146 @@
+# embedding_cache.py
+
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from knowledge_index import encode_embedding, decode_embedding
+from db_connection import get_connection
+
+# Intervalo entre limpezas das entradas expiradas do nível persistente
+PURGE_INTERVAL_SECONDS = 3600
+
+
+def normalize_query(text):
+    """Normaliza a consulta (maiúsculas/minúsculas e espaços) para uso como chave."""
+    return " ".join(text.casefold().split())
+
+
+def make_cache_key(model, text):
+    """Chave estável a partir do nome do modelo e do texto normalizado."""
+    raw = f"{model}\x00{normalize_query(text)}".encode('utf-8')
+    return hashlib.sha256(raw).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Cache LRU com TTL para embeddings de consultas RAG.
+
+    O primeiro nível fica em memória (por worker). Se 'db_path' for informado,
+    um segundo nível em SQLite (tabela query_embedding_cache, criada pelas
+    migrações) é partilhado entre todos os workers do gunicorn.
+    """
+
+    def __init__(self, max_entries=2048, ttl_seconds=24 * 3600, db_path=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.db_path = db_path
+        self.hits = 0
+        self.misses = 0
+        self.purged_at = 0.0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_memory(self, key, now):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            vector, created_at = entry
+            if now - created_at > self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return vector
+
+    def _put_memory(self, key, vector, created_at):
+        with self._lock:
+            self._entries[key] = (vector, created_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _get_persistent(self, key, now):
+        try:
+            conn = get_connection(self.db_path)
+            cursor = conn.cursor()
+            cursor.execute("SELECT embedding, created_at FROM query_embedding_cache WHERE cache_key = ?", (key,))
+            result = cursor.fetchone()
+            if result and now - result[1] > self.ttl_seconds:
+                with conn:
+                    conn.execute("DELETE FROM query_embedding_cache WHERE cache_key = ?", (key,))
+                result = None
+            if result:
+                return decode_embedding(result[0]), result[1]
+        except Exception as e:
+            print(f"Aviso: Falha ao ler cache persistente de embeddings: {e}")
+        return None
+
+    def _put_persistent(self, key, model, vector, created_at):
+        try:
+            conn = get_connection(self.db_path)
+            with conn:
+                conn.execute(
+                    "REPLACE INTO query_embedding_cache (cache_key, model, embedding, created_at) VALUES (?, ?, ?, ?)",
+                    (key, model, encode_embedding(vector), created_at)
+                )
+        except Exception as e:
+            print(f"Aviso: Falha ao gravar cache persistente de embeddings: {e}")
+
+    def get_or_compute(self, model, text, compute):
+        """
+        Devolve o embedding de 'text' para 'model', chamando 'compute(text)'
+        apenas quando não estiver em nenhum dos níveis do cache.
+        """
+        key = make_cache_key(model, text)
+        now = int(time.time())
+
+        vector = self._get_memory(key, now)
+        if vector is not None:
+            self._count(hit=True)
+            return vector
+
+        if self.db_path:
+            found = self._get_persistent(key, now)
+            if found is not None:
+                vector, created_at = found
+                self._put_memory(key, vector, created_at)
+                self._count(hit=True)
+                return vector
+
+        self._count(hit=False)
+        vector = compute(text)
+        if vector is None:
+            return None
+        self._put_memory(key, vector, now)
+        if self.db_path:
+            self._put_persistent(key, model, vector, now)
+            # Entradas expiradas que nunca voltam a ser consultadas são apagadas periodicamente
+            if now - self.purged_at > PURGE_INTERVAL_SECONDS:
+                self.purged_at = now
+                self.purge_expired()
+        return vector
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def purge_expired(self):
+        """Remove do nível persistente as entradas com TTL expirado."""
+        if not self.db_path:
+            return 0
+        try:
+            conn = get_connection(self.db_path)
+            with conn:
+                cursor = conn.execute("DELETE FROM query_embedding_cache WHERE created_at < ?",
+                                      (int(time.time()) - self.ttl_seconds,))
+            return cursor.rowcount
+        except Exception as e:
+            print(f"Aviso: Falha ao limpar cache persistente de embeddings: {e}")
+            return 0
+
+    def stats(self):
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,213 @@
+# history_retention.py
+
+import os
+import json
+import time
+import zlib
+import google.generativeai as genai
+from dotenv import load_dotenv
+from db_connection import get_connection
+
+# --- CONFIGURAÇÕES DE RETENÇÃO ---
+# Mensagens mais recentes de cada utilizador que ficam sempre na tabela chat_history
+HISTORY_LIVE_MESSAGES = int(os.getenv("HISTORY_LIVE_MESSAGES", 20))
+# Só são arquivadas mensagens com mais de N dias (não mexe em conversas em curso)
+HISTORY_ARCHIVE_AFTER_DAYS = int(os.getenv("HISTORY_ARCHIVE_AFTER_DAYS", 7))
+# Mensagens resumidas por chamada ao modelo
+HISTORY_ARCHIVE_BATCH = int(os.getenv("HISTORY_ARCHIVE_BATCH", 200))
+HISTORY_SUMMARY_MODEL = os.getenv("HISTORY_SUMMARY_MODEL", "gemini-2.5-flash")
+HISTORY_SUMMARY_MAX_CHARS = int(os.getenv("HISTORY_SUMMARY_MAX_CHARS", 2000))
+# Cada mensagem entra no pedido de resumo truncada a este tamanho (ex: áudios longos)
+SUMMARY_MESSAGE_MAX_CHARS = 1000
+
+ARCHIVE_TABLE_PREFIX = "chat_history_archive_"
+
+SUMMARY_PROMPT = """Você mantém o resumo de uma conversa entre um cliente e DUDA, a assistente do Bank AI.
+Atualize o resumo anterior com as novas mensagens abaixo. Guarde apenas o que for útil para
+continuar o atendimento: nome e dados que o cliente informou, produtos e valores discutidos,
+pedidos em aberto e decisões tomadas. Escreva em português, em no máximo {max_chars} caracteres.
+
+Resumo anterior:
+{previous_summary}
+
+Novas mensagens:
+{transcript}
+"""
+
+
+def archive_table_name(timestamp):
+    """Tabela de arquivo do mês (UTC) da mensagem, ex: chat_history_archive_202410."""
+    return ARCHIVE_TABLE_PREFIX + time.strftime('%Y%m', time.gmtime(timestamp))
+
+
+def ensure_archive_table(cursor, table):
+    """
+    Cria a tabela de arquivo de um mês. Cada linha guarda um lote de mensagens
+    de um utilizador como JSON comprimido com zlib.
+    """
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_number TEXT,
+            first_timestamp INTEGER,
+            last_timestamp INTEGER,
+            message_count INTEGER,
+            payload BLOB NOT NULL
+        )
+    ''')
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_user ON {table} (user_number)")
+
+
+def compress_messages(rows):
+    """rows: lista de (role, message, timestamp)."""
+    return zlib.compress(json.dumps(rows, ensure_ascii=False).encode('utf-8'), 9)
+
+
+def decompress_messages(payload):
+    return [tuple(row) for row in json.loads(zlib.decompress(payload).decode('utf-8'))]
+
+
+def summarize_turns(previous_summary, rows):
+    """
+    Gera o novo resumo a partir do resumo anterior e das mensagens (role, message, timestamp).
+    Retorna None em caso de falha (as mensagens ficam na tabela para a próxima execução).
+    """
+    transcript = "\n".join(
+        f"{'Cliente' if role == 'user' else 'DUDA'}: {message[:SUMMARY_MESSAGE_MAX_CHARS]}"
+        for role, message, _ in rows
+    )
+    prompt = SUMMARY_PROMPT.format(
+        max_chars=HISTORY_SUMMARY_MAX_CHARS,
+        previous_summary=previous_summary or "(nenhum)",
+        transcript=transcript
+    )
+    try:
+        model = genai.GenerativeModel(HISTORY_SUMMARY_MODEL)
+        response = model.generate_content(prompt)
+        summary = response.text.strip()
+        return summary[:HISTORY_SUMMARY_MAX_CHARS] if summary else None
+    except Exception as e:
+        print(f"!!! ERRO ao gerar resumo do histórico: {e} !!!")
+        return None
+
+
+def find_users_to_archive(db_path, cutoff, live_messages=HISTORY_LIVE_MESSAGES):
+    """Utilizadores com mensagens antigas para além da janela ativa."""
+    cursor = get_connection(db_path).cursor()
+    cursor.execute("""
+        SELECT user_number FROM chat_history
+        GROUP BY user_number
+        HAVING COUNT(*) > ? AND MIN(timestamp) < ?
+    """, (live_messages, cutoff))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def archive_user_history(db_path, user_number, cutoff, live_messages=HISTORY_LIVE_MESSAGES,
+                         batch_size=HISTORY_ARCHIVE_BATCH, summarize=summarize_turns):
+    """
+    Move para o arquivo as mensagens de 'user_number' anteriores a 'cutoff' que estão
+    fora das 'live_messages' mais recentes, incorporando-as no resumo do utilizador.
+    Retorna o número de mensagens arquivadas.
+    """
+    conn = get_connection(db_path)
+    archived = 0
+    while True:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, role, message, timestamp FROM chat_history
+            WHERE user_number = ? AND timestamp < ?
+              AND id NOT IN (
+                  SELECT id FROM chat_history WHERE user_number = ?
+                  ORDER BY timestamp DESC, id DESC
+                  LIMIT ?
+              )
+            ORDER BY timestamp ASC, id ASC
+            LIMIT ?
+        """, (user_number, cutoff, user_number, live_messages, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            return archived
+
+        cursor.execute("SELECT summary, message_count FROM chat_summaries WHERE user_number = ?", (user_number,))
+        previous = cursor.fetchone()
+        previous_summary, previous_count = previous if previous else (None, 0)
+
+        messages = [(role, message, timestamp) for _, role, message, timestamp in rows]
+        summary = summarize(previous_summary, messages)
+        if summary is None:
+            print(f"Aviso: Resumo de {user_number} não gerado. As mensagens ficam para a próxima execução.")
+            return archived
+
+        by_month = {}
+        for message in messages:
+            by_month.setdefault(archive_table_name(message[2]), []).append(message)
+
+        with conn:
+            for table, month_rows in by_month.items():
+                ensure_archive_table(cursor, table)
+                cursor.execute(
+                    f"""INSERT INTO {table}
+                        (user_number, first_timestamp, last_timestamp, message_count, payload)
+                        VALUES (?, ?, ?, ?, ?)""",
+                    (user_number, month_rows[0][2], month_rows[-1][2], len(month_rows), compress_messages(month_rows))
+                )
+            cursor.execute(
+                """REPLACE INTO chat_summaries
+                   (user_number, summary, summarized_until, message_count, updated_at)
+                   VALUES (?, ?, ?, ?, ?)""",
+                (user_number, summary, messages[-1][2], (previous_count or 0) + len(messages), int(time.time()))
+            )
+            cursor.executemany("DELETE FROM chat_history WHERE id = ?", [(row[0],) for row in rows])
+        archived += len(rows)
+
+
+def load_archived_history(db_path, user_number):
+    """Devolve todas as mensagens arquivadas de um utilizador (role, message, timestamp), por ordem."""
+    cursor = get_connection(db_path).cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ? ORDER BY name",
+                   (ARCHIVE_TABLE_PREFIX + '%',))
+    messages = []
+    for (table,) in cursor.fetchall():
+        cursor.execute(f"SELECT payload FROM {table} WHERE user_number = ? ORDER BY first_timestamp, id",
+                       (user_number,))
+        for (payload,) in cursor.fetchall():
+            messages.extend(decompress_messages(payload))
+    return messages
+
+
+def run_retention(db_path, archive_after_days=HISTORY_ARCHIVE_AFTER_DAYS, live_messages=HISTORY_LIVE_MESSAGES):
+    """Arquiva o histórico antigo de todos os utilizadores. Retorna o total de mensagens arquivadas."""
+    start_time = time.time()
+    cutoff = int(time.time()) - archive_after_days * 24 * 3600
+    users = find_users_to_archive(db_path, cutoff, live_messages)
+    print(f"{len(users)} utilizadores com histórico para arquivar (anterior a {archive_after_days} dias).")
+
+    total = 0
+    for user_number in users:
+        archived = archive_user_history(db_path, user_number, cutoff, live_messages)
+        if archived:
+            print(f"  {user_number}: {archived} mensagens arquivadas e resumidas.")
+        total += archived
+
+    if total:
+        # Devolve as páginas livres ao WAL e atualiza as estatísticas do planeador
+        conn = get_connection(db_path)
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("ANALYZE chat_history")
+    print(f"Retenção concluída: {total} mensagens arquivadas em {time.time() - start_time:.1f}s.")
+    return total
+
+
+# Execute periodicamente (ex: cron diário):
+#   docker-compose exec chatbot-ia python history_retention.py
+if __name__ == "__main__":
+    from database_manager import initialize_database, DB_PATH
+
+    load_dotenv()
+    GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+    if not GOOGLE_API_KEY:
+        raise ValueError("GOOGLE_API_KEY não encontrada no .env")
+    genai.configure(api_key=GOOGLE_API_KEY)
+
+    initialize_database()
+    run_retention(DB_PATH)
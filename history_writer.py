@@ -0,0 +1,132 @@
+# history_writer.py
+
+import os
+import time
+import atexit
+import threading
+from db_connection import get_connection
+
+
+class HistoryWriter:
+    """
+    Escrita diferida (write-behind) do histórico de chat.
+
+    As mensagens ficam num buffer em memória e são gravadas em lote, numa única
+    transação, quando o buffer atinge 'flush_rows' linhas ou a cada
+    'flush_seconds' segundos. Enquanto não forem gravadas, continuam visíveis
+    para as leituras deste worker através de read_with_pending().
+    O buffer é esvaziado de forma síncrona ao encerrar o processo (atexit).
+    Um lote que falha volta ao buffer até 'max_retries' vezes seguidas; depois é
+    descartado, e o buffer nunca passa de 'max_pending_rows' linhas.
+    """
+
+    def __init__(self, db_path, flush_rows=100, flush_seconds=1.0, max_pending_rows=10000, max_retries=5):
+        self.db_path = db_path
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.max_pending_rows = max_pending_rows
+        self.max_retries = max_retries
+        self.flushed = 0
+        self.dropped = 0
+        self._failures = 0
+        self._pending = []
+        self._lock = threading.Lock()
+        # Mantido durante a gravação de um lote: as leituras nunca veem uma linha
+        # em duplicado (no banco e no buffer) nem deixam de a ver.
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        atexit.register(self.close)
+
+    def _ensure_thread(self):
+        # A thread não sobrevive ao fork dos workers do gunicorn: é criada no próprio worker
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        if self._pid is not None:
+            # Linhas herdadas do processo pai são gravadas pelo próprio pai
+            self._pending = []
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_seconds)
+            self._wakeup.clear()
+            self.flush()
+
+    def append(self, user_number, role, message, timestamp=None):
+        """Coloca uma mensagem no buffer (não bloqueia à espera do disco)."""
+        row = (user_number, role, message, int(timestamp or time.time()))
+        with self._lock:
+            self._ensure_thread()
+            self._pending.append(row)
+            if len(self._pending) >= self.flush_rows:
+                self._wakeup.set()
+
+    def flush(self, raise_errors=False):
+        """
+        Grava todas as linhas pendentes numa única transação. Retorna quantas foram gravadas.
+        Com raise_errors=True, uma falha é relançada (depois de o lote voltar ao buffer).
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch = self._pending
+                self._pending = []
+            if not batch:
+                return 0
+            try:
+                conn = get_connection(self.db_path)
+                with conn:
+                    conn.executemany(
+                        "INSERT INTO chat_history (user_number, role, message, timestamp) VALUES (?, ?, ?, ?)",
+                        batch
+                    )
+                self.flushed += len(batch)
+                self._failures = 0
+                return len(batch)
+            except Exception as e:
+                print(f"!!! ERRO ao gravar lote de {len(batch)} mensagens no histórico: {e} !!!")
+                self._failures += 1
+                with self._lock:
+                    if self._failures >= self.max_retries:
+                        print(f"!!! ERRO: {self._failures} falhas seguidas. {len(batch)} mensagens do histórico descartadas. !!!")
+                        self.dropped += len(batch)
+                        self._failures = 0
+                    else:
+                        # Devolve o lote ao início do buffer para nova tentativa no próximo ciclo
+                        self._pending[:0] = batch
+                    excess = len(self._pending) - self.max_pending_rows
+                    if excess > 0:
+                        print(f"!!! ERRO: Buffer do histórico cheio. {excess} mensagens mais antigas descartadas. !!!")
+                        del self._pending[:excess]
+                        self.dropped += excess
+                if raise_errors:
+                    raise
+                return 0
+
+    def read_with_pending(self, user_number, read_db):
+        """
+        Executa 'read_db()' e devolve (resultado, linhas pendentes do utilizador)
+        sem que um flush concorrente mova linhas entre o banco e o buffer.
+        As linhas pendentes vêm como (role, message, timestamp), pela ordem de chegada.
+        """
+        with self._flush_lock:
+            result = read_db()
+            with self._lock:
+                pending = [(role, message, timestamp)
+                           for number, role, message, timestamp in self._pending
+                           if number == user_number]
+        return result, pending
+
+    def close(self):
+        """Esvazia o buffer (chamado no encerramento do processo)."""
+        if self._pid is not None and self._pid != os.getpid():
+            return
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {"pending": pending, "flushed": self.flushed, "dropped": self.dropped}
@@ -1,12 +1,23 @@
 # ingest_data.py
 
 import os
+import sys
 import time
-import sqlite3
+import hashlib
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import google.generativeai as genai
 import PyPDF2 
 from dotenv import load_dotenv
-from database_manager import add_knowledge, initialize_database, DB_PATH
+from database_manager import (
+    add_knowledge_batch, get_embeddings_batch, initialize_database, DB_PATH,
+    get_ingested_documents, get_known_documents, get_document_chunk_hashes,
+    delete_document_chunks, delete_untracked_knowledge, mark_document_ingested
+)
+from knowledge_index import bump_knowledge_version, build_ann_index, publish_knowledge_matrices
+from rate_limiter import TokenBucket
+from db_connection import get_connection
 
 # --- CONFIGURAÇÕES ---
 load_dotenv()
@@ -18,85 +29,298 @@ genai.configure(api_key=GOOGLE_API_KEY)
 
 KNOWLEDGE_SOURCE_DIR = "documentos_para_ia" 
 
+# Chunks enviados por pedido de embedding (a API aceita até 100 por pedido)
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 100))
+# Quota de pedidos por minuto da API de embeddings (ajuste ao seu plano)
+EMBEDDING_REQUESTS_PER_MINUTE = int(os.getenv("EMBEDDING_REQUESTS_PER_MINUTE", 1500))
+# Chunks gravados por transação no SQLite
+INGEST_COMMIT_ROWS = int(os.getenv("INGEST_COMMIT_ROWS", 1000))
+# Processos usados na extração de texto dos PDFs
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", os.cpu_count() or 1))
+# Páginas de um PDF extraídas por tarefa do pool
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", 25))
+# Intervalos de páginas em voo (limita a memória usada pelos resultados ainda não consumidos)
+PDF_PREFETCH_TASKS = int(os.getenv("PDF_PREFETCH_TASKS", INGEST_WORKERS * 2))
+# Tamanho dos blocos lidos dos arquivos TXT
+TXT_READ_BLOCK_CHARS = 64 * 1024
+
 def clear_knowledge_base():
     """Limpa a base de conhecimento antes de inserir novos dados."""
     try:
         initialize_database() 
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM knowledge_base")
-        conn.commit()
-        conn.close()
+        conn = get_connection(DB_PATH)
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM knowledge_base")
+            cursor.execute("DELETE FROM knowledge_documents")
+            bump_knowledge_version(cursor)
         print("Base de conhecimento anterior foi limpa.")
     except Exception as e:
         print(f"Erro ao limpar a base de conhecimento (pode estar vazia): {e}")
 
-def read_pdf(file_path):
-    """Extrai texto de um arquivo PDF."""
+def hash_file(file_path):
+    """Calcula o hash SHA-256 do conteúdo de um arquivo (lido em blocos)."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def hash_chunk(chunk):
+    """Hash SHA-256 do texto de um chunk."""
+    return hashlib.sha256(chunk.encode('utf-8')).hexdigest()
+
+def count_pdf_pages(file_path):
+    """Conta as páginas de um PDF (e avisa se parecer ser um scan). Retorna None em caso de erro."""
     try:
         with open(file_path, 'rb') as f:
             reader = PyPDF2.PdfReader(f)
             # Verifica se o PDF é baseado em imagem
             if reader.pages and reader.pages[0].get_object().get('/Resources', {}).get('/XObject'):
                  print(f"  -> Aviso: Este PDF ({os.path.basename(file_path)}) parece conter imagens complexas ou ser um scan. A extração pode falhar ou ser incompleta.")
-
-            text = ""
-            for page_num, page in enumerate(reader.pages):
-                try:
-                    text += page.extract_text() + "\n" 
-                except Exception as page_e:
-                    print(f"  -> Erro ao extrair texto da página {page_num+1} de {file_path}. Pulando página. Erro: {page_e}")
-            return text if text.strip() else None
-            
+            return len(reader.pages)
     except Exception as e:
         print(f"Erro ao ler PDF {file_path}: {e}")
         return None
 
+def extract_pdf_page_range(file_path, start, end):
+    """
+    Extrai as páginas [start, end) de um PDF. Executada nos processos do pool.
+    Retorna uma lista de (número da página, texto ou None, segundos, erro ou None).
+    """
+    results = []
+    with open(file_path, 'rb') as f:
+        reader = PyPDF2.PdfReader(f)
+        for page_num in range(start, end):
+            page_start = time.perf_counter()
+            try:
+                text = reader.pages[page_num].extract_text() or ""
+                results.append((page_num, text, time.perf_counter() - page_start, None))
+            except Exception as page_e:
+                results.append((page_num, None, time.perf_counter() - page_start, str(page_e)))
+    return results
+
+def plan_pdf_tasks(filename, file_path):
+    """Divide um PDF em intervalos de páginas: lista de (nome, caminho, início, fim)."""
+    page_count = count_pdf_pages(file_path)
+    if not page_count:
+        return []
+    return [(filename, file_path, start, min(start + PDF_PAGES_PER_TASK, page_count))
+            for start in range(0, page_count, PDF_PAGES_PER_TASK)]
+
+def iter_page_range_results(executor, tasks, window):
+    """
+    Envia os intervalos de páginas para o pool mantendo no máximo 'window' em voo,
+    e devolve (nome do arquivo, resultados) na ordem das tarefas.
+    A janela atravessa arquivos: o PDF seguinte começa a ser extraído enquanto
+    o atual ainda está a ser enviado para embedding.
+    """
+    tasks = iter(tasks)
+    in_flight = deque()
+    for filename, file_path, start, end in itertools.islice(tasks, window):
+        in_flight.append((filename, file_path, executor.submit(extract_pdf_page_range, file_path, start, end)))
+
+    while in_flight:
+        filename, file_path, future = in_flight.popleft()
+        for next_filename, next_path, start, end in itertools.islice(tasks, 1):
+            in_flight.append((next_filename, next_path, executor.submit(extract_pdf_page_range, next_path, start, end)))
+        try:
+            yield filename, future.result()
+        except Exception as e:
+            print(f"  -> Erro ao extrair um intervalo de páginas de {file_path}: {e}")
+            yield filename, []
+
+def iter_pdf_pages(file_path, range_results):
+    """
+    Devolve o texto das páginas à medida que os intervalos chegam, com uma quebra de
+    linha entre páginas. No fim relata falhas e tempos por página.
+    """
+    failures, page_count, total_seconds = 0, 0, 0.0
+    slowest_seconds, slowest_page = 0.0, 0
+    first = True
+    for page_results in range_results:
+        for page_num, text, seconds, error in page_results:
+            page_count += 1
+            total_seconds += seconds
+            if seconds >= slowest_seconds:
+                slowest_seconds, slowest_page = seconds, page_num
+            if error is not None:
+                failures += 1
+                print(f"  -> Erro ao extrair texto da página {page_num+1} de {file_path}. Pulando página. Erro: {error}")
+            elif text:
+                if not first:
+                    yield "\n"
+                first = False
+                yield text
+
+    if page_count:
+        print(f"  -> {page_count} páginas em {total_seconds:.2f}s de CPU (média {total_seconds / page_count * 1000:.0f} ms, "
+              f"mais lenta: página {slowest_page+1} com {slowest_seconds:.2f}s). Falhas: {failures}.")
+
+def read_pdf(file_path):
+    """Extrai texto de um arquivo PDF (no processo atual, sem pool), página a página."""
+    page_count = count_pdf_pages(file_path)
+    if not page_count:
+        return
+    ranges = (extract_pdf_page_range(file_path, start, min(start + PDF_PAGES_PER_TASK, page_count))
+              for start in range(0, page_count, PDF_PAGES_PER_TASK))
+    yield from iter_pdf_pages(file_path, ranges)
+
 def read_txt(file_path):
-    """Extrai texto de um arquivo TXT."""
+    """Extrai texto de um arquivo TXT, em blocos."""
     try:
         with open(file_path, 'r', encoding='utf-8') as f:
-            return f.read()
+            for block in iter(lambda: f.read(TXT_READ_BLOCK_CHARS), ''):
+                yield block
     except Exception as e:
         print(f"Erro ao ler TXT {file_path}: {e}")
-        return None
 
-def split_text_into_chunks(text, max_chars=1000, overlap=100):
-    """Divide o texto em pedaços menores (chunks) para melhor embedding."""
-    chunks = []
+def iter_text_chunks(text_pieces, max_chars=1000, overlap=100):
+    """
+    Divide um texto que chega em pedaços (páginas, blocos) em chunks para embedding.
+    Só mantém em memória o necessário para o chunk atual, e produz exatamente os mesmos
+    chunks que split_text_into_chunks aplicado ao texto completo.
+    """
+    buffer = ""
     start = 0
-    while start < len(text):
+    pieces = iter(text_pieces)
+    exhausted = False
+
+    while True:
+        # Só corta quando a janela inteira já chegou (ou o texto acabou)
+        while not exhausted and len(buffer) - start <= max_chars:
+            piece = next(pieces, None)
+            if piece is None:
+                exhausted = True
+            else:
+                buffer = buffer[start:] + piece
+                start = 0
+
+        if start >= len(buffer):
+            break
+
         end = start + max_chars
-        
+
         # Encontra o melhor ponto de corte (quebra de linha ou espaço)
         # quebra em parágrafo primeiro
-        best_end = text.rfind('\n\n', start, end)
+        best_end = buffer.rfind('\n\n', start, end)
         if best_end == -1 or best_end < start + (max_chars * 0.5):
-             best_end = text.rfind('\n', start, end)
+             best_end = buffer.rfind('\n', start, end)
              if best_end == -1 or best_end < start + (max_chars * 0.5):
-                 best_end = text.rfind(' ', start, end)
+                 best_end = buffer.rfind(' ', start, end)
                  if best_end == -1 or best_end < start + (max_chars * 0.5):
-                     best_end = end if end <= len(text) else len(text)
+                     best_end = end if end <= len(buffer) else len(buffer)
 
-        chunk = text[start:best_end].strip()
-        if chunk: 
-            chunks.append(chunk)
-        
-        if best_end == len(text):
-            break 
-            
-        start = best_end + 1 - overlap 
-        if start < 0 or start >= len(text):
-            break 
+        chunk = buffer[start:best_end].strip()
+        if chunk:
+            yield chunk
+
+        if best_end == len(buffer):
+            break
+
+        start = best_end + 1 - overlap
+        if start < 0 or start >= len(buffer):
+            break
+
+def split_text_into_chunks(text, max_chars=1000, overlap=100):
+    """Divide o texto em pedaços menores (chunks) para melhor embedding."""
+    return list(iter_text_chunks([text], max_chars, overlap))
+
+def ingest_chunks(hashed_chunks, rate_limiter, source_name):
+    """
+    Recebe (hash, chunk) em fluxo, gera os embeddings em lotes (respeitando a quota)
+    e grava-os em transações grandes. Cada transação funciona como checkpoint: se o
+    processo cair, os chunks já gravados são reconhecidos pelo hash na próxima execução.
+    Retorna (chunks gravados, chunks enviados).
+    """
+    saved, attempted = 0, 0
+    pending_chunks, pending_vectors, pending_hashes = [], [], []
 
-    return chunks
+    def flush():
+        nonlocal saved, pending_chunks, pending_vectors, pending_hashes
+        if pending_chunks:
+            saved += add_knowledge_batch(pending_chunks, pending_vectors, source_name, pending_hashes)
+            pending_chunks, pending_vectors, pending_hashes = [], [], []
+
+    hashed_chunks = iter(hashed_chunks)
+    while True:
+        batch = list(itertools.islice(hashed_chunks, EMBEDDING_BATCH_SIZE))
+        if not batch:
+            break
+        batch_hashes = [chunk_hash for chunk_hash, _ in batch]
+        batch_chunks = [chunk for _, chunk in batch]
+        vectors = get_embeddings_batch(batch_chunks, rate_limiter=rate_limiter)
+        if vectors is None:
+            print(f"Falha ao gerar embeddings dos chunks {attempted+1}-{attempted+len(batch)} de {source_name}")
+        else:
+            pending_chunks.extend(batch_chunks)
+            pending_vectors.extend(vectors)
+            pending_hashes.extend(batch_hashes)
+        attempted += len(batch)
+
+        if len(pending_chunks) >= INGEST_COMMIT_ROWS:
+            flush()
+
+    flush()
+    return saved, attempted
+
+def ingest_document(filename, text_pieces, content_hash, rate_limiter):
+    """
+    Ingestão incremental e em fluxo de um documento: os chunks são gerados à medida
+    que o texto chega; só os novos ou alterados são enviados para embedding, e os
+    que deixaram de existir são removidos no fim.
+    Retorna True se o documento ficou completo.
+    """
+    stored_hashes = get_document_chunk_hashes(filename)
+    seen_hashes = set()
+    stats = {"total": 0, "unchanged": 0}
+
+    def new_chunks():
+        for chunk in iter_text_chunks(text_pieces):
+            chunk_hash = hash_chunk(chunk)
+            # Ignora chunks repetidos dentro do mesmo documento
+            if chunk_hash in seen_hashes:
+                continue
+            seen_hashes.add(chunk_hash)
+            stats["total"] += 1
+            if chunk_hash in stored_hashes:
+                stats["unchanged"] += 1
+                continue
+            yield chunk_hash, chunk
+
+    print(f"Enviando chunks novos para embedding em lotes de {EMBEDDING_BATCH_SIZE}...")
+    saved, attempted = ingest_chunks(new_chunks(), rate_limiter, filename)
+
+    if stats["total"] == 0:
+        print(f"Nenhum texto extraído de {filename}.")
+        return False
+    print(f"{stats['total']} chunks no documento: {stats['unchanged']} inalterados, "
+          f"{saved} de {attempted} novos gravados na base de conhecimento.")
+
+    stale_hashes = stored_hashes - seen_hashes
+    if stale_hashes:
+        removed = delete_document_chunks(filename, stale_hashes)
+        print(f"{removed} chunks obsoletos de {filename} removidos.")
+
+    if saved < attempted:
+        print(f"Aviso: {filename} ficou incompleto. Rode o script novamente para retomar.")
+        return False
+    mark_document_ingested(filename, content_hash, stats["total"])
+    return True
 
 if __name__ == "__main__":
+    full_reindex = "--full" in sys.argv
+
     print("Inicializando banco de dados...")
     initialize_database()
     
-    # Limpa a base antiga para evitar duplicatas
-    clear_knowledge_base()
+    if full_reindex:
+        # Reindexação completa: limpa a base antiga
+        clear_knowledge_base()
+    else:
+        removed = delete_untracked_knowledge()
+        if removed:
+            print(f"{removed} chunks de ingestões antigas (sem hash) removidos; serão reindexados.")
 
     if not os.path.exists(KNOWLEDGE_SOURCE_DIR):
         os.makedirs(KNOWLEDGE_SOURCE_DIR)
@@ -105,49 +329,66 @@ if __name__ == "__main__":
         exit()
 
     print(f"Iniciando ingestão da pasta: {KNOWLEDGE_SOURCE_DIR}")
-    
-    for filename in os.listdir(KNOWLEDGE_SOURCE_DIR):
+    rate_limiter = TokenBucket(EMBEDDING_REQUESTS_PER_MINUTE)
+    ingested_documents = get_ingested_documents()
+    source_files = sorted(f for f in os.listdir(KNOWLEDGE_SOURCE_DIR) if f.lower().endswith((".pdf", ".txt")))
+
+    # Remove da base os documentos que já não existem na pasta
+    for document in sorted(get_known_documents() - set(source_files)):
+        removed = delete_document_chunks(document)
+        print(f"Documento removido da pasta: {document} ({removed} chunks apagados da base).")
+
+    # Seleciona os documentos novos ou alterados
+    pending_files = []
+    for filename in sorted(os.listdir(KNOWLEDGE_SOURCE_DIR)):
+        if filename not in source_files:
+            print(f"Ignorando arquivo não suportado: {filename}")
+            continue
+        content_hash = hash_file(os.path.join(KNOWLEDGE_SOURCE_DIR, filename))
+        if ingested_documents.get(filename) == content_hash:
+            print(f"Sem alterações: {filename}. Pulando.")
+            continue
+        pending_files.append((filename, content_hash))
+
+    # Intervalos de páginas de todos os PDFs, extraídos pelo pool numa janela limitada
+    pdf_tasks = []
+    for filename, _ in pending_files:
+        if filename.lower().endswith(".pdf"):
+            pdf_tasks.extend(plan_pdf_tasks(filename, os.path.join(KNOWLEDGE_SOURCE_DIR, filename)))
+    pdf_files_with_pages = {task[0] for task in pdf_tasks}
+
+    executor = ProcessPoolExecutor(max_workers=INGEST_WORKERS)
+    if pdf_tasks:
+        print(f"Extraindo {len(pdf_files_with_pages)} PDF(s) com {INGEST_WORKERS} processos...")
+    pdf_ranges = itertools.groupby(iter_page_range_results(executor, pdf_tasks, PDF_PREFETCH_TASKS),
+                                   key=lambda item: item[0])
+
+    for filename, content_hash in pending_files:
         file_path = os.path.join(KNOWLEDGE_SOURCE_DIR, filename)
-        full_text = None
         
         if filename.lower().endswith(".pdf"):
             print(f"\nProcessando PDF: {filename}")
-            full_text = read_pdf(file_path)
-        elif filename.lower().endswith(".txt"):
-            print(f"\nProcessando TXT: {filename}")
-            full_text = read_txt(file_path)
-            
-        if full_text:
-            text_length = len(full_text)
-            print(f"Texto extraído: {text_length} caracteres.")
-
-            # Verifica se o texto é absurdamente grande
-            if text_length > 50_000_000: 
-                print(f"!!! AVISO: Texto extraído de '{filename}' é muito grande ({text_length}). Pulando este arquivo para evitar MemoryError.")
+            if filename not in pdf_files_with_pages:
+                print(f"Ignorando arquivo vazio ou com falha na leitura: {filename}")
                 continue
-
-            try:
-                chunks = split_text_into_chunks(full_text)
-                print(f"Texto dividido em {len(chunks)} chunks. Enviando para embedding...")
-                
-                for i, chunk in enumerate(chunks):
-                    success = add_knowledge(chunk)
-                    if not success:
-                        print(f"Falha ao processar chunk {i+1} de {filename}")
-                    time.sleep(1) # (Rate Limit)
-            
-            except MemoryError:
-                # --- CAPTURA DE ERRO ---
-                print(f"!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-                print(f"!!! ERRO DE MEMÓRIA ao processar os chunks de: {filename} !!!")
-                print(f"!!! Este arquivo provavelmente é um SCAN ou está corrompido. !!!")
-                print(f"!!! O script irá pular este arquivo e continuar.            !!!")
-                print(f"!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-            except Exception as e:
-                print(f"!!! Erro inesperado ao processar chunks de {filename}: {e} !!!")
-                
+            _, file_ranges = next(pdf_ranges)
+            text_pieces = iter_pdf_pages(file_path, (results for _, results in file_ranges))
         else:
-            print(f"Ignorando arquivo não suportado, vazio ou falha na leitura: {filename}")
+            print(f"\nProcessando TXT: {filename}")
+            text_pieces = read_txt(file_path)
+
+        try:
+            ingest_document(filename, text_pieces, content_hash, rate_limiter)
+        except Exception as e:
+            print(f"!!! Erro inesperado ao processar chunks de {filename}: {e} !!!")
+
+    executor.shutdown()
+
+    print("\nExportando matriz de embeddings partilhada pelos workers...")
+    publish_knowledge_matrices(DB_PATH)
+
+    print("\nConstruindo índice de busca aproximada (IVF)...")
+    build_ann_index(DB_PATH)
 
     print("\n--- Ingestão de Dados Concluída ---")
-    print(f"Sua base de conhecimento no arquivo '{DB_PATH}' foi populada com os arquivos válidos.")
\ No newline at end of file
+    print(f"Sua base de conhecimento no arquivo '{DB_PATH}' está sincronizada com a pasta '{KNOWLEDGE_SOURCE_DIR}'.")
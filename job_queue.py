@@ -0,0 +1,375 @@
+# job_queue.py
+
+import os
+import json
+import time
+import uuid
+import threading
+import traceback
+from db_connection import get_connection
+
+# --- CONFIGURAÇÕES DA FILA ---
+# Threads de processamento por worker do gunicorn
+JOB_WORKER_THREADS = int(os.getenv("JOB_WORKER_THREADS", 4))
+# Tempo máximo de posse de um job; depois disso outro worker pode retomá-lo (ex: processo morto).
+# Enquanto o job corre, o lease é renovado a cada terço deste tempo
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", 300))
+# Tentativas antes de o job ir para a 'dead letter' (status 'dead')
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 5))
+JOB_RETRY_BASE_SECONDS = 5
+JOB_RETRY_MAX_SECONDS = 600
+# Máximo de conversas (remetentes) em processamento ao mesmo tempo, somando todos os workers
+JOB_MAX_ACTIVE_CONVERSATIONS = int(os.getenv("JOB_MAX_ACTIVE_CONVERSATIONS", 16))
+# Janela de agrupamento: mensagens de texto seguidas do mesmo remetente viram um só job (0 desativa)
+JOB_COALESCE_SECONDS = float(os.getenv("JOB_COALESCE_SECONDS", 3))
+# Espera máxima de um job agrupado desde a primeira mensagem, mesmo que continuem a chegar mensagens
+JOB_COALESCE_MAX_SECONDS = float(os.getenv("JOB_COALESCE_MAX_SECONDS", 10))
+# Intervalo de consulta da fila quando não há trabalho
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", 0.5))
+# Jobs concluídos são apagados depois deste tempo
+JOB_DONE_RETENTION_SECONDS = int(os.getenv("JOB_DONE_RETENTION_SECONDS", 24 * 3600))
+
+JOB_PENDING = 'pending'
+JOB_PROCESSING = 'processing'
+JOB_DONE = 'done'
+JOB_DEAD = 'dead'
+
+
+class LeaseLost(Exception):
+    """O job foi retomado por outro worker (lease expirado); quem o tinha deve parar."""
+
+
+class Job:
+    def __init__(self, job_id, sender, message_id, payload, attempts, token=None, steps=()):
+        self.id = job_id
+        self.sender = sender
+        self.message_id = message_id
+        self.payload = payload
+        self.attempts = attempts
+        # Token do lease (claim_token): identifica esta posse do job
+        self.token = token
+        # Etapas já concluídas em tentativas anteriores (ver JobQueue.mark_step)
+        self.steps = set(steps)
+
+
+class JobQueue:
+    """
+    Fila durável em SQLite (tabela webhook_jobs) para processar os webhooks fora do pedido HTTP.
+
+    O webhook só faz enqueue(); as threads de start_workers() reclamam jobs com um
+    'lease' (claim), e cada job termina em complete() ou fail(). Falhas voltam à
+    fila com espera exponencial até JOB_MAX_ATTEMPTS; depois ficam com status 'dead'.
+    Cada claim grava um token novo: complete(), fail() e renew_lease() só atuam se o
+    token ainda for o do job, pelo que um worker que perdeu o lease (e cujo job já foi
+    retomado por outro) não sobrescreve o resultado. Uma thread de heartbeat renova
+    o lease dos jobs em curso neste processo.
+
+    Como um job pode correr mais de uma vez, o handler regista com mark_step() as
+    etapas com efeitos externos (ex: resposta enviada) e salta-as quando job.steps
+    já as tiver.
+
+    Cada remetente funciona como uma caixa de correio ordenada: um job só é
+    reclamado quando não há outro anterior do mesmo remetente pendente ou em
+    processamento. Remetentes diferentes são processados em paralelo, até
+    'max_active' conversas ao mesmo tempo.
+
+    Jobs enfileirados com 'coalesce_seconds' ficam à espera durante essa janela;
+    um novo job do mesmo remetente que chegue dentro dela é juntado ao anterior
+    (função 'merge') em vez de criar outro.
+    """
+
+    def __init__(self, db_path, lease_seconds=JOB_LEASE_SECONDS, max_attempts=JOB_MAX_ATTEMPTS,
+                 max_active=JOB_MAX_ACTIVE_CONVERSATIONS):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.max_active = max_active
+        self.coalesced = 0
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._pid = None
+        # Jobs reclamados por este processo e ainda por terminar (renovados pelo heartbeat)
+        self._leased = {}
+        self._leased_lock = threading.Lock()
+        self._heartbeat_pid = None
+
+    def enqueue(self, sender, message_id, payload, coalesce_seconds=0, merge=None):
+        """
+        Grava o job (com commit) e acorda as threads deste worker. Retorna o id do job.
+
+        Com 'coalesce_seconds' (e uma função merge(payload_anterior, payload_novo)), se o
+        último job do remetente também for agrupável e ainda estiver dentro da janela,
+        o payload é juntado a esse job e a janela é prolongada (até JOB_COALESCE_MAX_SECONDS
+        desde a criação). Nesse caso retorna o id do job existente.
+        """
+        now = time.time()
+        coalescible = bool(coalesce_seconds and merge)
+        conn = get_connection(self.db_path)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if coalescible:
+                last = conn.execute(
+                    """SELECT id, payload, status, coalescible, attempts, available_at, created_at
+                       FROM webhook_jobs WHERE sender = ? ORDER BY id DESC LIMIT 1""",
+                    (sender,)
+                ).fetchone()
+                if last and last[2] == JOB_PENDING and last[3] and last[4] == 0 and last[5] > now:
+                    job_id, previous_payload, created_at = last[0], last[1], last[6]
+                    merged = merge(json.loads(previous_payload), payload)
+                    available_at = min(now + coalesce_seconds, created_at + JOB_COALESCE_MAX_SECONDS)
+                    conn.execute(
+                        "UPDATE webhook_jobs SET payload = ?, available_at = ?, updated_at = ? WHERE id = ?",
+                        (json.dumps(merged, ensure_ascii=False), max(available_at, now), now, job_id)
+                    )
+                    conn.commit()
+                    self.coalesced += 1
+                    return job_id
+
+            cursor = conn.execute(
+                """INSERT INTO webhook_jobs
+                   (sender, message_id, payload, status, attempts, available_at, coalescible, created_at, updated_at)
+                   VALUES (?, ?, ?, ?, 0, ?, ?, ?, ?)""",
+                (sender, message_id, json.dumps(payload, ensure_ascii=False), JOB_PENDING,
+                 now + coalesce_seconds if coalescible else now, int(coalescible), now, now)
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        self._wakeup.set()
+        return cursor.lastrowid
+
+    def claim(self):
+        """
+        Reclama o job disponível mais antigo (pendente, ou em processamento com o lease
+        expirado) cujo remetente não tenha nenhum job anterior ainda por terminar.
+        A transação IMMEDIATE garante que dois workers não reclamam o mesmo job.
+        Retorna None se não houver trabalho ou se o limite de conversas ativas foi atingido.
+        """
+        now = time.time()
+        conn = get_connection(self.db_path)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            active = conn.execute(
+                "SELECT COUNT(*) FROM webhook_jobs WHERE status = ? AND lease_until >= ?",
+                (JOB_PROCESSING, now)
+            ).fetchone()[0]
+            if active >= self.max_active:
+                conn.commit()
+                return None
+            row = conn.execute(
+                """SELECT id, sender, message_id, payload, attempts, steps FROM webhook_jobs AS job
+                   WHERE ((job.status = ? AND job.available_at <= ?)
+                          OR (job.status = ? AND job.lease_until < ?))
+                     AND NOT EXISTS (
+                         SELECT 1 FROM webhook_jobs AS earlier
+                         WHERE earlier.sender = job.sender
+                           AND earlier.status IN (?, ?)
+                           AND earlier.id < job.id
+                     )
+                   ORDER BY job.id
+                   LIMIT 1""",
+                (JOB_PENDING, now, JOB_PROCESSING, now, JOB_PENDING, JOB_PROCESSING)
+            ).fetchone()
+            if row is None:
+                conn.commit()
+                return None
+            token = uuid.uuid4().hex
+            conn.execute(
+                """UPDATE webhook_jobs
+                   SET status = ?, attempts = attempts + 1, lease_until = ?, claim_token = ?, updated_at = ?
+                   WHERE id = ?""",
+                (JOB_PROCESSING, now + self.lease_seconds, token, now, row[0])
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        job_id, sender, message_id, payload, attempts, steps = row
+        job = Job(job_id, sender, message_id, json.loads(payload), attempts + 1, token,
+                  json.loads(steps) if steps else ())
+        with self._leased_lock:
+            self._leased[job.id] = job
+        return job
+
+    def _update_leased(self, job, assignments, params):
+        """UPDATE do job só se este processo ainda tiver o lease. Retorna False se o perdeu."""
+        conn = get_connection(self.db_path)
+        with conn:
+            cursor = conn.execute(
+                f"UPDATE webhook_jobs SET {assignments} WHERE id = ? AND claim_token = ? AND status = ?",
+                list(params) + [job.id, job.token, JOB_PROCESSING]
+            )
+        return cursor.rowcount > 0
+
+    def _release_local(self, job):
+        with self._leased_lock:
+            self._leased.pop(job.id, None)
+
+    def renew_lease(self, job):
+        """Prolonga o lease de um job em curso. Retorna False se o lease já foi perdido."""
+        now = time.time()
+        return self._update_leased(job, "lease_until = ?, updated_at = ?", (now + self.lease_seconds, now))
+
+    def mark_step(self, job, step):
+        """
+        Regista no job que a etapa 'step' foi concluída, para não ser repetida se o
+        job voltar a correr. Lança LeaseLost se o job já não pertence a este processo.
+        """
+        steps = job.steps | {step}
+        if not self._update_leased(job, "steps = ?, updated_at = ?", (json.dumps(sorted(steps)), time.time())):
+            raise LeaseLost(f"Job {job.id} de {job.sender} perdeu o lease.")
+        job.steps = steps
+
+    def complete(self, job):
+        """Marca o job como concluído. Retorna False (e ignora o resultado) se o lease foi perdido."""
+        self._release_local(job)
+        if not self._update_leased(job, "status = ?, lease_until = NULL, updated_at = ?", (JOB_DONE, time.time())):
+            print(f"Aviso: Job {job.id} de {job.sender} perdeu o lease antes de terminar. Resultado ignorado.")
+            return False
+        return True
+
+    def fail(self, job, error):
+        """
+        Volta a pôr o job na fila com espera exponencial, ou envia-o para a 'dead letter'.
+        Retorna False (sem alterar o job) se o lease já tinha sido perdido.
+        """
+        now = time.time()
+        self._release_local(job)
+        if job.attempts >= self.max_attempts:
+            status, available_at = JOB_DEAD, now
+        else:
+            status = JOB_PENDING
+            available_at = now + min(JOB_RETRY_BASE_SECONDS * 2 ** (job.attempts - 1), JOB_RETRY_MAX_SECONDS)
+        if not self._update_leased(job, "status = ?, available_at = ?, lease_until = NULL, last_error = ?, updated_at = ?",
+                                   (status, available_at, str(error)[:2000], now)):
+            print(f"Aviso: Job {job.id} de {job.sender} perdeu o lease antes de terminar. Falha ignorada.")
+            return False
+        if status == JOB_DEAD:
+            print(f"!!! ERRO: Job {job.id} de {job.sender} falhou {job.attempts} vezes. Movido para 'dead'. !!!")
+        else:
+            print(f"Aviso: Job {job.id} falhou (tentativa {job.attempts}/{self.max_attempts}). "
+                  f"Nova tentativa em {available_at - now:.0f}s.")
+        return True
+
+    def release_leased(self):
+        """
+        Devolve já à fila os jobs que este processo ainda tem reclamados (usado no encerramento),
+        em vez de esperar que o lease expire. Retorna quantos foram devolvidos.
+        """
+        with self._leased_lock:
+            jobs = list(self._leased.values())
+            self._leased = {}
+        now = time.time()
+        released = 0
+        for job in jobs:
+            if self._update_leased(job, "status = ?, available_at = ?, lease_until = NULL, updated_at = ?",
+                                   (JOB_PENDING, now, now)):
+                released += 1
+        self._wakeup.set()
+        return released
+
+    def purge_done(self, older_than_seconds=JOB_DONE_RETENTION_SECONDS):
+        conn = get_connection(self.db_path)
+        with conn:
+            cursor = conn.execute("DELETE FROM webhook_jobs WHERE status = ? AND updated_at < ?",
+                                  (JOB_DONE, time.time() - older_than_seconds))
+        return cursor.rowcount
+
+    def requeue_dead(self, job_id=None):
+        """Devolve à fila os jobs 'dead' (todos, ou só 'job_id') depois de corrigida a causa."""
+        conn = get_connection(self.db_path)
+        query = "UPDATE webhook_jobs SET status = ?, attempts = 0, available_at = ?, updated_at = ? WHERE status = ?"
+        params = [JOB_PENDING, time.time(), time.time(), JOB_DEAD]
+        if job_id is not None:
+            query += " AND id = ?"
+            params.append(job_id)
+        with conn:
+            cursor = conn.execute(query, params)
+        self._wakeup.set()
+        return cursor.rowcount
+
+    def stats(self):
+        cursor = get_connection(self.db_path).cursor()
+        cursor.execute("SELECT status, COUNT(*) FROM webhook_jobs GROUP BY status")
+        counts = {JOB_PENDING: 0, JOB_PROCESSING: 0, JOB_DONE: 0, JOB_DEAD: 0}
+        counts.update(dict(cursor.fetchall()))
+        # Mensagens juntadas a um job existente por este worker desde o arranque
+        counts["coalesced"] = self.coalesced
+        return counts
+
+    # --- THREADS DE PROCESSAMENTO ---
+    def _heartbeat(self):
+        while True:
+            time.sleep(max(self.lease_seconds / 3, 1))
+            with self._leased_lock:
+                jobs = list(self._leased.values())
+            for job in jobs:
+                try:
+                    if not self.renew_lease(job):
+                        print(f"Aviso: Lease do job {job.id} de {job.sender} perdido; outro worker pode retomá-lo.")
+                        self._release_local(job)
+                except Exception as e:
+                    # Tenta de novo na próxima volta, antes de o lease expirar
+                    print(f"Aviso: Falha ao renovar o lease do job {job.id}: {e}")
+
+    def start_heartbeat(self):
+        """Inicia (uma vez por processo) a thread que renova o lease dos jobs em curso."""
+        if self._heartbeat_pid == os.getpid():
+            return
+        self._heartbeat_pid = os.getpid()
+        with self._leased_lock:
+            # Depois de um fork, os jobs do processo pai não são deste processo
+            self._leased = {}
+        threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True).start()
+
+    def _run(self, handler):
+        last_purge = 0.0
+        while True:
+            try:
+                job = self.claim()
+            except Exception as e:
+                print(f"!!! ERRO ao reclamar job da fila: {e} !!!")
+                job = None
+
+            if job is None:
+                if time.time() - last_purge > 3600:
+                    last_purge = time.time()
+                    try:
+                        self.purge_done()
+                    except Exception as e:
+                        print(f"Aviso: Falha ao limpar jobs concluídos: {e}")
+                self._wakeup.wait(JOB_POLL_SECONDS)
+                self._wakeup.clear()
+                continue
+
+            try:
+                handler(job)
+                self.complete(job)
+            except LeaseLost as e:
+                self._release_local(job)
+                print(f"Aviso: {e} Processamento interrompido; o job continua noutro worker.")
+            except Exception as e:
+                print(f"!!! ERRO ao processar job {job.id}: {e} !!!")
+                print(traceback.format_exc())
+                try:
+                    self.fail(job, e)
+                except Exception as fail_error:
+                    # O lease expira e o job é retomado mais tarde
+                    print(f"!!! ERRO ao registar falha do job {job.id}: {fail_error} !!!")
+
+    def start_workers(self, handler, threads=JOB_WORKER_THREADS):
+        """
+        Inicia as threads que processam a fila neste processo (uma vez por worker do gunicorn).
+        'handler' recebe o Job; se terminar sem exceção o job fica concluído.
+        """
+        if self._threads and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._threads = []
+        for index in range(threads):
+            thread = threading.Thread(target=self._run, args=(handler,), name=f"job-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        self.start_heartbeat()
+        print(f"Fila de webhooks: {threads} threads de processamento iniciadas (pid {self._pid}).")
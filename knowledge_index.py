@@ -0,0 +1,569 @@
+# knowledge_index.py
+
+import sqlite3
+import json
+import struct
+import time
+import os
+import fcntl
+import threading
+import numpy as np
+from db_connection import get_connection
+from ann_index import IVFIndex, ivf_index_path, ANN_MIN_ROWS
+
+
+# --- FORMATO BINÁRIO DOS EMBEDDINGS ---
+# Cabeçalho de 12 bytes: magic (4s), código do dtype (B), 3 bytes de preenchimento, dimensão (I).
+# Os dados começam alinhados a 4 bytes, prontos para np.frombuffer sem cópia.
+EMBEDDING_MAGIC = b'EMB1'
+EMBEDDING_HEADER = struct.Struct('<4sBxxxI')
+EMBEDDING_DTYPES = {1: np.dtype('<f4')}
+EMBEDDING_DTYPE_CODES = {dtype: code for code, dtype in EMBEDDING_DTYPES.items()}
+
+
+def encode_embedding(vector, dtype='<f4'):
+    """Serializa um vetor para o formato binário (cabeçalho + dados crus)."""
+    dtype = np.dtype(dtype)
+    array = np.asarray(vector, dtype=dtype).ravel()
+    header = EMBEDDING_HEADER.pack(EMBEDDING_MAGIC, EMBEDDING_DTYPE_CODES[dtype], array.size)
+    return header + array.tobytes()
+
+
+def is_binary_embedding(blob):
+    """Verifica se o valor armazenado já está no formato binário."""
+    return isinstance(blob, (bytes, memoryview)) and bytes(blob[:4]) == EMBEDDING_MAGIC
+
+
+def decode_embedding(blob):
+    """
+    Lê um embedding armazenado no banco.
+    Aceita o formato binário (leitura sem cópia) e o formato JSON antigo.
+    """
+    if is_binary_embedding(blob):
+        magic, dtype_code, dim = EMBEDDING_HEADER.unpack_from(blob)
+        return np.frombuffer(blob, dtype=EMBEDDING_DTYPES[dtype_code], count=dim,
+                             offset=EMBEDDING_HEADER.size)
+    if isinstance(blob, (bytes, memoryview)):
+        blob = bytes(blob).decode('utf-8')
+    return np.asarray(json.loads(blob), dtype=np.float32)
+
+
+# --- VERSÃO DA BASE DE CONHECIMENTO ---
+KNOWLEDGE_VERSION_KEY = 'knowledge_version'
+
+
+def read_knowledge_version(cursor):
+    """Lê a versão atual da base de conhecimento (0 se ainda não existir)."""
+    try:
+        cursor.execute("SELECT value FROM settings WHERE key = ?", (KNOWLEDGE_VERSION_KEY,))
+        result = cursor.fetchone()
+        return int(result[0]) if result else 0
+    except sqlite3.OperationalError:
+        # Tabela 'settings' ainda não criada
+        return 0
+
+
+def bump_knowledge_version(cursor):
+    """
+    Incrementa a versão da base de conhecimento.
+    Deve ser chamada na mesma transação que altera a tabela 'knowledge_base'.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+    new_version = read_knowledge_version(cursor) + 1
+    cursor.execute("REPLACE INTO settings (key, value) VALUES (?, ?)",
+                   (KNOWLEDGE_VERSION_KEY, str(new_version)))
+    return new_version
+
+
+# --- MATRIZ DE EMBEDDINGS PARTILHADA (MEMORY-MAPPED) ---
+def knowledge_matrix_dir(db_path):
+    """Pasta (ao lado do banco) com as matrizes exportadas de cada versão."""
+    return os.path.join(os.path.dirname(db_path), 'knowledge_index')
+
+
+def knowledge_matrix_paths(db_path, version):
+    """Caminhos (matriz, ids) da exportação de uma versão da base de conhecimento."""
+    directory = knowledge_matrix_dir(db_path)
+    return (os.path.join(directory, f'matrix_v{version}.npy'),
+            os.path.join(directory, f'ids_v{version}.npy'))
+
+
+def latest_exported_version(db_path):
+    """Versão mais recente com a matriz já exportada (None se não houver nenhuma)."""
+    directory = knowledge_matrix_dir(db_path)
+    versions = []
+    try:
+        for filename in os.listdir(directory):
+            if filename.startswith('matrix_v') and filename.endswith('.npy') and '.tmp.' not in filename:
+                version = filename[len('matrix_v'):-len('.npy')]
+                if version.isdigit() and os.path.exists(knowledge_matrix_paths(db_path, int(version))[1]):
+                    versions.append(int(version))
+    except OSError:
+        return None
+    return max(versions) if versions else None
+
+
+def export_knowledge_matrix(db_path, keep_versions=2):
+    """
+    Exporta os embeddings normalizados da versão atual para um arquivo .npy que os
+    workers mapeiam em memória (só leitura). A escrita é feita num arquivo temporário
+    e publicada com os.replace, portanto um worker nunca vê um arquivo incompleto.
+    Um lock de arquivo garante que apenas um processo exporta cada versão.
+    Retorna a versão exportada.
+    """
+    directory = knowledge_matrix_dir(db_path)
+    os.makedirs(directory, exist_ok=True)
+
+    with open(os.path.join(directory, '.export.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        conn = sqlite3.connect(db_path)
+        try:
+            cursor = conn.cursor()
+            # Leitura consistente: versão e chunks do mesmo snapshot
+            cursor.execute("BEGIN")
+            version = read_knowledge_version(cursor)
+            matrix_path, ids_path = knowledge_matrix_paths(db_path, version)
+            if os.path.exists(matrix_path):
+                return version
+
+            cursor.execute("SELECT COUNT(*) FROM knowledge_base")
+            row_count = cursor.fetchone()[0]
+            cursor.execute("SELECT embedding FROM knowledge_base LIMIT 1")
+            first = cursor.fetchone()
+            dim = len(decode_embedding(first[0])) if first else 0
+
+            suffix = f'.tmp.{os.getpid()}.npy'
+            ids = np.empty(row_count, dtype=np.int64)
+            matrix = np.lib.format.open_memmap(matrix_path + suffix, mode='w+',
+                                               dtype=np.float32, shape=(row_count, dim))
+            cursor.execute("SELECT id, embedding FROM knowledge_base ORDER BY id")
+            for position, (chunk_id, embedding) in enumerate(cursor):
+                vector = decode_embedding(embedding)
+                norm = np.linalg.norm(vector)
+                ids[position] = chunk_id
+                matrix[position] = vector / norm if norm else vector
+            matrix.flush()
+            del matrix
+
+            np.save(ids_path + suffix, ids)
+            os.replace(ids_path + suffix, ids_path)
+            os.replace(matrix_path + suffix, matrix_path)
+        finally:
+            conn.close()
+
+        # Remove exportações antigas (workers que ainda as usam mantêm o mapeamento válido)
+        kept_suffixes = tuple(f'_v{v}.npy' for v in range(version - keep_versions + 1, version + 1))
+        for filename in os.listdir(directory):
+            if filename.endswith('.npy') and not filename.endswith(kept_suffixes) and '.tmp.' not in filename:
+                try:
+                    os.remove(os.path.join(directory, filename))
+                except OSError:
+                    pass
+
+    print(f"Matriz de conhecimento exportada: {row_count} chunks (versão {version}).")
+    return version
+
+
+# --- QUANTIZAÇÃO (INT8 / FLOAT16) ---
+# 'none' (float32), 'float16' (metade da memória) ou 'int8' (um quarto, com escala por vetor).
+QUANTIZATION_MODE = os.getenv("RAG_QUANTIZATION", "none").lower()
+# Candidatos reavaliados em precisão total (float32) após a busca quantizada (0 desativa).
+RERANK_CANDIDATES = int(os.getenv("RAG_RERANK_CANDIDATES", 50))
+QUANTIZATION_MODES = ('none', 'float16', 'int8')
+
+
+def quantized_matrix_paths(db_path, version, mode):
+    """Caminhos (matriz, escalas) da exportação quantizada de uma versão."""
+    directory = knowledge_matrix_dir(db_path)
+    return (os.path.join(directory, f'matrix_{mode}_v{version}.npy'),
+            os.path.join(directory, f'scales_{mode}_v{version}.npy'))
+
+
+def quantize_rows(block, mode):
+    """Quantiza um bloco de linhas float32. Retorna (linhas, escalas ou None)."""
+    if mode == 'float16':
+        return block.astype(np.float16), None
+    scales = np.abs(block).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    quantized = np.clip(np.rint(block / scales[:, None]), -127, 127).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+class QuantizedMatrix:
+    """
+    Matriz de embeddings quantizada. Suporta 'matriz @ consulta' (calculado em blocos,
+    sem desquantizar a matriz inteira) e indexação de linhas (devolvidas em float32).
+    """
+
+    def __init__(self, rows, scales=None, block_size=4096):
+        self.rows = rows
+        self.scales = scales
+        self.block_size = block_size
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def __getitem__(self, positions):
+        rows = self.rows[positions].astype(np.float32)
+        if self.scales is not None:
+            rows *= self.scales[positions][..., None]
+        return rows
+
+    def __matmul__(self, query):
+        query = query.astype(np.float32)
+        scores = np.empty(len(self.rows), dtype=np.float32)
+        for start in range(0, len(self.rows), self.block_size):
+            end = start + self.block_size
+            scores[start:end] = self.rows[start:end].astype(np.float32) @ query
+        if self.scales is not None:
+            scores *= self.scales
+        return scores
+
+    @classmethod
+    def from_matrix(cls, matrix, mode, block_size=4096):
+        """Quantiza uma matriz float32 em memória (usado no benchmark)."""
+        parts = [quantize_rows(np.asarray(matrix[start:start + block_size]), mode)
+                 for start in range(0, len(matrix), block_size)]
+        rows = np.concatenate([p[0] for p in parts]) if parts else np.empty((0, 0), dtype=np.int8)
+        scales = np.concatenate([p[1] for p in parts]) if parts and mode == 'int8' else None
+        return cls(rows, scales, block_size)
+
+
+def export_quantized_matrix(db_path, version, mode, block_size=4096):
+    """
+    Gera (a partir da matriz float32 exportada) a versão quantizada, em blocos,
+    publicada de forma atómica e mapeada em memória pelos workers.
+    """
+    matrix_path, _ = knowledge_matrix_paths(db_path, version)
+    rows_path, scales_path = quantized_matrix_paths(db_path, version, mode)
+    directory = knowledge_matrix_dir(db_path)
+
+    with open(os.path.join(directory, '.export.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if os.path.exists(rows_path):
+            return
+        matrix = np.load(matrix_path, mmap_mode='r')
+        suffix = f'.tmp.{os.getpid()}.npy'
+        rows_dtype = np.float16 if mode == 'float16' else np.int8
+        rows = np.lib.format.open_memmap(rows_path + suffix, mode='w+', dtype=rows_dtype,
+                                         shape=matrix.shape if matrix.ndim == 2 else (0, 0))
+        scales = np.empty(len(matrix), dtype=np.float32)
+        for start in range(0, len(matrix), block_size):
+            block_rows, block_scales = quantize_rows(np.asarray(matrix[start:start + block_size]), mode)
+            rows[start:start + block_size] = block_rows
+            if block_scales is not None:
+                scales[start:start + block_size] = block_scales
+        rows.flush()
+        del rows
+
+        if mode == 'int8':
+            np.save(scales_path + suffix, scales)
+            os.replace(scales_path + suffix, scales_path)
+        os.replace(rows_path + suffix, rows_path)
+    print(f"Matriz quantizada ({mode}) exportada para a versão {version}.")
+
+
+def publish_knowledge_matrices(db_path, quantization=None):
+    """
+    Exporta a matriz float32 da versão atual e, com RAG_QUANTIZATION ativo, a sua
+    versão quantizada. Chamada pelo ingest_data.py e pelo migrate_embeddings.py:
+    os workers só mapeiam o que já foi exportado. Retorna a versão exportada.
+    """
+    version = export_knowledge_matrix(db_path)
+    mode = quantization or QUANTIZATION_MODE
+    if mode in ('float16', 'int8'):
+        export_quantized_matrix(db_path, version, mode)
+    return version
+
+
+def load_quantized_matrix(db_path, version, mode):
+    """
+    Mapeia a matriz quantizada de uma versão. Os workers não a exportam (é O(N)):
+    se ainda não existir, devolve None e a busca usa a matriz float32.
+    """
+    rows_path, scales_path = quantized_matrix_paths(db_path, version, mode)
+    if not os.path.exists(rows_path):
+        print(f"Aviso: Matriz {mode} da versão {version} não exportada "
+              f"(rode o ingest_data.py com RAG_QUANTIZATION={mode}). Usando float32.")
+        return None
+    rows = np.load(rows_path, mmap_mode='r')
+    scales = np.load(scales_path) if mode == 'int8' else None
+    return QuantizedMatrix(rows, scales)
+
+
+# --- ÍNDICE VETORIAL PARTILHADO ENTRE WORKERS ---
+class KnowledgeIndex:
+    """
+    Índice (um por worker) com os embeddings da base de conhecimento.
+
+    Os vetores ficam numa matriz float32 com as linhas já normalizadas, exportada
+    para um arquivo .npy e mapeada em memória só para leitura: todos os workers do
+    gunicorn partilham as mesmas páginas, e um worker novo serve RAG sem ler a tabela.
+    A similaridade de cosseno é um único produto matriz-vetor, e os textos dos
+    'top_k' chunks são lidos do banco por id.
+    O índice só é recarregado quando a versão da base de conhecimento muda.
+    Para bases grandes (>= RAG_ANN_MIN_ROWS) usa o índice IVF gerado pelo ingest_data.py.
+    Com RAG_QUANTIZATION ('float16' ou 'int8') a busca corre sobre a matriz quantizada
+    e os melhores candidatos são reavaliados em float32.
+    """
+
+    def __init__(self, db_path, use_ann=True, quantization=None):
+        self.db_path = db_path
+        self.use_ann = use_ann
+        self.quantization = quantization or QUANTIZATION_MODE
+        if self.quantization not in QUANTIZATION_MODES:
+            print(f"Aviso: RAG_QUANTIZATION '{self.quantization}' inválido. Usando 'none'.")
+            self.quantization = 'none'
+        self.version = None
+        self.ivf = None
+        # (ids, matriz float32, matriz quantizada ou None) trocados de uma só vez
+        self._data = (np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32), None)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data[0])
+
+    def _load(self, version):
+        """
+        Mapeia a matriz exportada da versão atual. Os workers nunca exportam (é O(N)):
+        se a versão ainda não foi publicada pelo ingest_data.py, usam a última exportada.
+        """
+        shared = True
+        try:
+            matrix_path, ids_path = knowledge_matrix_paths(self.db_path, version)
+            if not os.path.exists(matrix_path):
+                exported = latest_exported_version(self.db_path)
+                if exported is None:
+                    raise FileNotFoundError("nenhuma matriz exportada")
+                print(f"Aviso: Versão {version} ainda não exportada. Usando a versão {exported}.")
+                version = exported
+                matrix_path, ids_path = knowledge_matrix_paths(self.db_path, version)
+            ids = np.load(ids_path)
+            matrix = np.load(matrix_path, mmap_mode='r')
+        except Exception as e:
+            print(f"Aviso: Falha ao mapear a matriz partilhada ({e}). Carregando em memória.")
+            version, ids, matrix = self._read_from_db()
+            shared = False
+        if matrix.ndim != 2 or len(matrix) == 0:
+            matrix = np.empty((0, 0), dtype=np.float32)
+
+        quantized = None
+        if self.quantization != 'none' and len(matrix):
+            try:
+                if shared:
+                    quantized = load_quantized_matrix(self.db_path, version, self.quantization)
+                else:
+                    quantized = QuantizedMatrix.from_matrix(matrix, self.quantization)
+            except Exception as e:
+                print(f"Aviso: Falha ao preparar a matriz quantizada ({e}). Usando float32.")
+
+        self.ivf = self._load_ivf(ids, version) if self.use_ann and len(ids) >= ANN_MIN_ROWS else None
+        self._data = (ids, matrix, quantized)
+        self.version = version
+        mode = "IVF" if self.ivf is not None else "exata"
+        precision = self.quantization if quantized is not None else "float32"
+        print(f"Índice de conhecimento mapeado: {len(ids)} chunks (versão {version}, busca {mode}, {precision}).")
+
+    def _read_from_db(self):
+        """Carrega a matriz normalizada diretamente do banco (só para este processo)."""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN")
+            version = read_knowledge_version(cursor)
+            cursor.execute("SELECT id, embedding FROM knowledge_base ORDER BY id")
+            ids, vectors = [], []
+            for chunk_id, embedding in cursor:
+                ids.append(chunk_id)
+                vectors.append(decode_embedding(embedding))
+        finally:
+            conn.close()
+
+        if not vectors:
+            return version, np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32)
+        matrix = np.vstack(vectors).astype(np.float32, copy=False)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        matrix /= norms
+        return version, np.asarray(ids, dtype=np.int64), np.ascontiguousarray(matrix)
+
+    def _load_ivf(self, ids, version):
+        """Carrega o índice IVF persistido, se corresponder à versão atual."""
+        path = ivf_index_path(self.db_path)
+        if not os.path.exists(path):
+            print("Aviso: Índice IVF não encontrado. Usando busca exata.")
+            return None
+        try:
+            ivf = IVFIndex.load(path)
+        except Exception as e:
+            print(f"Aviso: Falha ao carregar índice IVF ({e}). Usando busca exata.")
+            return None
+        if not ivf.matches(ids, version):
+            print("Aviso: Índice IVF desatualizado. Rode o ingest_data.py novamente. Usando busca exata.")
+            return None
+        return ivf
+
+    def refresh(self):
+        """Recarrega o índice apenas se a versão da base de conhecimento mudou."""
+        version = read_knowledge_version(get_connection(self.db_path).cursor())
+        if version == self.version:
+            return
+        # Durante uma ingestão a versão muda a cada lote; a nova matriz só é
+        # mapeada quando o ingest_data.py a publicar
+        if self.version is not None and not os.path.exists(knowledge_matrix_paths(self.db_path, version)[0]):
+            return
+        with self._lock:
+            if version != self.version:
+                self._load(version)
+
+    def _fetch_texts(self, chunk_ids):
+        """Lê do banco o texto dos chunks indicados."""
+        placeholders = ",".join("?" * len(chunk_ids))
+        cursor = get_connection(self.db_path).cursor()
+        cursor.execute(f"SELECT id, text_chunk FROM knowledge_base WHERE id IN ({placeholders})",
+                       [int(chunk_id) for chunk_id in chunk_ids])
+        return dict(cursor.fetchall())
+
+    def search_positions(self, query_vector, top_k=3):
+        """
+        Devolve (posições, similaridades) dos 'top_k' chunks mais próximos,
+        por ordem decrescente de similaridade.
+        """
+        _, matrix, quantized = self._data
+        empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))
+        if len(matrix) == 0:
+            return empty
+
+        query = np.asarray(query_vector, dtype=np.float32)
+        query_norm = np.linalg.norm(query)
+        if query_norm == 0:
+            return empty
+        query = query / query_norm
+
+        # Com quantização, busca mais candidatos na matriz compacta e reavalia em float32
+        scoring_matrix = quantized if quantized is not None else matrix
+        n_candidates = max(top_k, RERANK_CANDIDATES) if quantized is not None and RERANK_CANDIDATES else top_k
+
+        ivf = self.ivf
+        if ivf is not None:
+            positions, scores = ivf.search(scoring_matrix, query, n_candidates)
+        else:
+            scores = scoring_matrix @ query
+            k = min(n_candidates, len(scores))
+            if k < len(scores):
+                candidates = np.argpartition(scores, -k)[-k:]
+            else:
+                candidates = np.arange(len(scores))
+            positions = candidates[np.argsort(scores[candidates])[::-1]]
+            scores = scores[positions]
+
+        if quantized is not None and RERANK_CANDIDATES and len(positions):
+            order = np.sort(positions)
+            exact = np.asarray(matrix[order]) @ query
+            best = np.argsort(exact)[::-1][:top_k]
+            return order[best], exact[best]
+        return positions[:top_k], scores[:top_k]
+
+    def search(self, query_vector, top_k=3):
+        """
+        Devolve uma lista de (similaridade, id do chunk, texto) com os 'top_k' chunks mais próximos.
+        """
+        ids = self._data[0]
+        positions, scores = self.search_positions(query_vector, top_k)
+        if len(positions) == 0:
+            return []
+        chunk_ids = ids[positions]
+        texts = self._fetch_texts(chunk_ids)
+        # Chunks apagados entretanto (reingestão em curso) são ignorados
+        return [(float(score), int(chunk_id), texts[int(chunk_id)])
+                for chunk_id, score in zip(chunk_ids, scores) if int(chunk_id) in texts]
+
+
+def build_ann_index(db_path, n_clusters=None):
+    """
+    Constrói e grava o índice IVF para a versão atual da base de conhecimento.
+    Para bases pequenas remove o arquivo, já que a busca exata será usada.
+    """
+    index = KnowledgeIndex(db_path, use_ann=False, quantization='none')
+    index.refresh()
+    ids, matrix, _ = index._data
+    path = ivf_index_path(db_path)
+    if len(ids) < ANN_MIN_ROWS:
+        if os.path.exists(path):
+            os.remove(path)
+        print(f"Base com {len(ids)} chunks (< {ANN_MIN_ROWS}): busca exata, índice IVF não necessário.")
+        return None
+
+    if os.path.exists(path):
+        try:
+            if IVFIndex.load(path).matches(ids, index.version):
+                print("Índice IVF já está atualizado.")
+                return None
+        except Exception:
+            pass
+
+    start = time.time()
+    ivf = IVFIndex.build(matrix, ids, index.version, n_clusters=n_clusters)
+    ivf.save(path)
+    print(f"Índice IVF com {len(ivf.centroids)} clusters gravado em '{path}' ({time.time() - start:.1f}s).")
+    return ivf
+
+
+# --- BENCHMARK DA QUANTIZAÇÃO ---
+def print_quantization_report(db_path, k=3, n_queries=200, rerank_candidates=50):
+    """
+    Compara float32, float16 e int8 no corpus atual: memória usada (e projeção para
+    1 milhão de chunks), recall@k face à busca exata em float32, com e sem reavaliação.
+    """
+    from ann_index import sample_test_queries
+
+    index = KnowledgeIndex(db_path, use_ann=False, quantization='none')
+    index.refresh()
+    ids, matrix, _ = index._data
+    if len(ids) == 0:
+        print("Base de conhecimento vazia. Nada para avaliar.")
+        return
+
+    matrix = np.asarray(matrix)
+    queries = sample_test_queries(matrix, n_queries)
+    exact_top = [set(np.argsort(matrix @ q)[::-1][:k].tolist()) for q in queries]
+    dim = matrix.shape[1]
+
+    print(f"\n--- Quantização: {len(matrix)} chunks de dimensão {dim}, recall@{k} ---")
+    print(f"{'modo':<8} {'memória':>12} {'1M chunks':>11} {'recall':>8} {'recall+rerank':>14} {'latência':>10}")
+    for mode in QUANTIZATION_MODES:
+        if mode == 'none':
+            scoring, nbytes = matrix, matrix.nbytes
+        else:
+            scoring = QuantizedMatrix.from_matrix(matrix, mode)
+            nbytes = scoring.nbytes
+        hits, hits_rerank, elapsed = 0, 0, 0.0
+        for query, exact in zip(queries, exact_top):
+            start = time.perf_counter()
+            scores = scoring @ query
+            candidates = np.argpartition(scores, -rerank_candidates)[-rerank_candidates:] \
+                if rerank_candidates < len(scores) else np.arange(len(scores))
+            elapsed += time.perf_counter() - start
+            approx = candidates[np.argsort(scores[candidates])[::-1][:k]]
+            reranked = candidates[np.argsort(matrix[candidates] @ query)[::-1][:k]]
+            hits += len(exact.intersection(approx.tolist()))
+            hits_rerank += len(exact.intersection(reranked.tolist()))
+        per_million_gb = nbytes / len(matrix) * 1_000_000 / 1024 ** 3
+        print(f"{mode:<8} {nbytes / 1024 ** 2:>10.1f}MB {per_million_gb:>9.2f}GB "
+              f"{hits / (k * len(queries)):>8.3f} {hits_rerank / (k * len(queries)):>14.3f} "
+              f"{1000 * elapsed / len(queries):>8.3f}ms")
+
+
+if __name__ == "__main__":
+    import sys
+    from database_manager import DB_PATH
+    print_quantization_report(sys.argv[1] if len(sys.argv) > 1 else DB_PATH)
@@ -0,0 +1,90 @@
+# message_dedup.py
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from db_connection import get_connection
+
+# --- CONFIGURAÇÕES DA DEDUPLICAÇÃO ---
+# Durante quanto tempo um ID de mensagem já visto é tratado como repetição
+MESSAGE_DEDUP_TTL_SECONDS = int(os.getenv("MESSAGE_DEDUP_TTL_SECONDS", 24 * 3600))
+# IDs recentes guardados em memória (por worker) para evitar a ida ao banco
+MESSAGE_DEDUP_CACHE_SIZE = int(os.getenv("MESSAGE_DEDUP_CACHE_SIZE", 10000))
+# Intervalo entre limpezas dos IDs expirados na tabela processed_messages
+MESSAGE_DEDUP_PURGE_SECONDS = 3600
+
+
+class MessageDedup:
+    """
+    Deduplicação dos webhooks pelo ID da mensagem (key.id do 'messages.upsert').
+
+    A Evolution API reenvia o webhook quando a resposta demora; mark_new() diz se o
+    ID é novo. Um LRU em memória responde às repetições recentes sem tocar no banco;
+    a tabela processed_messages (partilhada pelos workers) é a fonte de verdade,
+    e um ID volta a ser aceite depois de 'ttl_seconds'.
+    """
+
+    def __init__(self, db_path, max_entries=MESSAGE_DEDUP_CACHE_SIZE, ttl_seconds=MESSAGE_DEDUP_TTL_SECONDS):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.duplicates = 0
+        self.purged_at = 0.0
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, message_id, seen_at):
+        with self._lock:
+            self._seen[message_id] = seen_at
+            self._seen.move_to_end(message_id)
+            while len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+
+    def mark_new(self, message_id):
+        """
+        Regista o ID como processado. Retorna True se for a primeira vez (dentro do TTL)
+        e False se for uma repetição.
+        """
+        now = time.time()
+        with self._lock:
+            seen_at = self._seen.get(message_id)
+            if seen_at is not None and now - seen_at < self.ttl_seconds:
+                self._seen.move_to_end(message_id)
+                self.duplicates += 1
+                return False
+
+        conn = get_connection(self.db_path)
+        with conn:
+            # Só insere (ou renova um ID expirado); rowcount 0 quer dizer repetição
+            cursor = conn.execute(
+                """INSERT INTO processed_messages (message_id, seen_at) VALUES (?, ?)
+                   ON CONFLICT(message_id) DO UPDATE SET seen_at = excluded.seen_at
+                   WHERE processed_messages.seen_at < ?""",
+                (message_id, now, now - self.ttl_seconds)
+            )
+            is_new = cursor.rowcount > 0
+            if is_new and now - self.purged_at > MESSAGE_DEDUP_PURGE_SECONDS:
+                self.purged_at = now
+                conn.execute("DELETE FROM processed_messages WHERE seen_at < ?", (now - self.ttl_seconds,))
+
+        if not is_new:
+            with self._lock:
+                self.duplicates += 1
+        self._remember(message_id, now)
+        return is_new
+
+    def forget(self, message_id):
+        """Desfaz mark_new() quando a mensagem não chegou a ser enfileirada (o reenvio deve ser aceite)."""
+        with self._lock:
+            self._seen.pop(message_id, None)
+        conn = get_connection(self.db_path)
+        with conn:
+            conn.execute("DELETE FROM processed_messages WHERE message_id = ?", (message_id,))
+
+    def stats(self):
+        return {
+            "entries": len(self._seen),
+            "duplicates": self.duplicates,
+            "ttl_seconds": self.ttl_seconds,
+        }
@@ -0,0 +1,13 @@
+# migrate_embeddings.py
+
+from database_manager import initialize_database, migrate_embeddings_to_binary, DB_PATH
+from knowledge_index import publish_knowledge_matrices
+
+# Conversão única dos embeddings antigos (JSON) para o formato binário float32.
+# O chatbot lê os dois formatos, portanto pode ser executado com o serviço no ar.
+if __name__ == "__main__":
+    print(f"Migrando embeddings em: {DB_PATH}")
+    initialize_database()
+    migrate_embeddings_to_binary()
+    # Publica a nova versão para os workers (eles não exportam as matrizes)
+    publish_knowledge_matrices(DB_PATH)
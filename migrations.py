@@ -0,0 +1,240 @@
+# migrations.py
+
+import time
+from db_connection import get_connection
+
+# O número da versão do esquema fica no cabeçalho do próprio arquivo (PRAGMA user_version).
+
+
+def _add_column_if_missing(cursor, table, column, declaration):
+    """ALTER TABLE ... ADD COLUMN apenas se a coluna ainda não existir (bancos anteriores às migrações)."""
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+
+# --- MIGRAÇÕES ---
+# Cada migração recebe o cursor da transação e nunca é alterada depois de publicada:
+# mudanças novas entram como uma nova função no fim da lista MIGRATIONS.
+
+def _001_base_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS knowledge_base (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text_chunk TEXT NOT NULL,
+            embedding BLOB NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            number TEXT PRIMARY KEY,
+            name TEXT,
+            status TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_number TEXT,
+            role TEXT,
+            message TEXT,
+            timestamp INTEGER
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_user_number_timestamp
+        ON chat_history (user_number, timestamp)
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS received_files (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id TEXT UNIQUE,
+            user_number TEXT,
+            file_path TEXT,
+            mime_type TEXT,
+            caption TEXT,
+            timestamp INTEGER
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_file_user_number
+        ON received_files (user_number)
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+    # Define o modo padrão como 'standard' na primeira vez
+    cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('chatbot_mode', 'standard')")
+
+
+def _002_users_pending_file(cursor):
+    _add_column_if_missing(cursor, 'users', 'pending_file_path', 'TEXT')
+
+
+def _003_incremental_ingestion(cursor):
+    _add_column_if_missing(cursor, 'knowledge_base', 'document', 'TEXT')
+    _add_column_if_missing(cursor, 'knowledge_base', 'chunk_hash', 'TEXT')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_knowledge_document_hash
+        ON knowledge_base (document, chunk_hash)
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS knowledge_documents (
+            document TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            chunk_count INTEGER,
+            ingested_at INTEGER
+        )
+    ''')
+
+
+def _004_query_embedding_cache(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS query_embedding_cache (
+            cache_key TEXT PRIMARY KEY,
+            model TEXT,
+            embedding BLOB NOT NULL,
+            created_at INTEGER
+        )
+    ''')
+
+
+def _005_chat_summaries(cursor):
+    # Resumo acumulado das mensagens já arquivadas (history_retention.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            user_number TEXT PRIMARY KEY,
+            summary TEXT,
+            summarized_until INTEGER,
+            message_count INTEGER,
+            updated_at INTEGER
+        )
+    ''')
+
+
+def _006_webhook_jobs(cursor):
+    # Fila durável dos webhooks (job_queue.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS webhook_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender TEXT,
+            message_id TEXT,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            available_at REAL,
+            lease_until REAL,
+            last_error TEXT,
+            created_at REAL,
+            updated_at REAL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_webhook_jobs_status
+        ON webhook_jobs (status, available_at)
+    ''')
+
+
+def _007_webhook_jobs_sender(cursor):
+    # Ordem por remetente: procura de jobs anteriores ainda ativos do mesmo remetente
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_webhook_jobs_sender
+        ON webhook_jobs (sender, status, id)
+    ''')
+
+
+def _008_webhook_jobs_coalescible(cursor):
+    # Jobs de texto que podem receber as mensagens seguintes do mesmo remetente
+    _add_column_if_missing(cursor, 'webhook_jobs', 'coalescible', 'INTEGER NOT NULL DEFAULT 0')
+
+
+def _009_processed_messages(cursor):
+    # IDs de mensagens já recebidas pelo webhook (message_dedup.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS processed_messages (
+            message_id TEXT PRIMARY KEY,
+            seen_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_processed_messages_seen_at
+        ON processed_messages (seen_at)
+    ''')
+
+
+def _010_webhook_jobs_claim_token(cursor):
+    # Token do lease: só quem reclamou o job o pode renovar, concluir ou devolver à fila
+    _add_column_if_missing(cursor, 'webhook_jobs', 'claim_token', 'TEXT')
+
+
+def _011_webhook_jobs_steps(cursor):
+    # Etapas já feitas pelo job (ex: mensagem gravada, resposta enviada), saltadas numa nova tentativa
+    _add_column_if_missing(cursor, 'webhook_jobs', 'steps', 'TEXT')
+
+
+def _012_chat_history_user_id(cursor):
+    # Páginas do /view-db filtradas por utilizador (WHERE user_number = ? ORDER BY id).
+    # Em received_files, idx_file_user_number já serve: o índice inclui o rowid (id).
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_history_user_id
+        ON chat_history (user_number, id)
+    ''')
+
+
+MIGRATIONS = [
+    (1, "tabelas base (knowledge_base, users, chat_history, received_files, settings)", _001_base_tables),
+    (2, "users.pending_file_path", _002_users_pending_file),
+    (3, "ingestão incremental (knowledge_base.document/chunk_hash, knowledge_documents)", _003_incremental_ingestion),
+    (4, "cache persistente de embeddings de consultas", _004_query_embedding_cache),
+    (5, "resumos do histórico arquivado (chat_summaries)", _005_chat_summaries),
+    (6, "fila de webhooks (webhook_jobs)", _006_webhook_jobs),
+    (7, "índice por remetente da fila de webhooks", _007_webhook_jobs_sender),
+    (8, "webhook_jobs.coalescible (agrupamento de mensagens)", _008_webhook_jobs_coalescible),
+    (9, "deduplicação de mensagens do webhook (processed_messages)", _009_processed_messages),
+    (10, "webhook_jobs.claim_token (lease dos jobs)", _010_webhook_jobs_claim_token),
+    (11, "webhook_jobs.steps (jobs idempotentes)", _011_webhook_jobs_steps),
+    (12, "índice por utilizador e id do chat_history (paginação do /view-db)", _012_chat_history_user_id),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(db_path):
+    """
+    Leva o banco até SCHEMA_VERSION. Quando o esquema já está atualizado custa
+    uma única leitura. Caso contrário, as migrações pendentes correm numa
+    transação BEGIN IMMEDIATE: só um worker as aplica, os outros esperam pelo
+    lock (busy_timeout) e depois encontram a versão já atualizada.
+    Retorna a versão final do esquema.
+    """
+    conn = get_connection(db_path)
+    if get_schema_version(conn) >= SCHEMA_VERSION:
+        return SCHEMA_VERSION
+
+    start_time = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        current = get_schema_version(conn)
+        applied = 0
+        cursor = conn.cursor()
+        for version, description, apply in MIGRATIONS:
+            if version <= current:
+                continue
+            print(f"Aplicando migração {version}: {description}...")
+            apply(cursor)
+            cursor.execute(f"PRAGMA user_version = {version}")
+            current = version
+            applied += 1
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    if applied:
+        print(f"Esquema do banco de dados atualizado para a versão {current} ({time.time() - start_time:.2f}s).")
+    return current
@@ -0,0 +1,86 @@
+# prompt_budget.py
+
+import os
+
+# Limite de tokens do pedido ao Gemini: persona (com o contexto RAG) + histórico + mensagem
+GEMINI_PROMPT_TOKEN_BUDGET = int(os.getenv("GEMINI_PROMPT_TOKEN_BUDGET", 8000))
+# Abaixo deste espaço livre não vale a pena incluir uma mensagem truncada
+MIN_TRUNCATED_TOKENS = 64
+# Estimativa local (sem chamada à API): ~4 caracteres por token em português
+CHARS_PER_TOKEN = 4
+TRUNCATION_MARKER = " [...]"
+# Início da mensagem com o resumo do histórico arquivado (database_manager._with_summary)
+SUMMARY_PREFIX = "[Resumo da conversa anterior]"
+
+
+def estimate_tokens(text):
+    """Estimativa rápida do número de tokens de um texto."""
+    if not text:
+        return 0
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def _message_text(entry):
+    return "".join(part for part in entry.get('parts', []) if isinstance(part, str))
+
+
+def _split_summary(history_list):
+    """Separa o par (resumo, confirmação) do início do histórico das mensagens recentes."""
+    if (len(history_list) >= 2 and history_list[0]['role'] == 'user'
+            and _message_text(history_list[0]).startswith(SUMMARY_PREFIX)
+            and history_list[1]['role'] == 'model'):
+        return history_list[:2], history_list[2:]
+    return [], history_list
+
+
+def fit_history_to_budget(history_list, system_instruction, user_message, budget=None):
+    """
+    Seleciona o histórico que cabe no orçamento de tokens, depois de descontar a
+    persona e a mensagem atual. O resumo do histórico arquivado é sempre mantido
+    (os seus tokens são reservados primeiro). Nas mensagens recentes, percorre das
+    mais novas para as mais antigas: as antigas são descartadas primeiro e a última
+    que couber em parte é truncada.
+    Retorna (histórico, relatório com os tokens usados).
+    """
+    budget = budget or GEMINI_PROMPT_TOKEN_BUDGET
+    system_tokens = estimate_tokens(system_instruction)
+    message_tokens = estimate_tokens(user_message)
+    summary, live_history = _split_summary(history_list or [])
+    summary_tokens = sum(estimate_tokens(_message_text(entry)) for entry in summary)
+    remaining = budget - system_tokens - message_tokens - summary_tokens
+
+    kept = []
+    truncated = 0
+    for entry in reversed(live_history):
+        text = _message_text(entry)
+        tokens = estimate_tokens(text)
+        if tokens <= remaining:
+            kept.append(entry)
+            remaining -= tokens
+            continue
+        if remaining >= MIN_TRUNCATED_TOKENS:
+            max_chars = (remaining - estimate_tokens(TRUNCATION_MARKER)) * CHARS_PER_TOKEN
+            kept.append({"role": entry['role'], "parts": [text[:max_chars] + TRUNCATION_MARKER]})
+            remaining -= estimate_tokens(kept[-1]['parts'][0])
+            truncated = 1
+        break
+    kept.reverse()
+
+    # O histórico deve começar por uma mensagem do utilizador (depois do resumo)
+    while kept and kept[0]['role'] != 'user':
+        remaining += estimate_tokens(_message_text(kept.pop(0)))
+    kept = summary + kept
+
+    history_tokens = sum(estimate_tokens(_message_text(entry)) for entry in kept)
+    report = {
+        "budget": budget,
+        "system_tokens": system_tokens,
+        "message_tokens": message_tokens,
+        "summary_tokens": summary_tokens,
+        "history_tokens": history_tokens,
+        "total_tokens": system_tokens + message_tokens + history_tokens,
+        "kept_messages": len(kept),
+        "dropped_messages": len(history_list or []) - len(kept),
+        "truncated_messages": truncated,
+    }
+    return kept, report
@@ -0,0 +1,41 @@
+# rate_limiter.py
+
+import time
+import threading
+
+
+class TokenBucket:
+    """
+    Limitador 'token bucket': permite até 'rate_per_minute' operações por minuto,
+    com rajadas de até 'capacity' operações.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate_per_second = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else max(1, rate_per_minute // 60)
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated_at
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate_per_second)
+        self.updated_at = now
+
+    def acquire(self, tokens=1):
+        """Bloqueia até existirem 'tokens' disponíveis e consome-os."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate_per_second
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Esvazia o balde (ex: após um 429) para que os próximos pedidos aguardem."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, 0) - seconds * self.rate_per_second
@@ -0,0 +1,61 @@
+# retrieval_cache.py
+
+import threading
+from collections import OrderedDict
+from embedding_cache import normalize_query
+
+
+class RetrievalCache:
+    """
+    Cache LRU do resultado completo da recuperação RAG: consulta normalizada ->
+    ids dos chunks e bloco de contexto já formatado.
+
+    Cada entrada guarda a versão da base de conhecimento em que foi calculada;
+    quando a ingestão incrementa a versão, as entradas antigas deixam de valer.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, query, top_k):
+        return (normalize_query(query), top_k)
+
+    def get(self, query, version, top_k=3):
+        """Devolve (ids dos chunks, contexto) ou None se não estiver em cache."""
+        with self._lock:
+            if version != self.version:
+                # Nova versão da base: todo o conteúdo anterior fica inválido
+                self._entries.clear()
+                self.version = version
+            entry = self._entries.get(self._key(query, top_k))
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(self._key(query, top_k))
+            self.hits += 1
+            return entry
+
+    def put(self, query, version, chunk_ids, context, top_k=3):
+        with self._lock:
+            if version != self.version:
+                return
+            key = self._key(query, top_k)
+            self._entries[key] = (list(chunk_ids), context)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "knowledge_version": self.version,
+        }
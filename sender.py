@@ -10,9 +10,18 @@ CHATBOT_URL = "http://localhost:5001"
 def send_to_specific_users():
     """Busca a lista de utilizadores, permite a seleção e envia uma mensagem."""
     try:
-        response = requests.get(f"{CHATBOT_URL}/get-users")
-        response.raise_for_status()
-        users = response.json()
+        users = {}
+        cursor = None
+        while True:
+            # Com 'limit' o /get-users responde por páginas ({"users", "next_cursor"})
+            params = {"limit": 500, "cursor": cursor} if cursor else {"limit": 500}
+            response = requests.get(f"{CHATBOT_URL}/get-users", params=params)
+            response.raise_for_status()
+            page = response.json()
+            users.update(page.get("users", {}))
+            cursor = page.get("next_cursor")
+            if not cursor:
+                break
         if not users:
             print("Nenhum utilizador encontrado na base de dados.")
             return
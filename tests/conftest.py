@@ -0,0 +1,30 @@
+# conftest.py
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_connection import close_connection, get_connection
+from migrations import migrate
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    """Banco temporário já com o esquema atual (migrations.py)."""
+    path = str(tmp_path / "users.db")
+    migrate(path)
+    yield path
+    close_connection(path)
+
+
+@pytest.fixture
+def update_job(db_path):
+    """Altera colunas de um job diretamente no banco (ex: expirar o lease sem esperar)."""
+    def update(job_id, **columns):
+        assignments = ", ".join(f"{column} = ?" for column in columns)
+        conn = get_connection(db_path)
+        with conn:
+            conn.execute(f"UPDATE webhook_jobs SET {assignments} WHERE id = ?", list(columns.values()) + [job_id])
+    return update
@@ -0,0 +1,40 @@
+# test_history_writer.py
+
+import sqlite3
+import pytest
+
+from db_connection import get_connection
+from history_writer import HistoryWriter
+
+
+def rename_history_table(db_path, old, new):
+    conn = get_connection(db_path)
+    with conn:
+        conn.execute(f"ALTER TABLE {old} RENAME TO {new}")
+
+
+def test_failed_flush_keeps_the_rows_pending(db_path):
+    writer = HistoryWriter(db_path, flush_seconds=3600)
+    writer.append("5511@s", "user", "olá")
+    rename_history_table(db_path, "chat_history", "chat_history_off")
+
+    assert writer.flush() == 0
+    assert writer.stats()["pending"] == 1
+
+    rename_history_table(db_path, "chat_history_off", "chat_history")
+    assert writer.flush() == 1
+
+
+def test_flush_can_raise_for_the_job_path(db_path):
+    writer = HistoryWriter(db_path, flush_seconds=3600)
+    writer.append("5511@s", "user", "olá")
+    rename_history_table(db_path, "chat_history", "chat_history_off")
+
+    with pytest.raises(sqlite3.OperationalError):
+        writer.flush(raise_errors=True)
+    assert writer.stats()["pending"] == 1
+
+    rename_history_table(db_path, "chat_history_off", "chat_history")
+    assert writer.flush(raise_errors=True) == 1
+    count = get_connection(db_path).execute("SELECT COUNT(*) FROM chat_history").fetchone()[0]
+    assert count == 1
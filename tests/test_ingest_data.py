@@ -0,0 +1,89 @@
+# test_ingest_data.py
+
+import os
+import random
+import pytest
+
+pytest.importorskip("google.generativeai")
+pytest.importorskip("PyPDF2")
+# O módulo exige a chave ao ser importado; genai.configure só a guarda e o teste não chama a API
+os.environ.setdefault("GOOGLE_API_KEY", "chave-de-teste")
+from ingest_data import iter_text_chunks
+
+
+def baseline_split_text_into_chunks(text, max_chars=1000, overlap=100):
+    """Chunker original (lista, com o texto completo em memória): referência para iter_text_chunks."""
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = start + max_chars
+        best_end = text.rfind('\n\n', start, end)
+        if best_end == -1 or best_end < start + (max_chars * 0.5):
+            best_end = text.rfind('\n', start, end)
+            if best_end == -1 or best_end < start + (max_chars * 0.5):
+                best_end = text.rfind(' ', start, end)
+                if best_end == -1 or best_end < start + (max_chars * 0.5):
+                    best_end = end if end <= len(text) else len(text)
+
+        chunk = text[start:best_end].strip()
+        if chunk:
+            chunks.append(chunk)
+
+        if best_end == len(text):
+            break
+
+        start = best_end + 1 - overlap
+        if start < 0 or start >= len(text):
+            break
+
+    return chunks
+
+
+def make_pages(count=12, seed=42):
+    """Páginas com parágrafos, linhas curtas e uma palavra longa sem espaços (força um corte a meio)."""
+    rng = random.Random(seed)
+    words = ["conta", "crédito", "juros", "cartão", "transferência", "poupança", "taxa", "de", "o", "a"]
+    pages = []
+    for number in range(1, count + 1):
+        paragraphs = []
+        for _ in range(rng.randint(2, 5)):
+            lines = [" ".join(rng.choice(words) for _ in range(rng.randint(3, 25))) for _ in range(rng.randint(1, 4))]
+            paragraphs.append("\n".join(lines))
+        if number % 5 == 0:
+            paragraphs.append("x" * 400)
+        pages.append(f"Página {number}.\n" + "\n\n".join(paragraphs) + f"\nfim da página {number}")
+    return pages
+
+
+def page_pieces(pages):
+    """As páginas como iter_pdf_pages as entrega: uma quebra de linha entre páginas."""
+    for index, page in enumerate(pages):
+        if index:
+            yield "\n"
+        yield page
+
+
+@pytest.mark.parametrize("max_chars, overlap", [(1000, 100), (300, 50), (120, 30)])
+def test_streaming_chunks_match_the_baseline(max_chars, overlap):
+    pages = make_pages()
+    expected = baseline_split_text_into_chunks("\n".join(pages), max_chars, overlap)
+    assert list(iter_text_chunks(page_pieces(pages), max_chars, overlap)) == expected
+
+
+@pytest.mark.parametrize("piece_size", [1, 7, 4096])
+def test_piece_size_does_not_change_the_chunks(piece_size):
+    text = "\n".join(make_pages(seed=7))
+    pieces = [text[i:i + piece_size] for i in range(0, len(text), piece_size)]
+    assert list(iter_text_chunks(pieces, 300, 50)) == baseline_split_text_into_chunks(text, 300, 50)
+
+
+def test_chunks_overlap_across_page_boundaries():
+    pages = make_pages()
+    chunks = list(iter_text_chunks(page_pieces(pages), 300, 100))
+
+    # Algum chunk junta o fim de uma página com o início da seguinte
+    assert any(f"fim da página {n}" in chunk and f"Página {n + 1}." in chunk
+               for chunk in chunks for n in range(1, len(pages)))
+    # Cada chunk começa com texto que já estava no fim do anterior
+    for previous, current in zip(chunks, chunks[1:]):
+        assert current[:20] in previous
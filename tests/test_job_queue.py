@@ -0,0 +1,105 @@
+# test_job_queue.py
+
+import pytest
+from job_queue import JobQueue, LeaseLost, JOB_PENDING, JOB_PROCESSING, JOB_DONE, JOB_DEAD
+
+
+def test_claim_takes_a_lease(db_path):
+    queue = JobQueue(db_path)
+    job_id = queue.enqueue("a@s", "m1", {"n": 1})
+
+    job = queue.claim()
+    assert job.id == job_id
+    assert job.payload == {"n": 1}
+    assert job.attempts == 1
+    assert job.token
+    # O job está em processamento: nenhum worker o pode reclamar outra vez
+    assert JobQueue(db_path).claim() is None
+    assert queue.stats()[JOB_PROCESSING] == 1
+
+    assert queue.complete(job)
+    assert queue.stats()[JOB_DONE] == 1
+
+
+def test_expired_lease_is_reclaimed_and_the_old_owner_is_fenced(db_path, update_job):
+    queue = JobQueue(db_path)
+    queue.enqueue("a@s", "m1", {})
+    stale = queue.claim()
+    update_job(stale.id, lease_until=0)
+
+    fresh = JobQueue(db_path).claim()
+    assert fresh.id == stale.id
+    assert fresh.attempts == 2
+    assert fresh.token != stale.token
+
+    # O dono antigo já não conclui, não falha, nem regista etapas do job retomado
+    assert not queue.complete(stale)
+    assert not queue.fail(stale, RuntimeError("tarde demais"))
+    with pytest.raises(LeaseLost):
+        queue.mark_step(stale, "reply")
+    assert queue.stats()[JOB_PROCESSING] == 1
+
+    assert queue.complete(fresh)
+    assert queue.stats()[JOB_DONE] == 1
+
+
+def test_renewed_lease_is_not_reclaimed(db_path, update_job):
+    queue = JobQueue(db_path)
+    queue.enqueue("a@s", "m1", {})
+    job = queue.claim()
+    update_job(job.id, lease_until=0)
+
+    assert queue.renew_lease(job)
+    assert JobQueue(db_path).claim() is None
+
+
+def test_failed_job_is_retried_after_backoff(db_path, update_job):
+    queue = JobQueue(db_path)
+    queue.enqueue("a@s", "m1", {})
+    job = queue.claim()
+
+    assert queue.fail(job, RuntimeError("Evolution API indisponível"))
+    assert queue.stats()[JOB_PENDING] == 1
+    # Ainda dentro da espera exponencial
+    assert queue.claim() is None
+
+    update_job(job.id, available_at=0)
+    retry = queue.claim()
+    assert retry.id == job.id
+    assert retry.attempts == 2
+
+
+def test_job_goes_to_dead_letter_after_max_attempts_and_can_be_requeued(db_path, update_job):
+    queue = JobQueue(db_path, max_attempts=2)
+    queue.enqueue("a@s", "m1", {})
+    for _ in range(2):
+        job = queue.claim()
+        queue.fail(job, RuntimeError("erro"))
+        update_job(job.id, available_at=0)
+
+    assert queue.stats()[JOB_DEAD] == 1
+    assert queue.claim() is None
+
+    assert queue.requeue_dead() == 1
+    assert queue.claim().attempts == 1
+
+
+def test_steps_survive_a_retry(db_path, update_job):
+    queue = JobQueue(db_path)
+    queue.enqueue("a@s", "m1", {})
+    job = queue.claim()
+    queue.mark_step(job, "user_turn")
+    queue.fail(job, RuntimeError("erro"))
+    update_job(job.id, available_at=0)
+
+    assert queue.claim().steps == {"user_turn"}
+
+
+def test_release_leased_returns_running_jobs_to_the_queue(db_path):
+    queue = JobQueue(db_path)
+    queue.enqueue("a@s", "m1", {})
+    job = queue.claim()
+
+    assert queue.release_leased() == 1
+    assert not queue.complete(job)
+    assert JobQueue(db_path).claim().id == job.id
@@ -0,0 +1,64 @@
+# test_job_queue_coalescing.py
+
+import time
+from job_queue import JobQueue
+
+
+def merge_texts(previous, new):
+    previous["texts"] = previous["texts"] + new["texts"]
+    return previous
+
+
+def enqueue_text(queue, sender, message_id, text, coalesce_seconds=5):
+    return queue.enqueue(sender, message_id, {"message_id": message_id, "texts": [text]},
+                         coalesce_seconds=coalesce_seconds, merge=merge_texts)
+
+
+def test_text_messages_within_the_window_become_one_job(db_path, update_job):
+    queue = JobQueue(db_path)
+    first = enqueue_text(queue, "a@s", "m1", "Olá")
+    second = enqueue_text(queue, "a@s", "m2", "quero abrir uma conta")
+
+    assert second == first
+    assert queue.coalesced == 1
+    # O job só fica disponível quando a janela acaba
+    assert queue.claim() is None
+
+    update_job(first, available_at=0)
+    job = queue.claim()
+    assert job.payload["texts"] == ["Olá", "quero abrir uma conta"]
+    assert queue.claim() is None
+
+
+def test_media_is_never_merged(db_path):
+    queue = JobQueue(db_path)
+    text_job = enqueue_text(queue, "a@s", "m1", "Segue o comprovativo")
+    media_job = queue.enqueue("a@s", "m2", {"message_id": "m2"})
+    # Um texto depois da mídia também não se junta à mídia
+    last_job = enqueue_text(queue, "a@s", "m3", "obrigado")
+
+    assert len({text_job, media_job, last_job}) == 3
+    assert queue.coalesced == 0
+
+
+def test_claimed_job_does_not_receive_new_messages(db_path, update_job):
+    queue = JobQueue(db_path)
+    first = enqueue_text(queue, "a@s", "m1", "Olá")
+    update_job(first, available_at=0)
+    job = queue.claim()
+
+    second = enqueue_text(queue, "a@s", "m2", "ainda aí?")
+    assert second != first
+    assert job.payload["texts"] == ["Olá"]
+
+
+def test_window_is_capped_since_the_first_message(db_path, update_job):
+    queue = JobQueue(db_path)
+    first = enqueue_text(queue, "a@s", "m1", "1")
+    # Primeira mensagem criada há muito tempo: a janela prolongada não passa do máximo
+    update_job(first, created_at=time.time() - 3600)
+    enqueue_text(queue, "a@s", "m2", "2")
+
+    job = queue.claim()
+    assert job.id == first
+    assert job.payload["texts"] == ["1", "2"]
@@ -0,0 +1,60 @@
+# test_job_queue_ordering.py
+
+from job_queue import JobQueue
+
+
+def test_same_sender_waits_while_another_sender_proceeds(db_path):
+    queue = JobQueue(db_path)
+    first = queue.enqueue("a@s", "a1", {"n": 1})
+    second = queue.enqueue("a@s", "a2", {"n": 2})
+    other = queue.enqueue("b@s", "b1", {"n": 3})
+
+    job_a = queue.claim()
+    assert job_a.id == first
+    # A segunda mensagem de 'a' espera pela primeira; 'b' não fica bloqueado
+    job_b = queue.claim()
+    assert job_b.id == other
+    assert queue.claim() is None
+
+    queue.complete(job_a)
+    assert queue.claim().id == second
+
+
+def test_failed_job_keeps_blocking_later_jobs_of_its_sender(db_path, update_job):
+    queue = JobQueue(db_path)
+    first = queue.enqueue("a@s", "a1", {})
+    queue.enqueue("a@s", "a2", {})
+
+    queue.fail(queue.claim(), RuntimeError("erro"))
+    # O job que falhou está à espera da nova tentativa: a mensagem seguinte não passa à frente
+    assert queue.claim() is None
+
+    update_job(first, available_at=0)
+    assert queue.claim().id == first
+
+
+def test_active_conversation_cap(db_path):
+    queue = JobQueue(db_path, max_active=2)
+    for sender in ("a@s", "b@s", "c@s"):
+        queue.enqueue(sender, f"{sender}-1", {})
+
+    job_a = queue.claim()
+    queue.claim()
+    # Limite atingido, somando todas as instâncias da fila sobre o mesmo banco
+    assert queue.claim() is None
+    assert JobQueue(db_path, max_active=2).claim() is None
+
+    queue.complete(job_a)
+    assert queue.claim().sender == "c@s"
+
+
+def test_expired_leases_do_not_count_towards_the_cap(db_path, update_job):
+    queue = JobQueue(db_path, max_active=1)
+    queue.enqueue("a@s", "a1", {})
+    queue.enqueue("b@s", "b1", {})
+    stuck = queue.claim()
+    assert queue.claim() is None
+
+    update_job(stuck.id, lease_until=0)
+    # O job abandonado é retomado primeiro (é o mais antigo)
+    assert queue.claim().id == stuck.id
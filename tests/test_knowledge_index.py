@@ -0,0 +1,66 @@
+# test_knowledge_index.py
+
+import os
+import json
+import numpy as np
+from db_connection import get_connection
+from knowledge_index import (
+    EMBEDDING_HEADER, encode_embedding, decode_embedding, is_binary_embedding,
+    bump_knowledge_version, quantized_matrix_paths, publish_knowledge_matrices, KnowledgeIndex
+)
+
+
+def test_binary_embedding_round_trip():
+    vector = np.random.default_rng(0).standard_normal(768).astype(np.float32)
+    blob = encode_embedding(vector)
+
+    assert is_binary_embedding(blob)
+    assert len(blob) == EMBEDDING_HEADER.size + vector.size * 4
+    decoded = decode_embedding(blob)
+    assert decoded.dtype == np.float32
+    np.testing.assert_array_equal(decoded, vector)
+
+
+def test_round_trip_from_a_list_read_as_memoryview():
+    # Conforme a versão do sqlite3, o BLOB pode chegar como bytes ou memoryview
+    blob = encode_embedding([0.5, -1.25, 3.0])
+    np.testing.assert_array_equal(decode_embedding(memoryview(blob)), [0.5, -1.25, 3.0])
+
+
+def test_legacy_json_embedding_is_decoded():
+    values = [0.1, -0.2, 0.3]
+    for stored in (json.dumps(values), json.dumps(values).encode('utf-8')):
+        assert not is_binary_embedding(stored)
+        decoded = decode_embedding(stored)
+        assert decoded.dtype == np.float32
+        np.testing.assert_allclose(decoded, values, rtol=1e-6)
+
+
+def add_chunks(db_path, count, dim=16):
+    vectors = np.random.default_rng(1).standard_normal((count, dim)).astype(np.float32)
+    conn = get_connection(db_path)
+    with conn:
+        conn.executemany("INSERT INTO knowledge_base (text_chunk, embedding) VALUES (?, ?)",
+                         [(f"chunk {i}", encode_embedding(v)) for i, v in enumerate(vectors)])
+        bump_knowledge_version(conn.cursor())
+
+
+def test_publish_exports_the_quantized_matrix(db_path):
+    add_chunks(db_path, 10)
+    version = publish_knowledge_matrices(db_path, quantization='int8')
+
+    assert all(os.path.exists(path) for path in quantized_matrix_paths(db_path, version, 'int8'))
+    index = KnowledgeIndex(db_path, use_ann=False, quantization='int8')
+    index.refresh()
+    assert index._data[2] is not None
+
+
+def test_worker_falls_back_to_float32_without_exporting(db_path):
+    add_chunks(db_path, 10)
+    version = publish_knowledge_matrices(db_path, quantization='none')
+
+    index = KnowledgeIndex(db_path, use_ann=False, quantization='float16')
+    index.refresh()
+    assert index._data[2] is None
+    assert not os.path.exists(quantized_matrix_paths(db_path, version, 'float16')[0])
+    assert len(index.search_positions(np.ones(16, dtype=np.float32), top_k=3)[0]) == 3
@@ -0,0 +1,35 @@
+# test_message_dedup.py
+
+from db_connection import get_connection
+from message_dedup import MessageDedup
+
+
+def test_duplicate_message_id_is_ignored(db_path):
+    dedup = MessageDedup(db_path)
+    assert dedup.mark_new("ABC123")
+    assert not dedup.mark_new("ABC123")
+    assert dedup.mark_new("XYZ789")
+    assert dedup.stats()["duplicates"] == 1
+
+
+def test_duplicate_is_detected_by_another_worker(db_path):
+    # Outro worker do gunicorn: LRU vazio, mesma tabela processed_messages
+    assert MessageDedup(db_path).mark_new("ABC123")
+    assert not MessageDedup(db_path).mark_new("ABC123")
+
+
+def test_message_id_is_accepted_again_after_the_ttl(db_path):
+    dedup = MessageDedup(db_path, ttl_seconds=60)
+    assert dedup.mark_new("ABC123")
+    conn = get_connection(db_path)
+    with conn:
+        conn.execute("UPDATE processed_messages SET seen_at = seen_at - 120")
+
+    assert MessageDedup(db_path, ttl_seconds=60).mark_new("ABC123")
+
+
+def test_forget_lets_a_redelivery_through(db_path):
+    dedup = MessageDedup(db_path)
+    dedup.mark_new("ABC123")
+    dedup.forget("ABC123")
+    assert dedup.mark_new("ABC123")
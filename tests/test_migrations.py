@@ -0,0 +1,22 @@
+# test_migrations.py
+
+import pytest
+
+from db_connection import get_connection
+from migrations import SCHEMA_VERSION, get_schema_version
+
+
+def test_schema_is_at_the_latest_version(db_path):
+    assert get_schema_version(get_connection(db_path)) == SCHEMA_VERSION
+
+
+@pytest.mark.parametrize("table", ["chat_history", "received_files"])
+def test_user_filtered_pages_use_an_index(db_path, table):
+    # Mesma forma da consulta de fetch_table_page com 'user_number' (ordem por id, sem ordenação extra)
+    plan = get_connection(db_path).execute(
+        f"EXPLAIN QUERY PLAN SELECT * FROM {table} WHERE user_number = ? AND id < ? ORDER BY id DESC LIMIT 101",
+        ("5511@s", 1000)
+    ).fetchall()
+    details = " ".join(row[-1] for row in plan)
+    assert "USING INDEX" in details
+    assert "TEMP B-TREE" not in details
@@ -0,0 +1,98 @@
+# test_prompt_budget.py
+
+from prompt_budget import (
+    fit_history_to_budget, estimate_tokens, MIN_TRUNCATED_TOKENS, TRUNCATION_MARKER, SUMMARY_PREFIX
+)
+
+
+def turn(role, text):
+    return {"role": role, "parts": [text]}
+
+
+def conversation(turns, chars=400):
+    """Histórico alternado user/model; cada mensagem tem chars/4 tokens e começa pelo seu número."""
+    history = []
+    for index in range(turns):
+        label = f"mensagem {index} "
+        history.append(turn('user' if index % 2 == 0 else 'model', label + "x" * (chars - len(label))))
+    return history
+
+
+def test_history_is_kept_whole_when_it_fits():
+    history = conversation(6)
+    kept, report = fit_history_to_budget(history, "persona", "pergunta", budget=100000)
+
+    assert kept == history
+    assert report["dropped_messages"] == 0
+    assert report["truncated_messages"] == 0
+
+
+def test_total_stays_within_the_budget():
+    history = conversation(40)
+    kept, report = fit_history_to_budget(history, "p" * 400, "q" * 200, budget=2000)
+
+    assert report["total_tokens"] <= 2000
+    assert report["dropped_messages"] > 0
+    assert report["kept_messages"] == len(kept)
+
+
+def test_newest_turns_are_kept():
+    history = conversation(40)
+    kept, report = fit_history_to_budget(history, "persona", "pergunta", budget=1000)
+
+    # 9 mensagens inteiras (as mais recentes, pela ordem original) e a anterior truncada
+    assert kept[1:] == history[-9:]
+    assert kept[0]['role'] == 'user'
+    assert kept[0]['parts'][0].startswith("mensagem 30 ")
+    assert kept[0]['parts'][0].endswith(TRUNCATION_MARKER)
+    assert report["truncated_messages"] == 1
+
+
+def test_history_starts_with_a_user_message():
+    # Sem espaço para truncar: a mensagem mais antiga que sobraria é do 'model' e sai
+    history = conversation(4)
+    budget = estimate_tokens("persona") + estimate_tokens("pergunta") + 3 * 100
+    kept, _ = fit_history_to_budget(history, "persona", "pergunta", budget=budget)
+
+    assert kept == history[2:]
+
+
+def test_single_message_larger_than_the_budget_is_truncated():
+    history = [turn('user', "y" * 40000)]
+    kept, report = fit_history_to_budget(history, "persona", "pergunta", budget=1000)
+
+    assert len(kept) == 1
+    assert kept[0]['parts'][0].endswith(TRUNCATION_MARKER)
+    assert report["truncated_messages"] == 1
+    assert report["total_tokens"] <= 1000
+
+
+def test_single_message_is_dropped_when_too_little_budget_is_left():
+    history = [turn('user', "y" * 40000)]
+    budget = estimate_tokens("persona") + estimate_tokens("pergunta") + MIN_TRUNCATED_TOKENS - 1
+    kept, report = fit_history_to_budget(history, "persona", "pergunta", budget=budget)
+
+    assert kept == []
+    assert report["dropped_messages"] == 1
+
+
+def test_user_message_larger_than_the_budget_leaves_no_history():
+    kept, report = fit_history_to_budget(conversation(4), "persona", "q" * 40000, budget=1000)
+
+    assert kept == []
+    assert report["history_tokens"] == 0
+
+
+def test_archived_summary_is_always_kept():
+    summary = [
+        turn('user', f"{SUMMARY_PREFIX}: " + "s" * 400),
+        turn('model', "Entendido, vou considerar este resumo na conversa."),
+    ]
+    kept, report = fit_history_to_budget(summary + conversation(40), "persona", "pergunta", budget=1000)
+
+    # Os tokens do resumo são reservados primeiro; só as mensagens recentes são cortadas
+    assert kept[:2] == summary
+    assert kept[-1] == conversation(40)[-1]
+    assert kept[2]['role'] == 'user'
+    assert report["summary_tokens"] == sum(estimate_tokens(entry['parts'][0]) for entry in summary)
+    assert report["total_tokens"] <= 1000